@@ -17,6 +17,7 @@ EXPLORATION = 50  # 1000
 N_PARTICLES = 200
 RELATIVE_EXPLO = False  # In this case use smaller exploration
 BELIEF_VALUES = False
+BELIEF_TOLERANCE = .05  # Groups particle beliefs for belief values
 EXPORT_BELIEF_QUOTIENT = True
 POMCP_DESTINATION = os.path.join(os.path.dirname(__file__),
                                  '../visualization/pomcp/json/pomcp.json')
@@ -40,6 +41,8 @@ pol = POMCPPolicyRunner(p, iterations=ITERATIONS,
                         exploration=EXPLORATION,
                         relative_exploration=RELATIVE_EXPLO,
                         belief_values=BELIEF_VALUES,
+                        tree_params=({'tolerance': BELIEF_TOLERANCE}
+                                     if BELIEF_VALUES else {}),
                         belief='particle',
                         belief_params={'n_particles': N_PARTICLES})
 
@@ -86,6 +86,9 @@ class Experiment(SupportiveExperiment):
             self.model.r_preference = 18
         if self.parameters['policy'] == 'pomcp':
             self.init_pomcp_policy()
+        elif self.parameters['policy'] == 'hierarchical-pomcp':
+            self.parameters['hierarchical'] = True
+            self.init_pomcp_policy()
         elif self.parameters['policy'] == 'repeat':
             self.policy = PolicyLongSupportiveSequence(self.model)
         elif self.parameters['policy'] == 'random':
@@ -5,15 +5,18 @@ import time
 import json
 import logging
 import argparse
+from functools import partial
 
 import matplotlib
 
 from expjobs.helpers import Launcher
 
-from task_models.lib.utils import NPEncoder
+from task_models.lib.utils import NPEncoder, BufferedRandom
 from task_models.utils.multiprocess import repeat, get_process_elapsed_time
 from task_models.lib.pomcp import NTransitionsHorizon, POMCPPolicyRunner
-from task_models.supportive import NHTMHorizon
+from task_models.lib.options import HierarchicalPolicyRunner
+from task_models.supportive import (NHTMHorizon, SupportiveRolloutPolicy,
+                                    HTMDistancePrior)
 
 
 class FinishedOrNTransitionsHorizon(NTransitionsHorizon):
@@ -33,6 +36,10 @@ class FinishedOrNTransitionsHorizon(NTransitionsHorizon):
     def copy(self):
         return FinishedOrNTransitionsHorizon(self.model, self.n)
 
+    def reset(self):
+        super(FinishedOrNTransitionsHorizon, self).reset()
+        self._is_final = False
+
     @classmethod
     def generator(cls, model, n=100):
         return cls._Generator(cls, model, n)
@@ -68,11 +75,15 @@ def simulate_one_evaluation(model, pol, max_horizon=200, logger=None,
     h_a = []
     h_o = []
     h_r = []
+    h_n = []  # Simulations run by the policy for each action
+    h_p = []  # Search profiles for each action (if profiling)
     horizon = FinishedOrNTransitionsHorizon(model, max_horizon)
     full_return = 0
     while not horizon.is_reached():
         a = model.actions.index(pol.get_action())
         h_a.append(a)
+        h_n.append(getattr(pol, 'last_iterations', None))
+        h_p.append(getattr(pol, 'last_profile', None))
         s, o, r = model.sample_transition(a, h_s[-1])  # real transition
         h_o.append(o)
         h_r.append(r)
@@ -92,14 +103,21 @@ def simulate_one_evaluation(model, pol, max_horizon=200, logger=None,
             'rewards': h_r,
             'elapsed-time': elapsed.total_seconds(),
             'simulator-calls': n_calls,
+            'simulations': h_n,
+            'profiles': h_p,
             }
 
 
-def evaluate(model, pol, n_evaluation, max_horizon=200, logger=None):
+def evaluate(model, pol, n_evaluation, max_horizon=200, logger=None,
+             seed=None, rngs=()):
+    """
+    :param seed: seed of the evaluation processes (see RepeatPool)
+    :param rngs: random sources to reseed in each process
+    """
     def func():
         return simulate_one_evaluation(model, pol, max_horizon=max_horizon,
                                        logger=logger)
-    return repeat(func, n_evaluation)
+    return repeat(func, n_evaluation, seed=seed, rngs=rngs)
 
 
 class SupportiveExperiment(object):
@@ -112,16 +130,29 @@ class SupportiveExperiment(object):
         'n_warmup': 2000,           # initial warmup exploration
         'n_evaluations': 20,        # number of evaluations
         'iterations': 1000,         # iterations for the policy (in get_action)
+        'time-budget': None,        # if set, seconds per action (in get_action)
+        'min-iterations': None,     # in time budget mode (default: n_actions)
         'rollout-iterations': 1,    # iterations for rollouts
         'exploration': 50,
         'relative-explo': False,    # In this case use smaller exploration
         'belief-values': False,
+        'belief-tolerance': .05,    # to group particle beliefs
         'n_particles': 150,
+        'belief-update': 'rejection',  # or weighted (particle filter)
+        'reinvigoration': 0.,       # for weighted belief updates
         'horizon-type': 'transitions',  # or htm
         'horizon-length': 20,
         'intermediate-rewards': False,
         'p_preference': 0.3,
         'policy': 'pomcp',
+        'rollout-policy': 'random',  # or htm
+        'legal-actions': False,     # only search actions legal in beliefs
+        'hierarchical': False,      # search over options from the HTM
+        'prior': None,              # or htm: prior values of new nodes
+        'prior-visits': 10,         # prior visits of each action
+        'tree-file': None,          # saved warm tree, created if missing
+        'profile': False,           # record search profiles
+        'seed': None,               # if set, seeds a BufferedRandom
     }
 
     EVALUATE_ARGUMENTS = {}
@@ -134,6 +165,20 @@ class SupportiveExperiment(object):
         self.log = logging.info
         self.results = {}
         self.path = None
+        self.rng = None
+
+    def _tree_params(self):
+        params = {}
+        if self.parameters['belief-values']:
+            params['tolerance'] = self.parameters['belief-tolerance']
+        if self.parameters['legal-actions']:
+            params['legal_actions'] = True
+        if self.parameters['prior'] == 'htm':
+            params['prior'] = HTMDistancePrior(
+                self.model, n_visits=self.parameters['prior-visits'])
+        elif self.parameters['prior'] is not None:
+            raise ValueError('Unknown prior: ' + str(self.parameters['prior']))
+        return params
 
     def set_debug_parameters(self):
         self.parameters['n_warmup'] = 2
@@ -148,17 +193,30 @@ class SupportiveExperiment(object):
             self.set_debug_parameters()
         self.log_parameters()
         self.results['parameters'] = self.parameters
+        if self.parameters['seed'] is not None:
+            self.rng = BufferedRandom(self.parameters['seed'])
         self.init_run()
-        self.log('Starting warmup')
-        # Some initial exploration
+        tree_file = self.parameters['tree-file']
         t_0 = time.time()
-        self.policy.get_action(iterations=self.parameters['n_warmup'])
+        if tree_file is not None and os.path.exists(tree_file):
+            self.log('Loading warm tree from ' + tree_file)
+            self.policy.load_tree(tree_file)
+        else:
+            self.log('Starting warmup')
+            # Some initial exploration
+            self.policy.get_action(iterations=self.parameters['n_warmup'])
+            self.results['warmup-profile'] = getattr(
+                self.policy, 'last_profile', None)
+            if tree_file is not None:
+                self.policy.save_tree(tree_file)
         self.results['t_warmup'] = time.time() - t_0
         self.log('Warmup done in {}s.'.format(self.results['t_warmup']))
         # Evaluation
         self.results['evaluations'] = evaluate(
             self.model, self.policy, self.parameters['n_evaluations'],
-            logger=self.log, **self.EVALUATE_ARGUMENTS)
+            logger=self.log, seed=self.parameters['seed'],
+            rngs=[] if self.rng is None else [self.rng],
+            **self.EVALUATE_ARGUMENTS)
         # Finishing
         self.finish_run()
         if self.path is not None:
@@ -180,8 +238,25 @@ class SupportiveExperiment(object):
         pass
 
     def init_pomcp_policy(self):
-        self.policy = POMCPPolicyRunner(
+        if self.rng is not None:
+            self.model.rng = self.rng
+        if self.parameters['hierarchical']:
+            if self.parameters['rollout-policy'] == 'htm':
+                raise ValueError('Hierarchical search only supports random '
+                                 'rollouts')
+            if (self.parameters['legal-actions'] or
+                    self.parameters['prior'] is not None):
+                raise ValueError('Hierarchical search does not support '
+                                 'legal actions and priors')
+            runner = partial(HierarchicalPolicyRunner,
+                             options=self.model.htm_options())
+        else:
+            runner = POMCPPolicyRunner
+        self.policy = runner(
             self.model, iterations=self.parameters['iterations'],
+            time_budget=self.parameters['time-budget'],
+            min_iterations=self.parameters['min-iterations'],
+            profile=self.parameters['profile'],
             rollout_it=self.parameters['rollout-iterations'],
             horizon=(NHTMHorizon if self.parameters['horizon-type'] == 'htm'
                      else FinishedOrNTransitionsHorizon
@@ -189,8 +264,17 @@ class SupportiveExperiment(object):
             exploration=self.parameters['exploration'],
             relative_exploration=self.parameters['relative-explo'],
             belief_values=self.parameters['belief-values'],
+            tree_params=self._tree_params(),
             belief='particle',
-            belief_params={'n_particles': self.parameters['n_particles']})
+            belief_params={
+                'n_particles': self.parameters['n_particles'],
+                'update': self.parameters['belief-update'],
+                'reinvigoration': self.parameters['reinvigoration']},
+            rollout_policy=(
+                SupportiveRolloutPolicy(
+                    self.model,
+                    legal_actions=self.parameters['legal-actions'])
+                if self.parameters['rollout-policy'] == 'htm' else None))
 
     def write_result(self, path):
         with io.open(path, 'w') as f:
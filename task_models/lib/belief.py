@@ -1,11 +1,23 @@
+from collections import OrderedDict
+
 import numpy as np
 
-from .utils import assert_normal
+from .utils import assert_normal, RandomSource
+from .pomdp import Impossible
+
+
+def _quantized_signature(states, probabilities, tolerance):
+    # Probabilities are rounded to multiples of tolerance, zeros are dropped
+    q = np.round(np.asarray(probabilities) / tolerance).astype(np.int64)
+    keep = q != 0
+    return (np.asarray(states, dtype=np.int64)[keep].tobytes(),
+            q[keep].tobytes())
 
 
 class BaseBelief(object):
 
-    def sample(self):
+    def sample(self, n=None):
+        """One state, or an array of n states if n is given."""
         raise NotImplemented
 
     def successor(self, model, a, o):
@@ -14,25 +26,113 @@ class BaseBelief(object):
     def to_list(self):
         return self.array.tolist()
 
-
-class ArrayBelief(BaseBelief):
-
-    def __init__(self, probabilities):
+    @property
+    def nbytes(self):
+        """Estimated memory footprint of the belief data."""
+        raise NotImplementedError
+
+    def signature(self, tolerance):
+        """Hashable key, identical for beliefs whose probabilities round
+        to the same multiples of tolerance."""
+        raise NotImplementedError
+
+    def support(self):
+        """Array of the states of nonzero probability."""
+        raise NotImplementedError
+
+    def legal_actions(self, model):
+        """Boolean mask of the actions legal in at least one state of the
+        support, from model.legal_actions (cached).
+        """
+        mask = getattr(self, '_legal_actions', None)
+        if mask is None:
+            mask = np.zeros((model.n_actions,), dtype=bool)
+            for s in self.support():
+                mask |= model.legal_actions(s)
+            self._legal_actions = mask
+        return mask
+
+
+class ArrayBelief(BaseBelief, RandomSource):
+    """
+    :param rng: random source for sampling (np.random or BufferedRandom),
+        passed to successors (None: np.random)
+    """
+
+    def __init__(self, probabilities, rng=None):
         self.array = np.asarray(probabilities)
         assert_normal(self.array, name='probabilities')
+        self.rng = rng
 
     def __hash__(self):
-        return hash(self.array.tostring())
+        return hash(self.array.tobytes())
 
     def __eq__(self, other):
         return (isinstance(other, ArrayBelief) and
                 (self.array == other.array).all())
 
-    def sample(self):
-        return np.random.choice(self.array.shape[0], p=self.array)
+    def sample(self, n=None):
+        return self.rng.choice(self.array.shape[0], size=n, p=self.array)
 
     def successor(self, model, a, o):
-        return ArrayBelief(model.belief_update(a, o, self.array))
+        return ArrayBelief(model.belief_update(a, o, self.array),
+                           rng=self.rng)
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def support(self):
+        return np.flatnonzero(self.array)
+
+    def signature(self, tolerance):
+        states = np.flatnonzero(self.array)
+        return _quantized_signature(states, self.array[states], tolerance)
+
+
+class SuccessorCache(object):
+    """LRU cache of the belief updates of one model, keyed on the belief
+    array, action and observation. Impossible updates are cached as well
+    and raise Impossible again. Cached arrays are read-only, so they can be
+    shared by the beliefs of several search trees and policy runners.
+
+    :param max_size: maximum number of cached updates
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def belief_update(self, model, a, o, b):
+        """Cached model.belief_update(a, o, b) for an array b."""
+        b = np.asarray(b)
+        key = (b.tobytes(), a, o)
+        new_b = self._cache.pop(key, None)
+        if new_b is None:
+            self.misses += 1
+            try:
+                new_b = np.array(model.belief_update(a, o, b))
+                new_b.flags.writeable = False
+            except Impossible as e:
+                new_b = e
+            if len(self._cache) >= self.max_size:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self._cache[key] = new_b  # Most recently used last
+        if isinstance(new_b, Impossible):
+            raise Impossible(*new_b.args)
+        return new_b
+
+    def successor(self, model, belief, a, o):
+        """Cached successor of an ArrayBelief."""
+        return ArrayBelief(self.belief_update(model, a, o, belief.array),
+                           rng=belief.rng)
 
 
 class MaxSamplesReached(RuntimeError):
@@ -73,47 +173,251 @@ class _SuccessorSampler:
         return s
 
 
-class ParticleBelief(BaseBelief):
+class SparseBelief(BaseBelief, RandomSource):
+    """Belief given by the sorted states of nonzero probability and their
+    probabilities, for large state spaces with small supports. Successors
+    are computed by model.sparse_belief_update.
 
-    def __init__(self, sampler, n_states, n_particles=100):
+    :param rng: random source for sampling (np.random or BufferedRandom),
+        passed to successors (None: np.random)
+    """
+
+    def __init__(self, states, probabilities, n_states, rng=None):
+        self.states = np.asarray(states, dtype=np.int64)
+        self.probabilities = np.asarray(probabilities, dtype=float)
+        assert_normal(self.probabilities, name='probabilities')
+        if np.any(np.diff(self.states) <= 0):
+            raise ValueError('States of sparse beliefs must be sorted and '
+                             'unique.')
+        self.n_states = n_states
+        self.rng = rng
+
+    @classmethod
+    def from_array(cls, array, rng=None):
+        array = np.asarray(array)
+        states = np.flatnonzero(array)
+        return cls(states, array[states], array.shape[0], rng=rng)
+
+    def __hash__(self):
+        return hash((self.states.tobytes(), self.probabilities.tobytes()))
+
+    def __eq__(self, other):
+        return (isinstance(other, SparseBelief) and
+                np.array_equal(self.states, other.states) and
+                np.array_equal(self.probabilities, other.probabilities))
+
+    def sample(self, n=None):
+        i = self.rng.choice(self.states.shape[0], size=n,
+                            p=self.probabilities)
+        return int(self.states[i]) if n is None else self.states[i]
+
+    def successor(self, model, a, o):
+        states, probabilities = model.sparse_belief_update(
+            a, o, self.states, self.probabilities)
+        return SparseBelief(states, probabilities, self.n_states,
+                            rng=self.rng)
+
+    @property
+    def array(self):
+        """Dense probabilities."""
+        a = np.zeros((self.n_states,))
+        a[self.states] = self.probabilities
+        return a
+
+    @property
+    def nbytes(self):
+        return self.states.nbytes + self.probabilities.nbytes
+
+    def support(self):
+        return self.states
+
+    def signature(self, tolerance):
+        return _quantized_signature(self.states, self.probabilities,
+                                    tolerance)
+
+
+def systematic_resample(weights, n, rng=np.random):
+    """Indices of n samples from the (unnormalized) weights, by systematic
+    resampling: a single uniform draw is spread over n evenly spaced
+    positions, which keeps the variance of the counts low.
+    """
+    if n == 0:
+        return np.zeros((0,), dtype=np.int64)
+    cumulated = np.cumsum(weights)
+    positions = (rng.random() + np.arange(n)) * (cumulated[-1] / n)
+    return np.minimum(np.searchsorted(cumulated, positions, side='right'),
+                      len(cumulated) - 1)
+
+
+class ParticleBelief(BaseBelief, RandomSource):
+    """Belief represented by a read-only int64 array of particles (states).
+    Particle arrays are never modified once set, so that they can be shared
+    between beliefs, e.g. a successor identical to its parent.
+
+    :param rng: random source for sampling (np.random or BufferedRandom),
+        passed to successors (None: np.random)
+    :param update: 'rejection' | 'weighted'
+        How successors are sampled: 'rejection' simulates transitions until
+        the observation matches, 'weighted' simulates one transition per
+        particle, weights it by model.observation_probability and resamples.
+        Weighted updates fall back to rejection sampling when no simulated
+        transition is consistent with the observation.
+    :param reinvigoration: fraction of the particles of weighted updates
+        replaced by new successors sampled by rejection, which brings back
+        states missed by the simulated transitions
+    """
+
+    def __init__(self, sampler, n_states, n_particles=100, rng=None,
+                 update='rejection', reinvigoration=0.):
+        if update not in ('rejection', 'weighted'):
+            raise ValueError('Unknown belief update: ' + str(update))
         self.n_states = n_states
         self.n_particles = n_particles
-        self.part_states = []
-        self._populate(sampler)
+        self.rng = rng
+        self.update = update
+        self.reinvigoration = reinvigoration
+        self._array = None
+        self._unique = None
+        self._shared = False
+        if sampler is not None:
+            self._populate(sampler)
+
+    @classmethod
+    def from_particles(cls, particles, n_states, rng=None,
+                       update='rejection', reinvigoration=0.):
+        """Belief with the given particles (states). Read-only int64 arrays
+        are shared rather than copied.
+        """
+        b = cls(None, n_states, len(particles), rng=rng, update=update,
+                reinvigoration=reinvigoration)
+        b._set_particles(particles)
+        return b
+
+    def _set_particles(self, particles):
+        if not (isinstance(particles, np.ndarray) and
+                particles.dtype == np.int64 and
+                not particles.flags.writeable):
+            particles = np.array(particles, dtype=np.int64)
+            particles.flags.writeable = False
+        self.part_states = particles
 
     def _populate(self, sampler):
+        particles = []
         try:
-            while len(self.part_states) < self.n_particles:
-                self.part_states.append(sampler())
+            while len(particles) < self.n_particles:
+                particles.append(sampler())
         except MaxSamplesReached as e:
-            if len(self.part_states) > 0:
+            if len(particles) > 0:
                 # duplicate found particles
-                n_part = len(self.part_states)
-
-                def self_sampler():
-                    return self.sample(_max_index=n_part)
-
-                self._populate(self_sampler)
+                particles.extend(np.asarray(particles)[self.rng.randint(
+                    len(particles), size=self.n_particles - len(particles))])
             else:
                 e.msg = "Impossible to sample any particle."
                 raise e
+        self._set_particles(particles)
 
-    def sample(self, _max_index=None):
-        if _max_index is None:
-            _max_index = self.n_particles
-        return self.part_states[np.random.choice(_max_index)]
+    def sample(self, n=None):
+        """One state, or an array of n states if n is given."""
+        if n is None:
+            return int(self.part_states[self.rng.choice(self.n_particles)])
+        return self.part_states[self.rng.randint(self.n_particles, size=n)]
 
     def successor(self, model, a, o):
+        if self.update == 'weighted':
+            return self._weighted_successor(model, a, o)
+        return self._rejection_successor(model, a, o)
+
+    def _rejection_successor(self, model, a, o):
         sampler = _SuccessorSampler(model, self, a, o,
                                     max_samples=100 * self.n_particles)
-        return ParticleBelief(sampler, self.n_states, self.n_particles)
+        succ = ParticleBelief(sampler, self.n_states, self.n_particles,
+                              rng=self.rng, update=self.update,
+                              reinvigoration=self.reinvigoration)
+        succ._share_identical(self)
+        return succ
+
+    def _weighted_successor(self, model, a, o):
+        if not hasattr(model, 'observation_probability'):
+            raise ValueError('Weighted belief updates require the '
+                             'observation_probability of the model.')
+        states = self.part_states
+        if hasattr(model, 'sample_transitions'):
+            new_states = np.asarray(model.sample_transitions(a, states)[0])
+        else:
+            new_states = np.array([model.sample_transition(a, s)[0]
+                                   for s in states])
+        weights = np.asarray(
+            model.observation_probability(a, states, new_states, o),
+            dtype=float)
+        if not weights.sum() > 0.:
+            # The observation is too unlikely for the simulated transitions
+            return self._rejection_successor(model, a, o)
+        n_fresh = int(round(self.reinvigoration * self.n_particles))
+        particles = new_states[systematic_resample(
+            weights, self.n_particles - n_fresh, rng=self.rng)]
+        if n_fresh > 0:
+            sampler = _SuccessorSampler(model, self, a, o,
+                                        max_samples=100 * n_fresh)
+            fresh = []
+            try:
+                while len(fresh) < n_fresh:
+                    fresh.append(sampler())
+            except MaxSamplesReached:
+                # Completed with weighted successors
+                fresh.extend(new_states[systematic_resample(
+                    weights, n_fresh - len(fresh), rng=self.rng)])
+            particles = np.concatenate(
+                [particles, np.array(fresh, dtype=np.int64)])
+        succ = ParticleBelief.from_particles(
+            particles, self.n_states, rng=self.rng,
+            update=self.update, reinvigoration=self.reinvigoration)
+        succ._share_identical(self)
+        return succ
+
+    def _share_identical(self, other):
+        """Uses the particles and cached histograms of other if both beliefs
+        hold the same particles, in any order.
+        """
+        if len(self.part_states) != len(other.part_states):
+            return
+        states, counts = self._unique_counts()
+        other_states, other_counts = other._unique_counts()
+        if (np.array_equal(states, other_states) and
+                np.array_equal(counts, other_counts)):
+            self.part_states = other.part_states
+            self._array = other._array
+            self._unique = other._unique
+            self._shared = True
+
+    @property
+    def nbytes(self):
+        """Estimated memory footprint of the particles. Particles shared
+        with another belief are only counted for that belief.
+        """
+        return 0 if self._shared else self.part_states.nbytes
+
+    def _unique_counts(self):
+        if self._unique is None:
+            self._unique = np.unique(self.part_states, return_counts=True)
+        return self._unique
+
+    def support(self):
+        return self._unique_counts()[0]
+
+    def signature(self, tolerance):
+        states, counts = self._unique_counts()
+        return _quantized_signature(states, counts / float(counts.sum()),
+                                    tolerance)
 
     @property
     def array(self):
-        a = np.zeros((self.n_states))
-        for i in self.part_states:
-            a[i] += 1
-        return a / (a.sum() or 1.)
+        """Histogram of the particles (cached, read-only)."""
+        if self._array is None:
+            a = np.bincount(self.part_states, minlength=self.n_states)
+            a = a / float(max(len(self.part_states), 1))
+            a.flags.writeable = False
+            self._array = a
+        return self._array
 
 
 def _format_p(x):
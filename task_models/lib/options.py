@@ -0,0 +1,225 @@
+"""Hierarchical search over options, i.e. closed-loop sub-policies on the
+primitive actions of a model.
+
+The search tree of a POMCPPolicyRunner is built on an OptionModel whose
+actions are the options and whose observations are the sequences of
+primitive observations received while running an option. Each search step
+then covers several primitive transitions, which shortens the planning
+horizon. HierarchicalPolicyRunner executes the chosen options one
+primitive action at a time.
+"""
+
+from .pomcp import POMCPPolicyRunner
+
+
+class Option(object):
+    """Closed-loop sub-policy: chooses primitive actions from the primitive
+    observations received since the option started.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def action(self, observations):
+        """Next primitive action after the given observations (list of
+        observation indices), None once the option is terminated. Must
+        return an action for an empty list.
+        """
+        raise NotImplementedError
+
+
+class SequenceOption(Option):
+    """Runs actions in order. An action is tried again (at most
+    max_retries times) when its observation is in retry_observations.
+    """
+
+    def __init__(self, name, actions, retry_observations=(), max_retries=1):
+        super(SequenceOption, self).__init__(name)
+        if len(actions) == 0:
+            raise ValueError('An option requires at least one action')
+        self.actions = list(actions)
+        self.retry_observations = set(retry_observations)
+        self.max_retries = max_retries
+
+    def action(self, observations):
+        i = 0
+        retries = 0
+        for o in observations:
+            if o in self.retry_observations and retries < self.max_retries:
+                retries += 1
+            else:
+                i += 1
+                retries = 0
+        return self.actions[i] if i < len(self.actions) else None
+
+
+class OptionModel(object):
+    """Model whose actions are the options run on model.
+
+    Observations are the sequences of primitive observations of the
+    options, indexed in order of appearance (observations holds their
+    names). Rewards of an option are discounted by the discount of the
+    model within the option; between options the discount is applied once,
+    which is exact for undiscounted models.
+
+    :param max_steps: maximum number of primitive transitions of an option
+    """
+
+    def __init__(self, model, options, max_steps=20):
+        self.model = model
+        self.options = options
+        self.max_steps = max_steps
+        self.actions = [opt.name for opt in options]
+        self.n_actions = len(options)
+        self.observations = []  # Names of the observation sequences
+        self._sequences = []
+        self._sequence_ids = {}
+
+    @property
+    def n_states(self):
+        return self.model.n_states
+
+    @property
+    def discount(self):
+        return self.model.discount
+
+    @property
+    def start(self):
+        return self.model.start
+
+    @property
+    def rng(self):
+        return getattr(self.model, 'rng', None)
+
+    def sample_start(self):
+        return self.model.sample_start()
+
+    def observation_id(self, sequence):
+        """Index of the sequence of primitive observations."""
+        sequence = tuple(sequence)
+        i = self._sequence_ids.get(sequence)
+        if i is None:
+            i = len(self._sequences)
+            self._sequence_ids[sequence] = i
+            self._sequences.append(sequence)
+            self.observations.append(
+                ', '.join([str(self.model.observations[o])
+                           for o in sequence]))
+        return i
+
+    def observation_sequence(self, o):
+        return self._sequences[o]
+
+    def is_terminated(self, option, observations):
+        return (len(observations) >= self.max_steps or
+                self.options[option].action(observations) is None)
+
+    def sample_transition(self, a, s):
+        option = self.options[a]
+        observations = []
+        full_return = 0.
+        gamma = 1.
+        while not self.is_terminated(a, observations):
+            s, o, r = self.model.sample_transition(
+                option.action(observations), s)
+            observations.append(o)
+            full_return += gamma * r
+            gamma *= self.model.discount
+        return s, self.observation_id(observations), full_return
+
+    def belief_update(self, a, o, b):
+        # The primitive actions are given by the observations
+        option = self.options[a]
+        sequence = self.observation_sequence(o)
+        for i, primitive_o in enumerate(sequence):
+            b = self.model.belief_update(option.action(list(sequence[:i])),
+                                         primitive_o, b)
+        return b
+
+
+class HierarchicalPolicyRunner(object):
+    """Runs a POMCPPolicyRunner on the options of the model and executes the
+    chosen option one primitive action at a time. Actions and observations
+    are the primitive ones of the model.
+
+    :param options: list of Option
+    :param max_steps: maximum number of primitive transitions of an option
+    :param kwargs: parameters of the POMCPPolicyRunner
+    """
+
+    def __init__(self, model, options, max_steps=20, **kwargs):
+        self.model = model
+        self.option_model = OptionModel(model, options, max_steps=max_steps)
+        self.runner = POMCPPolicyRunner(self.option_model, **kwargs)
+        self.last_iterations = 0
+        self.last_elapsed = 0.
+        self.last_profile = None
+        self._reset()
+
+    @property
+    def actions(self):
+        return self.model.actions
+
+    @property
+    def observations(self):
+        return self.model.observations
+
+    @property
+    def tree(self):
+        return self.runner.tree
+
+    @property
+    def belief(self):
+        """Belief at the start of the current option."""
+        return self.runner.belief
+
+    def reset(self, belief=None):
+        self.runner.reset(belief=belief)
+        self._reset()
+
+    def _reset(self):
+        self.history = []  # Primitive actions and observations
+        self._option = None
+        self._option_observations = []
+        self._last_action = None
+
+    def load_tree(self, f):
+        self.runner.load_tree(f)
+        self._reset()
+
+    def save_tree(self, f):
+        self.runner.save_tree(f)
+
+    def get_action(self, iterations=None, time_budget=None):
+        """Primitive action of the current option, after searching for a new
+        option if the previous one is terminated.
+        """
+        if self._option is None:
+            self._option = self.option_model.actions.index(
+                self.runner.get_action(iterations=iterations,
+                                       time_budget=time_budget))
+            self._option_observations = []
+            self.last_iterations = self.runner.last_iterations
+            self.last_elapsed = self.runner.last_elapsed
+            self.last_profile = self.runner.last_profile
+        else:
+            self.last_iterations = 0
+            self.last_elapsed = 0.
+            self.last_profile = None
+        self._last_action = self.option_model.options[self._option].action(
+            self._option_observations)
+        return self.actions[self._last_action]
+
+    def step(self, observation):
+        if self._last_action is None:
+            raise ValueError('Unknown last action')
+        o = self.observations.index(observation)
+        self.history = self.history + [self._last_action, o]
+        self._option_observations.append(o)
+        self._last_action = None
+        if self.option_model.is_terminated(self._option,
+                                           self._option_observations):
+            sequence = self.option_model.observation_id(
+                self._option_observations)
+            self.runner.step(self.option_model.observations[sequence])
+            self._option = None
@@ -2,12 +2,21 @@ import time
 import math
 import json
 import threading
+import multiprocessing
 from numbers import Integral
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 import numpy as np
 
-from .belief import (ArrayBelief, ParticleBelief, MaxSamplesReached,
+from .belief import (ArrayBelief, ParticleBelief, SparseBelief,
+                     MaxSamplesReached,
                      format_belief_array)
+from .pomdp import GraphPolicy
+from .utils import NPEncoder, RandomSource
 
 
 class Horizon(object):
@@ -31,6 +40,16 @@ class Horizon(object):
     def copy(self):
         raise NotImplementedError
 
+    def reset(self):
+        """Restores the initial horizon, so that the object can be reused
+        for the next simulation."""
+        raise NotImplementedError
+
+    def key(self):
+        """Hashable summary of the remaining horizon, used to cache rollout
+        returns."""
+        raise NotImplementedError
+
     @classmethod
     def generator(cls, model, **parameters):
         raise NotImplementedError
@@ -40,6 +59,7 @@ class NTransitionsHorizon(Horizon):
 
     def __init__(self, n):
         self.n = n
+        self._initial_n = n
 
     def is_reached(self):
         return self.n <= 0
@@ -50,6 +70,12 @@ class NTransitionsHorizon(Horizon):
     def copy(self):
         return NTransitionsHorizon(self.n)
 
+    def reset(self):
+        self.n = self._initial_n
+
+    def key(self):
+        return self.n
+
     @classmethod
     def generator(cls, model, n=100):
         return cls._Generator(cls, n)
@@ -64,28 +90,415 @@ def _null_logger(*args, **kwargs):
     pass
 
 
-class _SearchTree:
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _beliefs_to_arrays(beliefs):
+    if all(isinstance(b, ParticleBelief) for b in beliefs):
+        return {'particles': np.array([b.part_states for b in beliefs],
+                                      dtype=np.int64),
+                'n_states': np.array(beliefs[0].n_states)}
+    elif all(isinstance(b, ArrayBelief) for b in beliefs):
+        return {'beliefs': np.array([b.array for b in beliefs])}
+    elif all(isinstance(b, SparseBelief) for b in beliefs):
+        return {'sparse_indptr': np.cumsum([0] + [len(b.states)
+                                                 for b in beliefs]),
+                'sparse_states': np.concatenate([b.states for b in beliefs]),
+                'sparse_probabilities': np.concatenate(
+                    [b.probabilities for b in beliefs]),
+                'n_states': np.array(beliefs[0].n_states)}
+    else:
+        raise ValueError('Can only save array, particle or sparse beliefs.')
+
+
+def _beliefs_from_arrays(arrays, rng=None, belief_params={}):
+    if 'particles' in arrays:
+        n_states = int(arrays['n_states'])
+        # The number of particles is the one saved
+        params = dict((k, v) for k, v in belief_params.items()
+                      if k != 'n_particles')
+        return [ParticleBelief.from_particles(p, n_states, rng=rng, **params)
+                for p in arrays['particles']]
+    elif 'sparse_indptr' in arrays:
+        n_states = int(arrays['n_states'])
+        indptr = arrays['sparse_indptr']
+        return [SparseBelief(arrays['sparse_states'][i:j],
+                             arrays['sparse_probabilities'][i:j], n_states,
+                             rng=rng)
+                for i, j in zip(indptr[:-1], indptr[1:])]
+    else:
+        return [ArrayBelief(b, rng=rng) for b in arrays['beliefs']]
+
+
+def _widening_limit(widening, n):
+    """Maximum number of children, k * n^alpha (at least one), for
+    widening = (k, alpha)."""
+    k, alpha = widening
+    return max(1, int(math.ceil(k * n ** alpha)))
+
+
+def _sample_existing(keys, visits, rng=np.random):
+    """Samples one of the keys with probability proportional to visits + 1.
+    """
+    weights = np.asarray(visits, dtype=float) + 1.
+    return keys[rng.choice(len(keys), p=weights / weights.sum())]
+
+
+def _select_action(visits, totals, n_simulations, exploration=0,
+                   relative_exploration=False, max_children=None,
+                   exploit=False, mask=None, rng=np.random):
+    """UCB action selection from the statistics of the action children.
+    Unexplored actions are tried first unless max_children actions have
+    already been explored. With exploit, returns the explored action of
+    best value (a random action if none is explored). If given, mask is a
+    boolean array of the actions that can be selected.
+    """
+    if mask is not None and not mask.all():
+        legal = np.flatnonzero(mask)
+        return legal[_select_action(visits[legal], totals[legal],
+                                    n_simulations, exploration=exploration,
+                                    relative_exploration=relative_exploration,
+                                    max_children=max_children,
+                                    exploit=exploit, rng=rng)]
+    not_init = np.flatnonzero(visits == 0)
+    if exploit and len(not_init) < len(visits):
+        tried = np.flatnonzero(visits > 0)
+        return tried[np.argmax(totals[tried] / visits[tried])]
+    elif exploit:
+        return rng.choice(not_init)
+    if len(not_init) > 0 and (max_children is None or
+                              len(visits) - len(not_init) < max_children):
+        # Chose an unexplored action
+        return rng.choice(not_init)
+    assert(n_simulations > 0)  # explored if children explored
+    if len(not_init) > 0:  # Only select among explored actions
+        tried = np.flatnonzero(visits > 0)
+        return tried[_select_action(visits[tried], totals[tried],
+                                    n_simulations, exploration=exploration,
+                                    relative_exploration=relative_exploration,
+                                    rng=rng)]
+    # Augmented greedy (UCT)
+    values = totals / visits
+    if exploration > 0 and relative_exploration:
+        exploration *= values.max() - values.min()
+    return np.argmax(values + exploration * np.sqrt(
+        np.log(n_simulations) / visits))
+
+
+class RolloutPolicy(RandomSource):
+    """Policy used to choose actions during rollouts, from the sampled state.
+
+    :param epsilon: probability of choosing a random action instead (0.)
+    :param legal_actions: only choose random actions among the legal
+        actions of the state, from model.legal_actions (False)
+    :param rng: random source (None: the one of the model if any, else
+        np.random)
+    """
+
+    def __init__(self, model, epsilon=0., legal_actions=False, rng=None):
+        self.model = model
+        self.epsilon = epsilon
+        self.legal_actions = legal_actions
+        self.rng = rng
+
+    def _default_rng(self):
+        return getattr(self.model, 'rng', np.random)
+
+    def action(self, s):
+        if self.epsilon > 0 and self.rng.random() < self.epsilon:
+            return self._random_action(s)
+        return self._action(s)
+
+    def _random_action(self, s):
+        if self.legal_actions:
+            return self.rng.choice(
+                np.flatnonzero(self.model.legal_actions(s)))
+        return self.rng.randint(self.model.n_actions)
+
+    def actions(self, states):
+        """Actions for an array of states (used by batch rollouts)."""
+        return np.array([self.action(s) for s in states], dtype=np.int64)
+
+    def _action(self, s):
+        raise NotImplementedError
+
+
+class RandomRolloutPolicy(RolloutPolicy):
+
+    def action(self, s):
+        return self._random_action(s)
+
+    def actions(self, states):
+        if self.legal_actions:
+            return np.array([self._random_action(s) for s in states],
+                            dtype=np.int64)
+        return self.rng.randint(self.model.n_actions, size=len(states))
+
+
+class TabularRolloutPolicy(RolloutPolicy):
+    """
+    :param table: array of the action to take from each state
+    """
+
+    def __init__(self, model, table, epsilon=0., legal_actions=False,
+                 rng=None):
+        super(TabularRolloutPolicy, self).__init__(
+            model, epsilon=epsilon, legal_actions=legal_actions, rng=rng)
+        self.table = np.asarray(table, dtype=np.int64)
+
+    def _action(self, s):
+        return self.table[s]
+
+    def actions(self, states):
+        actions = self.table[np.asarray(states)]
+        if self.epsilon > 0:
+            explore = self.rng.random(actions.shape) < self.epsilon
+            if self.legal_actions:
+                actions[explore] = [self._random_action(s)
+                                    for s in np.asarray(states)[explore]]
+            else:
+                actions[explore] = self.rng.randint(self.model.n_actions,
+                                                    size=explore.sum())
+        return actions
+
+    @classmethod
+    def from_pomdp(cls, pomdp, n_iterations=100, epsilon=0., rng=None):
+        """Greedy policy for the underlying fully observable MDP."""
+        return cls(pomdp, pomdp.mdp_q_values(n_iterations).argmax(0),
+                   epsilon=epsilon, rng=rng)
+
+
+class ActionPrior(object):
+    """Initial statistics of the actions of new observation nodes, as if
+    each action had been explored n_visits times with the return given by
+    values. Search then starts from the actions of best prior value instead
+    of trying each action first.
+
+    :param n_visits: number of prior visits of each action
+    """
+
+    def __init__(self, n_visits=10):
+        self.n_visits = n_visits
+
+    def values(self, belief):
+        """Array of the prior value of each action from belief."""
+        raise NotImplementedError
+
+
+class QMDPPrior(ActionPrior):
+    """Action values of the underlying fully observable MDP averaged over
+    the belief (QMDP), for tabular POMDP models.
+
+    :param n_iterations: iterations of value iteration
+    """
+
+    def __init__(self, pomdp, n_visits=10, n_iterations=100):
+        super(QMDPPrior, self).__init__(n_visits=n_visits)
+        self.q_values = pomdp.mdp_q_values(n_iterations)
+
+    def values(self, belief):
+        return self.q_values.dot(belief.array)
+
+
+class RolloutCache(object):
+    """Bounded cache of average rollout returns, keyed by state and
+    remaining horizon. Once an entry averages n_samples returns, its
+    average is used instead of running new rollouts.
+
+    :param max_size: maximum number of entries, least recently used entries
+        are evicted first
+    :param n_samples: number of rollouts to average before using the entry
+    """
+
+    def __init__(self, max_size=10000, n_samples=10):
+        self.max_size = max_size
+        self.n_samples = n_samples
+        self._entries = OrderedDict()  # key -> [n, average return]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Cached return or None if not enough samples."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry  # Mark as recently used
+        return entry[1] if entry[0] >= self.n_samples else None
+
+    def add(self, key, value):
+        entry = self._entries.pop(key, [0, 0.])
+        entry[0] += 1
+        entry[1] += (value - entry[1]) / entry[0]
+        self._entries[key] = entry
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SearchProfile(object):
+    """Cumulative durations (in seconds) of the phases of the search and
+    counters of search events, gathered by trees created with profile=True.
+
+    Phases are selection (descent in the tree, including transitions
+    sampled on the way), successor (belief update for new nodes), rollout
+    and backup. Counters are simulations, rollout_steps, simulator_calls
+    (including the ones of particle belief updates), max_samples_reached
+    (failed belief updates) and new_nodes.
+    """
+
+    PHASES = ['selection', 'successor', 'rollout', 'backup']
+    COUNTERS = ['simulations', 'rollout_steps', 'simulator_calls',
+                'max_samples_reached', 'new_nodes']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times = {p: 0. for p in self.PHASES}
+        self.counts = {c: 0 for c in self.COUNTERS}
+        self._last = _clock()
+
+    def start(self):
+        self._last = _clock()
+
+    def lap(self, phase):
+        """Adds the time since the last lap (or start) to phase."""
+        now = _clock()
+        self.times[phase] += now - self._last
+        self._last = now
+
+    def to_dict(self):
+        return {'times': dict(self.times), 'counts': dict(self.counts)}
+
+
+class _CountingSimulator(object):
+    """Model proxy that counts the transitions sampled through it, e.g. by
+    the rejection sampling of particle belief updates.
+    """
+
+    def __init__(self, model, counts):
+        self._model = model
+        self._counts = counts
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def sample_transition(self, a, s):
+        self._counts['simulator_calls'] += 1
+        return self._model.sample_transition(a, s)
+
+    def sample_transitions(self, a, s):
+        self._counts['simulator_calls'] += len(s)
+        return self._model.sample_transitions(a, s)
+
+
+class _SearchTree(RandomSource):
+    """
+    :param max_nodes: maximum number of observation nodes (None)
+    :param max_bytes: maximum estimated memory footprint, including
+        beliefs (None)
+    :param prune: once the budget is reached, prune least visited subtrees
+        instead of stopping the expansion of the tree (False)
+    :param batch_rollouts: run all rollouts from a node together, through
+        the model's vectorized sample_transitions (False, ignored for models
+        that do not implement it)
+    :param rollout_policy: RolloutPolicy used for rollouts (None for
+        uniformly random actions)
+    :param rollout_cache: RolloutCache of rollout returns, requires the
+        horizon to implement key (None, only used by non-batch rollouts)
+    :param widening: (k, alpha) progressive widening of observation
+        branches: an action node visited N times has at most k * N^alpha
+        children, other samples are routed to existing children with
+        probability proportional to their visits (None)
+    :param action_widening: (k, alpha) progressive widening of the actions
+        explored from observation nodes (None)
+    :param profile: gather a SearchProfile of the simulations in
+        self.profile (else None)
+    :param legal_actions: only select, at each node, the actions that are
+        legal in at least one state of its belief, and only use legal
+        actions in random rollouts (False, requires model.legal_actions)
+    :param prior: ActionPrior initializing the statistics of the actions of
+        new observation nodes (None)
+    :param successor_cache: SuccessorCache of the updates of array beliefs,
+        which may be shared with other trees and policy runners on the same
+        model (None)
+    :param rng: random source of the search and beliefs, np.random or a
+        BufferedRandom (None: the one of the model if any, else np.random)
+
+    When the budget is reached and pruning is disabled, simulations that
+    reach a new history use a rollout from the sampled state without adding
+    nodes. Nodes are always created by get_node.
+    """
+
+    # Estimated size of an observation node and its action node children,
+    # in bytes and without belief
+    NODE_BYTES = 400
+    ACTION_NODE_BYTES = 150
+
+    _shares_nodes = False  # Observation nodes may have several parents
 
     def __init__(self, model, horizon_generator, exploration,
                  relative_exploration=False, rollout_it=1, belief='array',
-                 belief_params={}, node_params={}, logger=None):
+                 belief_params={}, node_params={}, max_nodes=None,
+                 max_bytes=None, prune=False, batch_rollouts=False,
+                 rollout_policy=None, rollout_cache=None, widening=None,
+                 action_widening=None, profile=False, legal_actions=False,
+                 prior=None, successor_cache=None, rng=None, logger=None):
+        if legal_actions and not hasattr(model, 'legal_actions'):
+            raise ValueError('Legal actions require model.legal_actions')
+        if successor_cache is not None and belief != 'array':
+            raise ValueError('Successor caches require array beliefs')
+        self.successor_cache = successor_cache
+        self.rng = rng
+        self.legal_actions = legal_actions
         self._belief = belief
         self._belief_params = belief_params
         self.model = model
+        self.prior = prior  # used for root initialization
         self._node_params = node_params
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.pruning = prune
+        self.n_nodes = 0  # Number of observation nodes
+        self.n_bytes = 0  # Estimated memory footprint
+        self.n_pruned = 0  # Number of pruned observation nodes
         self.root = self._observation_node_for_belief(self._belief_start())
         self.horizon_gen = horizon_generator
+        self._horizon = (None, None)  # Reused (generator, horizon)
         self.exploration = exploration
         self.relative_explo = relative_exploration
         self.rollout_it = rollout_it
+        # Batch rollouts are only used if the model supports them
+        self.batch_rollouts = (batch_rollouts and
+                               hasattr(model, 'sample_transitions'))
+        self.rollout_policy = (
+            RandomRolloutPolicy(model, legal_actions=legal_actions,
+                                rng=self.rng)
+            if rollout_policy is None else rollout_policy)
+        self.rollout_cache = rollout_cache
+        self.widening = widening
+        self.action_widening = action_widening
+        self.profile = SearchProfile() if profile else None
         self.log = _null_logger if logger is None else logger
 
+    def _default_rng(self):
+        return getattr(self.model, 'rng', np.random)
+
     def _belief_start(self):
         if self._belief == 'array':
-            return ArrayBelief(self.model.start, **self._belief_params)
+            return ArrayBelief(self.model.start, rng=self.rng,
+                               **self._belief_params)
         elif self._belief == 'particle':
             return ParticleBelief(self.model.sample_start, self.model.n_states,
-                                  **self._belief_params)
+                                  rng=self.rng, **self._belief_params)
+        elif self._belief == 'sparse':
+            return SparseBelief.from_array(self.model.start, rng=self.rng)
         else:
             raise ValueError('Unknown belief type: ' + self._belief)
 
@@ -97,19 +510,27 @@ class _SearchTree:
             if isinstance(node, _SearchActionNode):  # h is an observation
                 if h not in node.children:
                     node.children[h] = self._observation_node_for_belief(
-                        last_belief.successor(self.model, history[i - 1], h))
+                        self._successor(last_belief, history[i - 1], h))
                 node = node.children[h]
             else:  # h is an action
                 last_belief = node.belief
                 node = node.safe_get_child(h)
         return node
 
-    def random_action(self):
-        return np.random.randint(self.model.n_actions)
+    def random_action(self, belief=None):
+        """Uniformly random action, among the legal actions of the belief if
+        given and legal actions are used.
+        """
+        if belief is not None and self.legal_actions:
+            return self.rng.choice(np.flatnonzero(
+                belief.legal_actions(self.model)))
+        return self.rng.randint(self.model.n_actions)
 
     def rollout_from_node(self, node, horizon):
         if horizon.is_reached():
             return 0
+        elif self.batch_rollouts:
+            return self.rollout_from_nodes([node], [horizon])[0]
         else:
             returns = 0.
             for _ in range(self.rollout_it):
@@ -119,41 +540,364 @@ class _SearchTree:
             node.update(returns)  # Only counts one visit
             return returns
 
+    def rollout_from_nodes(self, nodes, horizons):
+        """Runs rollout_it rollouts from each node (with the corresponding
+        horizon) in a single batch and updates the nodes with their average
+        returns.
+        """
+        states = [n.belief.sample() for n in nodes for _ in range(self.rollout_it)]
+        lanes_horizons = [h.copy() for h in horizons
+                          for _ in range(self.rollout_it)]
+        returns = self._batch_rollouts(states, lanes_horizons).reshape(
+            (len(nodes), self.rollout_it)).mean(-1)
+        for node, h, r in zip(nodes, horizons, returns):
+            if not h.is_reached():
+                node.update(float(r))  # Only counts one visit
+        return [float(r) for r in returns]
+
+    def _batch_rollouts(self, states, horizons):
+        """Advances one rollout per lane, each lane with its own initial
+        state and horizon, and returns the array of discounted returns.
+        """
+        states = np.array(states, dtype=np.int64)
+        gamma = np.ones(states.shape)
+        full_return = np.zeros(states.shape)
+        lanes = np.flatnonzero([not h.is_reached() for h in horizons])
+        steps = 0
+        while len(lanes) > 0:
+            steps += len(lanes)
+            a = self.rollout_policy.actions(states[lanes])
+            new_states, o, r = self.model.sample_transitions(a, states[lanes])
+            for i, l in enumerate(lanes):
+                horizons[l].decrement(a[i], states[l], new_states[i], o[i])
+            states[lanes] = new_states
+            full_return[lanes] += gamma[lanes] * r
+            gamma[lanes] *= self.model.discount
+            lanes = lanes[[not horizons[l].is_reached() for l in lanes]]
+        self._count_rollout_steps(steps)
+        return full_return
+
     def _one_rollout_from_node(self, state, horizon):
+        if self.rollout_cache is None:
+            return self._rollout(state, horizon)
+        key = (state, horizon.key())
+        full_return = self.rollout_cache.get(key)
+        if full_return is None:
+            full_return = self._rollout(state, horizon)
+            self.rollout_cache.add(key, full_return)
+        return full_return
+
+    def _rollout(self, state, horizon):
         gamma = 1.
         full_return = 0.
+        steps = 0
         while not horizon.is_reached():
-            a = self.random_action()
+            a = self.rollout_policy.action(state)
             new_state, o, r = self.model.sample_transition(a, state)
             horizon.decrement(a, state, new_state, o)
             state = new_state
             full_return += gamma * r
             gamma *= self.model.discount
+            steps += 1
+        self._count_rollout_steps(steps)
         return full_return
 
+    def _count_rollout_steps(self, steps):
+        if self.profile is not None:
+            self.profile.counts['rollout_steps'] += steps
+            self.profile.counts['simulator_calls'] += steps
+
+    def _successor(self, belief, a, o):
+        """Belief update of a new node, counting the simulator calls it
+        makes when profiling.
+        """
+        if self.successor_cache is not None:
+            return self.successor_cache.successor(self.model, belief, a, o)
+        if self.profile is None:
+            return belief.successor(self.model, a, o)
+        return belief.successor(
+            _CountingSimulator(self.model, self.profile.counts), a, o)
+
+    def _new_horizon(self):
+        """Returns a horizon in its initial state, reusing the one of the
+        previous simulation when the generator has not changed.
+        """
+        generator, horizon = self._horizon
+        if generator is self.horizon_gen:
+            try:
+                horizon.reset()
+                return horizon
+            except NotImplementedError:
+                pass
+        horizon = self.horizon_gen()
+        self._horizon = (self.horizon_gen, horizon)
+        return horizon
+
     def simulate_from_node(self, node, action=None):
-        state = node.belief.sample()
-        self._simulate_from_node(node, state, self.horizon_gen(), a=action)
+        if self.pruning and self.is_full():
+            self.prune(keep=node)
+        if self.profile is None:
+            state = node.belief.sample()
+            self._simulate_from_node(node, state, self._new_horizon(),
+                                     a=action)
+        else:
+            self._profiled_simulation(node.belief, node, action)
+
+    def _profiled_simulation(self, belief, node, action):
+        # node is the node, or its id, as used by _simulate_from_node
+        n_nodes = self.n_nodes
+        self.profile.start()
+        self._simulate_from_node(node, belief.sample(), self._new_horizon(),
+                                 a=action)
+        self.profile.counts['simulations'] += 1
+        self.profile.counts['new_nodes'] += self.n_nodes - n_nodes
+
+    def _node_nbytes(self, b):
+        return (self.NODE_BYTES + self.ACTION_NODE_BYTES * self.model.n_actions
+                + b.nbytes)
+
+    def _count_node(self, b, n=1):
+        self.n_nodes += n
+        self.n_bytes += n * self._node_nbytes(b)
+
+    def is_full(self):
+        return ((self.max_nodes is not None and
+                 self.n_nodes >= self.max_nodes) or
+                (self.max_bytes is not None and
+                 self.n_bytes >= self.max_bytes))
+
+    def _is_below(self, ratio):
+        return ((self.max_nodes is None or
+                 self.n_nodes < ratio * self.max_nodes) and
+                (self.max_bytes is None or
+                 self.n_bytes < ratio * self.max_bytes))
+
+    def prune(self, keep=None, ratio=.9):
+        """Removes least visited subtrees until the tree size is below
+        ratio times the budget. The root and the ancestors of keep are
+        never removed.
+        """
+        # Breadth first listing of observation nodes with their parents
+        nodes = [self.root]
+        parents = [None]  # (index of parent, action node, observation)
+        i = 0
+        while i < len(nodes):
+            for child in nodes[i]._iterate_children():
+                for o, c in child.children.items():
+                    nodes.append(c)
+                    parents.append((i, child, o))
+            i += 1
+        protected = set([0])
+        for i, n in enumerate(nodes):
+            if n is keep:
+                while i > 0:
+                    protected.add(i)
+                    i = parents[i][0]
+                break
+        removed = set()
+        for i in sorted(range(1, len(nodes)),
+                        key=lambda i: nodes[i].n_simulations):
+            if self._is_below(ratio):
+                break
+            if i in protected or id(nodes[i]) in removed:
+                continue
+            self._remove_subtree(nodes[i], removed)
+            _, parent, o = parents[i]
+            del parent.children[o]
+
+    def _remove_subtree(self, node, removed):
+        stack = [node]
+        while len(stack) > 0:
+            n = stack.pop()
+            removed.add(id(n))
+            self._count_node(n.belief, n=-1)
+            self.n_pruned += 1
+            for child in n._iterate_children():
+                stack.extend(child.children.values())
 
     def _observation_node_for_belief(self, b):
-        return _SearchObservationNode(b, self.model.n_actions, **self._node_params)
+        self._count_node(b)
+        node = _SearchObservationNode(b, self.model.n_actions,
+                                      **self._node_params)
+        self._init_with_prior(node)
+        return node
 
-    def _simulate_from_node(self, node, state, horizon, a=None):
-        if horizon.is_reached():
-            return node.value
+    def _init_with_prior(self, node):
+        if self.prior is None:
+            return
+        n = self.prior.n_visits
+        values = self.prior.values(node.belief)
+        for a in range(self.model.n_actions):
+            node.safe_get_child(a)
+        node._child_visits[:] = n
+        node._child_totals[:] = n * values
+        node._avg.n_simulations = n * self.model.n_actions
+        node._avg.total_value = n * values.sum()
+
+    def _iterate_observation_nodes(self):
+        visited = set([id(self.root)])
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            yield node
+            for child in node._iterate_children():
+                for c in child.children.values():
+                    if id(c) not in visited:
+                        visited.add(id(c))
+                        stack.append(c)
+
+    def _clear(self):
+        self.n_nodes = 0
+        self.n_bytes = 0
+
+    def _recount(self):
+        self._clear()
+        for n in self._iterate_observation_nodes():
+            self._count_node(n.belief)
+
+    def set_root(self, node):
+        """Makes node the new root, releasing all nodes that are not in
+        its subtree.
+        """
+        self.root = node
+        self._recount()
+
+    def save(self, f):
+        """Saves node statistics, children and beliefs to f (file or path)
+        as a compressed numpy archive.
+        """
+        if isinstance(f, str):
+            # Prevents numpy from adding the .npz extension to the path
+            with open(f, 'wb') as fd:
+                np.savez_compressed(fd, **self._to_arrays())
         else:
+            np.savez_compressed(f, **self._to_arrays())
+
+    def load(self, f):
+        """Replaces the tree by the one saved in f (file or path), which
+        must have been built for the same model. Trees saved from other tree
+        types can be loaded, except graphs with shared nodes (from belief
+        values) that can only be loaded with belief values.
+        """
+        data = np.load(f)
+        try:
+            arrays = {k: data[k] for k in data.files}
+        finally:
+            data.close()
+        if arrays['action_visits'].shape[1:] != (self.model.n_actions,):
+            raise ValueError('Saved tree does not match the number of actions')
+        children = arrays['edges'][:, 3]
+        if not self._shares_nodes and (
+                len(np.unique(children)) < len(children) or
+                (children == 0).any()):
+            raise ValueError('Saved tree has shared nodes')
+        self._from_arrays(arrays)
+
+    def _to_arrays(self):
+        # Observation nodes are indexed in iteration order (root first) and
+        # edges are (parent, action, observation, child)
+        nodes = list(self._iterate_observation_nodes())
+        index = {id(n): i for i, n in enumerate(nodes)}
+        edges = [(i, a, o, index[id(c)])
+                 for i, n in enumerate(nodes)
+                 for a, child in enumerate(n.children) if child is not None
+                 for o, c in child.children.items()]
+        arrays = {
+            'visits': np.array([n._avg.n_simulations for n in nodes],
+                               dtype=np.int64),
+            'totals': np.array([n._avg.total_value for n in nodes]),
+            'action_visits': np.array([n._child_visits for n in nodes]),
+            'action_totals': np.array([n._child_totals for n in nodes]),
+            'action_init': np.array([[c is not None for c in n.children]
+                                     for n in nodes]),
+            'edges': np.array(edges, dtype=np.int64).reshape((-1, 4)),
+        }
+        arrays.update(_beliefs_to_arrays([n.belief for n in nodes]))
+        return arrays
+
+    def _from_arrays(self, arrays):
+        nodes = [_SearchObservationNode(b, self.model.n_actions,
+                                        **self._node_params)
+                 for b in _beliefs_from_arrays(
+                     arrays, rng=self.rng, belief_params=self._belief_params)]
+        for i, node in enumerate(nodes):
+            node._avg.n_simulations = int(arrays['visits'][i])
+            node._avg.total_value = float(arrays['totals'][i])
+            for a in np.flatnonzero(arrays['action_init'][i]):
+                node.safe_get_child(a)
+            node._child_visits[:] = arrays['action_visits'][i]
+            node._child_totals[:] = arrays['action_totals'][i]
+        for p, a, o, c in arrays['edges'].tolist():
+            nodes[p].children[a].children[o] = nodes[c]
+        self.root = nodes[0]
+        self._recount()
+
+    def reset_root(self):
+        """Replaces the whole tree by a fresh root with initial belief."""
+        self._clear()
+        self.root = self._observation_node_for_belief(self._belief_start())
+
+    def _max_actions(self, n):
+        if self.action_widening is None:
+            return None
+        return _widening_limit(self.action_widening, n)
+
+    def _rng_kwargs(self):
+        # Only passes the random source to nodes if it is not the default
+        return {} if self.rng is np.random else {'rng': self.rng}
+
+    def _mask_kwargs(self, belief):
+        # Only passes the mask of legal actions to nodes if they are used
+        if not self.legal_actions:
+            return {}
+        return {'mask': belief.legal_actions(self.model)}
+
+    def _best_action(self, node):
+        kwargs = self._rng_kwargs()
+        kwargs.update(self._mask_kwargs(node.belief))
+        if self.action_widening is not None:
+            kwargs['max_children'] = self._max_actions(node.n_simulations)
+        return node.get_best_action(exploration=self.exploration,
+                                    relative_exploration=self.relative_explo,
+                                    **kwargs)
+
+    def _simulate_from_node(self, node, state, horizon, a=None):
+        # Descends iteratively, recording (action node, parent, reward) along
+        # the path, then backs the return up from the end of the path
+        profile = self.profile
+        path = []
+        while not horizon.is_reached():
             if a is None:
-                a = node.get_best_action(
-                    exploration=self.exploration,
-                    relative_exploration=self.relative_explo)
+                a = self._best_action(node)
             child = node.safe_get_child(a)
             new_s, o, r = self.model.sample_transition(a, state)
             horizon.decrement(a, state, new_s, o)
-            if o not in child.children:
+            path.append((child, node, r))
+            if (o not in child.children and self.widening is not None and
+                    len(child.children) >= _widening_limit(
+                        self.widening, child.n_simulations)):
+                # Progressive widening: continue from an existing child
+                keys = list(child.children)
+                o = _sample_existing(keys, [child.children[k].n_simulations
+                                            for k in keys], rng=self.rng)
+            if o in child.children:
+                # Continue regular search
+                node = child.children[o]
+                state = new_s
+                a = None
+                continue
+            if profile is not None:
+                profile.lap('selection')
+            if self.is_full():
+                # Do not expand the tree further
+                partial_return = self._one_rollout_from_node(new_s, horizon)
+            else:
                 try:
                     # Create node with updated belief
                     child.children[o] = self._observation_node_for_belief(
-                        node.belief.successor(self.model, a, o))
+                        self._successor(node.belief, a, o))
+                    if profile is not None:
+                        profile.lap('successor')
                     # Use rollout
                     partial_return = self.rollout_from_node(child.children[o],
                                                             horizon)
@@ -162,15 +906,26 @@ class _SearchTree:
                     partial_return = 0.
                     # Note maybe use more relevant value, but, since the event
                     # is rare, it should not impact the result
-            else:
-                # Continue regular search
-                partial_return = self._simulate_from_node(
-                    child.children[o], new_s, horizon)
-            full_return = r + self.model.discount * partial_return
-            child.update(full_return)
-            node.update(full_return)
+                    if profile is not None:
+                        profile.counts['max_samples_reached'] += 1
+                        profile.lap('successor')
+            if profile is not None:
+                profile.lap('rollout')
+            break
+        else:
+            partial_return = node.value
+            if profile is not None:
+                profile.lap('selection')
+        # Backup
+        for child, node, r in reversed(path):
+            partial_return = r + self.model.discount * partial_return
+            child.update(partial_return)
+            node.update(partial_return)
             # TODO belief update (not needed for exact belief)
-            return full_return
+        if profile is not None:
+            profile.counts['simulator_calls'] += len(path)
+            profile.lap('backup')
+        return partial_return
 
     def to_dict(self, as_policy=False):
         return self.root.to_dict(self.model, as_policy=as_policy)
@@ -184,26 +939,77 @@ class _SearchTree:
 
 
 class _ObservationLookupSearchTree(_SearchTree):
+    """
+    :param tolerance: share nodes between beliefs whose probabilities round
+        to the same multiples of tolerance, the node keeps the first of these
+        beliefs (None: only share nodes between equal array beliefs,
+        required for particle beliefs)
+    :param max_lookup: maximum number of beliefs in the table of shared
+        nodes, least recently used beliefs are forgotten first: their nodes
+        stay in the tree but are no longer shared with new histories (None)
+
+    Entries of nodes that are no longer reachable from the root (e.g. after
+    set_root, when the runner reroots the tree after each step) are removed
+    from the table.
+    """
 
-    def __init__(self, model, horizon, exploration,
-                 relative_exploration=False, belief='array', rollout_it=1,
-                 belief_params={}, node_params={}, logger=None):
-        self._obs_nodes = {}  # used in super for root initialization
-        if belief == 'particle':
+    _shares_nodes = True
+
+    def __init__(self, model, horizon, exploration, belief='array',
+                 belief_params={}, prune=False, tolerance=None,
+                 max_lookup=None, **kwargs):
+        self._obs_nodes = OrderedDict()  # used in super for root init
+        self.max_lookup = max_lookup
+        if belief == 'particle' and tolerance is None:
+            raise ValueError('_ObservationLookupSearchTree requires a '
+                             'tolerance for particle belief')
+        if prune:
             raise ValueError(
-                '_ObservationLookupSearchTree does not support particle belief')
+                '_ObservationLookupSearchTree does not support pruning')
+        self.tolerance = tolerance
         super(_ObservationLookupSearchTree, self).__init__(
-            model, horizon, exploration,
-            relative_exploration=relative_exploration,
-            belief=belief, rollout_it=rollout_it, belief_params={},
-            node_params=node_params, logger=logger)
+            model, horizon, exploration, belief=belief,
+            belief_params=belief_params if belief == 'particle' else {},
+            **kwargs)
+
+    def _belief_key(self, b):
+        return b if self.tolerance is None else b.signature(self.tolerance)
 
     def _observation_node_for_belief(self, b):
         # Returns node for given belief, creating one if none exists
-        if b not in self._obs_nodes:
-            self._obs_nodes[b] = _SearchObservationNode(
-                b, self.model.n_actions, **self._node_params)
-        return self._obs_nodes[b]
+        key = self._belief_key(b)
+        node = self._obs_nodes.pop(key, None)
+        if node is None:
+            self._count_node(b)
+            node = _SearchObservationNode(b, self.model.n_actions,
+                                          **self._node_params)
+            self._init_with_prior(node)
+        self._obs_nodes[key] = node  # Marks as recently used
+        self._bound_lookup()
+        return node
+
+    def _bound_lookup(self):
+        if self.max_lookup is not None:
+            while len(self._obs_nodes) > self.max_lookup:
+                self._obs_nodes.popitem(last=False)
+
+    def _clear(self):
+        super(_ObservationLookupSearchTree, self)._clear()
+        self._obs_nodes = OrderedDict()
+
+    def _recount(self):
+        # Only keeps the entries (in order of use) of reachable nodes
+        table = self._obs_nodes
+        super(_ObservationLookupSearchTree, self)._recount()
+        reachable = set(id(n) for n in self._iterate_observation_nodes())
+        self._obs_nodes = OrderedDict((k, n) for k, n in table.items()
+                                      if id(n) in reachable)
+
+    def _from_arrays(self, arrays):
+        super(_ObservationLookupSearchTree, self)._from_arrays(arrays)
+        for n in self._iterate_observation_nodes():
+            self._obs_nodes[self._belief_key(n.belief)] = n
+        self._bound_lookup()
 
     # Here we need to keep track of visited children since the tree is no more
     # a tree...
@@ -211,6 +1017,9 @@ class _ObservationLookupSearchTree(_SearchTree):
         return self.root.to_dict(self.model, as_policy=as_policy,
                                  exclude_visited=set())
 
+    def map(self, fun, join_children=_children_to_dict):
+        return self.root._map(fun, join_children, visited=set())
+
 
 class _ValueAverage(object):
 
@@ -231,6 +1040,34 @@ class _ValueAverage(object):
         self.n_simulations += 1
 
 
+class _ChildValueAverage(_ValueAverage):
+    """Value average stored in arrays of the parent node, at given index.
+    """
+
+    def __init__(self, visits, totals, i, alpha=0):
+        self._visits = visits
+        self._totals = totals
+        self._i = i
+        assert(0 <= alpha <= 1)
+        self.alpha = alpha
+
+    @property
+    def n_simulations(self):
+        return int(self._visits[self._i])
+
+    @n_simulations.setter
+    def n_simulations(self, n):
+        self._visits[self._i] = n
+
+    @property
+    def total_value(self):
+        return float(self._totals[self._i])
+
+    @total_value.setter
+    def total_value(self, v):
+        self._totals[self._i] = v
+
+
 class _SearchNode(object):
 
     def __init__(self, alpha=.001):
@@ -255,16 +1092,42 @@ class _SearchNode(object):
     def update(self, value):
         self._avg.update(value)
 
-    def to_dict(self, model, as_policy=False, exclude_visited=None,
-                recursive=True):
+    def to_dict(self, model, as_policy=False, observed=None,
+                exclude_visited=None, recursive=True):
+        """Dictionary of the subtree of the node, built iteratively (in
+        depth-first order) so that deep trees do not reach the recursion
+        limit.
+
+        :param exclude_visited: set of beliefs of the observation nodes
+            already exported, whose children are not exported again (None)
+        :param recursive: whether to export the children of the node
+        """
+        root, children = self._node_dict(
+            model, as_policy=as_policy, observed=observed,
+            exclude_visited=exclude_visited, recursive=recursive)
+        stack = [(c, o, root["children"]) for c, o in reversed(children)]
+        while len(stack) > 0:
+            node, observed, siblings = stack.pop()
+            d, children = node._node_dict(model, as_policy=as_policy,
+                                          observed=observed,
+                                          exclude_visited=exclude_visited)
+            siblings.append(d)
+            stack.extend((c, o, d["children"]) for c, o in reversed(children))
+        return root
+
+    def _node_dict(self, model, as_policy=False, observed=None,
+                   exclude_visited=None, recursive=True):
+        """Returns the dictionary of the node without its children and the
+        list of (child, observed) to append to its "children".
+        """
         return {"value": self.value,
                 "visits": self.n_simulations,
                 "node": None,
-                }
+                }, []
 
-    def _map(self, fun, join_children):
+    def _map(self, fun, join_children, visited=None):
         result = fun(self)
-        child_results = [c._map(fun, join_children)
+        child_results = [c._map(fun, join_children, visited=visited)
                          for c in self._iterate_children()]
         return join_children(result, child_results)
 
@@ -282,6 +1145,9 @@ class _SearchObservationNode(_SearchNode):
         self.belief = belief
         self.children = [None for _ in range(n_actions)]
         self._children_alpha = alpha
+        # Statistics of children, updated in place through their averages
+        self._child_visits = np.zeros((n_actions,), dtype=np.int64)
+        self._child_totals = np.zeros((n_actions,))
 
     def children_dict(self, model):
         return {model.actions[a]: c
@@ -291,8 +1157,7 @@ class _SearchObservationNode(_SearchNode):
         return [i for i, c in enumerate(self.children) if c is not None]
 
     def _not_init_children(self):
-        return [i for i, c in enumerate(self.children)
-                if c is None or c.n_simulations == 0]
+        return np.flatnonzero(self._child_visits == 0)
 
     def augmented_values(self, exploration=0, relative=False):
         # Note: nans are returned for not initialized children
@@ -305,78 +1170,92 @@ class _SearchObservationNode(_SearchNode):
                 if child is not None else np.nan
                 for child in self.children]
 
-    def get_best_action(self, exploration=0, relative_exploration=False):
-        not_init = self._not_init_children()
-        if len(not_init) == 0:
-            assert(self.n_simulations > 0)  # explored if children explored
-            # Augmented greedy (UCT)
-            a = np.argmax([self.augmented_values(
-                exploration=exploration, relative=relative_exploration)])
-        else:
-            # Chose an unexplored action
-            a = np.random.choice(not_init)
-        return a
+    def get_best_action(self, exploration=0, relative_exploration=False,
+                        max_children=None, exploit=False, mask=None,
+                        rng=np.random):
+        """
+        :param exploit: only consider explored actions, without exploration
+            (see _select_action)
+        :param mask: boolean array of the actions that can be selected
+            (None: all)
+        """
+        return _select_action(self._child_visits, self._child_totals,
+                              self.n_simulations, exploration=exploration,
+                              relative_exploration=relative_exploration,
+                              max_children=max_children, exploit=exploit,
+                              mask=mask, rng=rng)
 
     def safe_get_child(self, a):
         if self.children[a] is None:
-            self.children[a] = _SearchActionNode(alpha=self._children_alpha)
+            child = _SearchActionNode(alpha=self._children_alpha)
+            child._avg = _ChildValueAverage(
+                self._child_visits, self._child_totals, a,
+                alpha=self._children_alpha)
+            self.children[a] = child
         return self.children[a]
 
     def _iterate_children(self):
         return filter(lambda c: c is not None, self.children)
 
-    def to_dict(self, model, as_policy=False, observed=None,
-                exclude_visited=None, recursive=True):
-        children = recursive
+    def _map(self, fun, join_children, visited=None):
+        if visited is not None:
+            # Children of already visited nodes are not mapped again
+            if id(self) in visited:
+                return join_children(fun(self), [])
+            visited.add(id(self))
+        return super(_SearchObservationNode, self)._map(
+            fun, join_children, visited=visited)
+
+    def _policy_fields(self, model, a, observed=None):
+        return {
+            "action": model.actions[a],
+            "observed": observed,
+            "values": [v if not math.isnan(v) else None
+                       for v in self.augmented_values()],  # For json
+            "exploration_terms": [
+                np.sqrt(np.log(self.n_simulations) / child.n_simulations)
+                if ((child is not None) and child.n_simulations > 0)
+                else None
+                for child in self.children
+                ],
+            "child_visits": [c.n_simulations if c is not None else 0
+                             for c in self.children],
+            }
+
+    def _node_dict(self, model, as_policy=False, observed=None,
+                   exclude_visited=None, recursive=True):
+        expand = recursive
         if exclude_visited is not None:
             if self.belief in exclude_visited:
-                children = False
+                expand = False
             else:
                 exclude_visited.add(self.belief)
-        base = super(_SearchObservationNode, self).to_dict(
+        base, _ = super(_SearchObservationNode, self)._node_dict(
             model, as_policy=as_policy, exclude_visited=exclude_visited)
         base["belief"] = self.belief.to_list()
+        children = []
         if as_policy:
-            a = self.get_best_action()
+            a = self.get_best_action(exploit=True)
             grand_children = self.safe_get_child(a).children
-            base.update({
-                "action": model.actions[a],
-                "observed": observed,
-                "values": [v if not math.isnan(v) else None
-                           for v in self.augmented_values()],  # For json
-                "exploration_terms": [
-                    np.sqrt(np.log(self.n_simulations) / child.n_simulations)
-                    if ((child is not None) and child.n_simulations > 0)
-                    else None
-                    for child in self.children
-                    ],
-                "child_visits": [c.n_simulations if c is not None else 0
-                                 for c in self.children],
-                })
-            if children:
+            base.update(self._policy_fields(model, a, observed=observed))
+            if expand:
                 base.update({
                     "observations": [model.observations[o]
                                      for o in grand_children],
-                    "children": [
-                        grand_children[o].to_dict(
-                            model, as_policy=as_policy, observed=i,
-                            exclude_visited=exclude_visited)
-                        for i, o in enumerate(grand_children)],
+                    "children": [],
                     })
+                children = [(grand_children[o], i)
+                            for i, o in enumerate(grand_children)]
         else:
-            if children:
-                base.update({
-                    "actions": [model.actions[i]
-                                for i, c in enumerate(self.children)
-                                if c is not None],
-                    "children": [c.to_dict(model, as_policy=as_policy,
-                                           exclude_visited=exclude_visited)
-                                 for c in self.children if c is not None],
-                    })
+            if expand:
+                base["actions"] = [model.actions[i]
+                                   for i, c in enumerate(self.children)
+                                   if c is not None]
+                children = [(c, None) for c in self.children if c is not None]
             else:
-                base.update({'actions': [], 'children': []})
-
-        return base
+                base["actions"] = []
+            base["children"] = []
+        return base, children
 
 
 class _SearchActionNode(_SearchNode):
@@ -384,22 +1263,404 @@ class _SearchActionNode(_SearchNode):
     Children indexed by observation.
     """
 
-    def to_dict(self, model, as_policy=False, exclude_visited=None,
-                recursive=True):
+    def _node_dict(self, model, as_policy=False, observed=None,
+                   exclude_visited=None, recursive=True):
         if as_policy:
             raise NotImplemented
         else:
-            base = super(_SearchActionNode, self).to_dict(
+            base, _ = super(_SearchActionNode, self)._node_dict(
                 model, as_policy=as_policy, exclude_visited=exclude_visited)
+            children = self.children
             base.update({
-                "observations": [model.observations[o]
-                                 for o in self.children],
-                "children": [self.children[o].to_dict(
-                                model, as_policy=as_policy,
-                                exclude_visited=exclude_visited)
-                             for o in self.children],
+                "observations": [model.observations[o] for o in children],
+                "children": [],
                 })
-            return base
+            return base, [(children[o], None) for o in children]
+
+
+def _grow(array, size, fill=0):
+    """Returns a copy of array extended to the given size along first axis."""
+    new = np.full((size,) + array.shape[1:], fill, dtype=array.dtype)
+    new[:array.shape[0]] = array
+    return new
+
+
+class _ArrayObservationNode(_SearchObservationNode):
+    """View on an observation node of an _ArraySearchTree.
+    """
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.id = i
+
+    @property
+    def belief(self):
+        return self.tree._beliefs[self.id]
+
+    @property
+    def n_simulations(self):
+        return int(self.tree._visits[self.id])
+
+    @property
+    def value(self):
+        return self.tree._node_value(self.id)
+
+    def update(self, value):
+        self.tree._update_observation_node(self.id, value)
+
+    @property
+    def children(self):
+        first = self.id * self.tree.model.n_actions
+        return [_ArrayActionNode(self.tree, first + a)
+                if self.tree._a_init[first + a] else None
+                for a in range(self.tree.model.n_actions)]
+
+    def safe_get_child(self, a):
+        return _ArrayActionNode(self.tree, self.tree._action_id(self.id, a))
+
+    def get_best_action(self, exploration=0, relative_exploration=False,
+                        max_children=None, exploit=False, mask=None,
+                        rng=None):
+        # The random source of the tree is always used
+        return self.tree._get_best_action(
+            self.id, exploration=exploration,
+            relative_exploration=relative_exploration,
+            max_children=max_children, exploit=exploit, mask=mask)
+
+
+class _ArrayActionNode(_SearchActionNode):
+    """View on an action node of an _ArraySearchTree.
+    """
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.id = i
+
+    @property
+    def n_simulations(self):
+        return int(self.tree._a_visits[self.id])
+
+    @property
+    def value(self):
+        return self.tree._action_value(self.id)
+
+    def update(self, value):
+        self.tree._update_action_node(self.id, value)
+
+    @property
+    def children(self):
+        return {int(self.tree._keys[c]): _ArrayObservationNode(self.tree, c)
+                for c in self.tree._iterate_action_children(self.id)}
+
+
+class _ArraySearchTree(_SearchTree):
+    """Search tree that stores node statistics in flat growable arrays.
+
+    Observation nodes are addressed by integer ids. The action node for
+    action a of observation node i has id i * n_actions + a. Children of an
+    action node are stored as a linked list of observation nodes (first
+    child, next sibling) keyed by their observation. Public accessors
+    (root, get_node, map) return views that follow the interface of
+    _SearchObservationNode and _SearchActionNode.
+    """
+
+    def __init__(self, model, horizon_generator, exploration,
+                 node_params={}, prune=False, capacity=1024, **kwargs):
+        if prune:
+            raise ValueError('_ArraySearchTree does not support pruning')
+        self._alpha = node_params.get('alpha', .001)
+        assert(0 <= self._alpha <= 1)
+        self._capacity = capacity
+        self._init_arrays(capacity, model.n_actions)
+        super(_ArraySearchTree, self).__init__(
+            model, horizon_generator, exploration, node_params=node_params,
+            **kwargs)
+
+    def _init_arrays(self, capacity, n_actions):
+        self._beliefs = []
+        self._visits = np.zeros((capacity,), dtype=np.int64)
+        self._totals = np.zeros((capacity,))
+        self._keys = np.full((capacity,), -1, dtype=np.int64)
+        self._siblings = np.full((capacity,), -1, dtype=np.int64)
+        self._a_visits = np.zeros((capacity * n_actions,), dtype=np.int64)
+        self._a_totals = np.zeros((capacity * n_actions,))
+        self._a_init = np.zeros((capacity * n_actions,), dtype=bool)
+        self._a_children = np.full((capacity * n_actions,), -1, dtype=np.int64)
+
+    def _grow_arrays(self):
+        capacity = 2 * self._visits.shape[0]
+        n_a = capacity * self.model.n_actions
+        self._visits = _grow(self._visits, capacity)
+        self._totals = _grow(self._totals, capacity)
+        self._keys = _grow(self._keys, capacity, fill=-1)
+        self._siblings = _grow(self._siblings, capacity, fill=-1)
+        self._a_visits = _grow(self._a_visits, n_a)
+        self._a_totals = _grow(self._a_totals, n_a)
+        self._a_init = _grow(self._a_init, n_a)
+        self._a_children = _grow(self._a_children, n_a, fill=-1)
+
+    def _clear(self):
+        super(_ArraySearchTree, self)._clear()
+        self._init_arrays(self._capacity, self.model.n_actions)
+
+    def set_root(self, node):
+        # Compacts the subtree of node into new arrays
+        n_a = self.model.n_actions
+        order = [node.id]
+        i = 0
+        while i < len(order):
+            for a_id in range(order[i] * n_a, (order[i] + 1) * n_a):
+                order.extend(self._iterate_action_children(a_id))
+            i += 1
+        ids = np.array(order)
+        a_ids = (ids[:, np.newaxis] * n_a + np.arange(n_a)).ravel()
+        new_ids = np.full((self.n_nodes + 1,), -1, dtype=np.int64)
+        new_ids[ids] = np.arange(len(ids))  # new_ids[-1] stays -1
+        beliefs = [self._beliefs[i] for i in order]
+        self._visits = self._visits[ids]
+        self._totals = self._totals[ids]
+        self._keys = self._keys[ids]
+        self._siblings = new_ids[self._siblings[ids]]
+        self._keys[0] = -1  # New root has no parent
+        self._siblings[0] = -1
+        self._a_visits = self._a_visits[a_ids]
+        self._a_totals = self._a_totals[a_ids]
+        self._a_init = self._a_init[a_ids]
+        self._a_children = new_ids[self._a_children[a_ids]]
+        super(_ArraySearchTree, self)._clear()
+        self._beliefs = []
+        for b in beliefs:
+            self._add_node(b)
+        self._root = 0
+
+    def _to_arrays(self):
+        # The root is always node 0
+        n, n_a = self.n_nodes, self.model.n_actions
+        edges = [(a_id // n_a, a_id % n_a, self._keys[c], c)
+                 for a_id in np.flatnonzero(self._a_children[:n * n_a] >= 0)
+                 for c in self._iterate_action_children(a_id)]
+        arrays = {
+            'visits': self._visits[:n],
+            'totals': self._totals[:n],
+            'action_visits': self._a_visits[:n * n_a].reshape((n, n_a)),
+            'action_totals': self._a_totals[:n * n_a].reshape((n, n_a)),
+            'action_init': self._a_init[:n * n_a].reshape((n, n_a)),
+            'edges': np.array(edges, dtype=np.int64).reshape((-1, 4)),
+        }
+        arrays.update(_beliefs_to_arrays(self._beliefs))
+        return arrays
+
+    def _from_arrays(self, arrays):
+        self._clear()
+        for b in _beliefs_from_arrays(arrays, rng=self.rng,
+                                      belief_params=self._belief_params):
+            self._add_node(b)
+        n = self.n_nodes
+        self._visits[:n] = arrays['visits']
+        self._totals[:n] = arrays['totals']
+        self._a_visits[:arrays['action_visits'].size] = \
+            arrays['action_visits'].ravel()
+        self._a_totals[:arrays['action_totals'].size] = \
+            arrays['action_totals'].ravel()
+        self._a_init[:arrays['action_init'].size] = \
+            arrays['action_init'].ravel()
+        for p, a, o, c in arrays['edges'].tolist():
+            self._link_child(p * self.model.n_actions + a, o, c)
+        self._root = 0
+
+    @property
+    def root(self):
+        return _ArrayObservationNode(self, self._root)
+
+    @root.setter
+    def root(self, i):
+        self._root = i
+
+    def _node_nbytes(self, b):
+        # Array entries and belief list pointer
+        return 41 + 25 * self.model.n_actions + b.nbytes
+
+    def _observation_node_for_belief(self, b):
+        # Returns the id of a new node with given belief
+        i = self._add_node(b)
+        if self.prior is not None:
+            n, n_a = self.prior.n_visits, self.model.n_actions
+            values = self.prior.values(b)
+            self._a_init[i * n_a:(i + 1) * n_a] = True
+            self._a_visits[i * n_a:(i + 1) * n_a] = n
+            self._a_totals[i * n_a:(i + 1) * n_a] = n * values
+            self._visits[i] = n * n_a
+            self._totals[i] = n * values.sum()
+        return i
+
+    def _add_node(self, b):
+        # Returns the id of a new node with given belief and no statistics
+        if self.n_nodes >= self._visits.shape[0]:
+            self._grow_arrays()
+        i = self.n_nodes
+        self._count_node(b)
+        self._beliefs.append(b)
+        return i
+
+    def _action_id(self, i, a):
+        if not 0 <= a < self.model.n_actions:
+            raise IndexError('Invalid action: {}'.format(a))
+        a_id = i * self.model.n_actions + a
+        self._a_init[a_id] = True
+        return a_id
+
+    def _iterate_action_children(self, a_id):
+        c = self._a_children[a_id]
+        while c >= 0:
+            yield c
+            c = self._siblings[c]
+
+    def _get_child(self, a_id, o):
+        # Returns -1 if there is no child for this observation
+        c = self._a_children[a_id]
+        while c >= 0 and self._keys[c] != o:
+            c = self._siblings[c]
+        return c
+
+    def _add_child(self, a_id, o, b):
+        i = self._observation_node_for_belief(b)
+        self._link_child(a_id, o, i)
+        return i
+
+    def _link_child(self, a_id, o, i):
+        # Appends node i to the children of a_id, for observation o
+        self._keys[i] = o
+        last = self._a_children[a_id]
+        if last < 0:
+            self._a_children[a_id] = i
+        else:
+            while self._siblings[last] >= 0:
+                last = self._siblings[last]
+            self._siblings[last] = i
+
+    def _node_value(self, i):
+        n = self._visits[i]
+        return 0. if n == 0 else float(self._totals[i] / n)
+
+    def _action_value(self, a_id):
+        n = self._a_visits[a_id]
+        return 0. if n == 0 else float(self._a_totals[a_id] / n)
+
+    def _update_observation_node(self, i, value):
+        self._totals[i] = ((self._totals[i] + value) * (1 - self._alpha) +
+                           self._alpha * (self._visits[i] + 1) * value)
+        self._visits[i] += 1
+
+    def _update_action_node(self, a_id, value):
+        self._a_totals[a_id] = (
+            (self._a_totals[a_id] + value) * (1 - self._alpha) +
+            self._alpha * (self._a_visits[a_id] + 1) * value)
+        self._a_visits[a_id] += 1
+
+    def _get_best_action(self, i, exploration=0, relative_exploration=False,
+                         max_children=None, exploit=False, mask=None):
+        first = i * self.model.n_actions
+        return _select_action(
+            self._a_visits[first:first + self.model.n_actions],
+            self._a_totals[first:first + self.model.n_actions],
+            self._visits[i], exploration=exploration,
+            relative_exploration=relative_exploration,
+            max_children=max_children, exploit=exploit, mask=mask,
+            rng=self.rng)
+
+    def get_node(self, history):
+        """Raises ValueError if node does not exist or history is invalid."""
+        i = self._root
+        a_id = None
+        for j, h in enumerate(history):
+            if a_id is not None:  # h is an observation
+                c = self._get_child(a_id, h)
+                if c < 0:
+                    c = self._add_child(a_id, h, self._successor(
+                        self._beliefs[i], history[j - 1], h))
+                i = c
+                a_id = None
+            else:  # h is an action
+                a_id = self._action_id(i, h)
+        if a_id is None:
+            return _ArrayObservationNode(self, i)
+        else:
+            return _ArrayActionNode(self, a_id)
+
+    def simulate_from_node(self, node, action=None):
+        if self.profile is None:
+            state = node.belief.sample()
+            self._simulate_from_node(node.id, state, self._new_horizon(),
+                                     a=action)
+        else:
+            self._profiled_simulation(node.belief, node.id, action)
+
+    def _simulate_from_node(self, i, state, horizon, a=None):
+        # Same as _SearchTree._simulate_from_node on node and action ids
+        profile = self.profile
+        path = []
+        while not horizon.is_reached():
+            if a is None:
+                a = self._get_best_action(
+                    i, exploration=self.exploration,
+                    relative_exploration=self.relative_explo,
+                    max_children=self._max_actions(self._visits[i]),
+                    **self._mask_kwargs(self._beliefs[i]))
+            a_id = self._action_id(i, a)
+            new_s, o, r = self.model.sample_transition(a, state)
+            horizon.decrement(a, state, new_s, o)
+            path.append((a_id, i, r))
+            c = self._get_child(a_id, o)
+            if c < 0 and self.widening is not None:
+                children = list(self._iterate_action_children(a_id))
+                if len(children) >= _widening_limit(self.widening,
+                                                    self._a_visits[a_id]):
+                    # Progressive widening: continue from an existing child
+                    c = _sample_existing(children, self._visits[children],
+                                         rng=self.rng)
+            if c >= 0:
+                # Continue regular search
+                i = c
+                state = new_s
+                a = None
+                continue
+            if profile is not None:
+                profile.lap('selection')
+            if self.is_full():
+                # Do not expand the tree further
+                partial_return = self._one_rollout_from_node(new_s, horizon)
+            else:
+                try:
+                    # Create node with updated belief
+                    c = self._add_child(a_id, o, self._successor(
+                        self._beliefs[i], a, o))
+                    if profile is not None:
+                        profile.lap('successor')
+                    # Use rollout
+                    partial_return = self.rollout_from_node(
+                        _ArrayObservationNode(self, c), horizon)
+                except MaxSamplesReached:
+                    self.log('Maximum number of samples reached, skipping.')
+                    partial_return = 0.
+                    if profile is not None:
+                        profile.counts['max_samples_reached'] += 1
+                        profile.lap('successor')
+            if profile is not None:
+                profile.lap('rollout')
+            break
+        else:
+            partial_return = self._node_value(i)
+            if profile is not None:
+                profile.lap('selection')
+        # Backup
+        for a_id, i, r in reversed(path):
+            partial_return = r + self.model.discount * partial_return
+            self._update_action_node(a_id, partial_return)
+            self._update_observation_node(i, partial_return)
+        if profile is not None:
+            profile.counts['simulator_calls'] += len(path)
+            profile.lap('backup')
+        return partial_return
 
 
 class POMCPPolicyRunner(object):
@@ -409,18 +1670,49 @@ class POMCPPolicyRunner(object):
     :param iterations: number of simulation episodes to run
     :param exploration: UCT exploration parameter (c in [Silver2010])
     :param belief_values: group values for histories with same belief
+        (for particle beliefs, requires a tolerance in tree_params)
+    :param tree: 'nodes' | 'arrays' ('nodes')
+        Store the search tree as node objects or in flat arrays (more
+        compact for large trees, does not support belief_values).
+    :param tree_params: additional parameters for the search tree
+        (e.g. max_nodes, max_bytes, prune, widening)
+    :param reroot: after each step, make the reached node the root of the
+        search tree and release the rest of the tree (in that case reset
+        starts from a fresh tree)
+    :param rollout_policy: RolloutPolicy for rollouts (None for random
+        actions)
+    :param time_budget: if set, get_action runs simulations for this
+        duration (in seconds) instead of a fixed number of iterations
+    :param min_iterations: minimum number of simulations in time budget
+        mode (defaults to the number of actions)
+    :param profile: profile the search (see SearchProfile)
+    :param rng: random source of the search tree (see _SearchTree)
+
+    After get_action, last_iterations and last_elapsed give the number of
+    simulations that were run and their duration, and last_profile the
+    profile of these simulations as a dictionary (None if not profiling).
     """
 
     def __init__(self, model, particles=20, iterations=100, horizon=100,
                  exploration=None, relative_exploration=False, rollout_it=1,
                  belief_values=False, belief='array', belief_params={},
-                 logger=None):
+                 tree='nodes', tree_params={}, reroot=False,
+                 rollout_policy=None, time_budget=None, min_iterations=None,
+                 profile=False, rng=None, logger=None):
         if logger is None:
             from logging import warning as logger
         if exploration is None:
             exploration = 1. if relative_exploration else 100
-        tree_class = (_ObservationLookupSearchTree if belief_values
-                      else _SearchTree)
+        if tree == 'arrays':
+            if belief_values:
+                raise ValueError(
+                    'Array search tree does not support belief values')
+            tree_class = _ArraySearchTree
+        elif tree == 'nodes':
+            tree_class = (_ObservationLookupSearchTree if belief_values
+                          else _SearchTree)
+        else:
+            raise ValueError('Unknown tree type: ' + str(tree))
         if isinstance(horizon, Horizon._Generator):
             horizon_generator = horizon
         elif isinstance(horizon, Integral):
@@ -431,11 +1723,21 @@ class POMCPPolicyRunner(object):
                                relative_exploration=relative_exploration,
                                rollout_it=rollout_it, belief=belief,
                                belief_params=belief_params,
-                               logger=logger)
-        if iterations < model.n_actions:
+                               rollout_policy=rollout_policy,
+                               profile=profile, rng=rng, logger=logger,
+                               **tree_params)
+        if iterations < model.n_actions and self.tree.prior is None:
             logger('{} iterations is smaller than the number of actions'.format(
                 iterations))
         self.iterations = iterations
+        self.time_budget = time_budget
+        self.min_iterations = (model.n_actions if min_iterations is None
+                               else min_iterations)
+        self.last_iterations = 0
+        self.last_elapsed = 0.
+        self.last_profile = None
+        self.reroot = reroot
+        self.history = []
         self._reset()
 
     @property
@@ -455,6 +1757,8 @@ class POMCPPolicyRunner(object):
     def _reset(self, belief=None):
         if belief is not None:
             raise NotImplementedError
+        if self.reroot and len(self.history) > 0:
+            self.tree.reset_root()
         self.history = []
         self._node = self.tree.root
         self._last_action = None
@@ -463,18 +1767,60 @@ class POMCPPolicyRunner(object):
     def belief(self):
         return self._node.belief
 
-    def get_action(self, iterations=None):
+    def load_tree(self, f):
+        """Loads a search tree saved with tree.save and resets the runner
+        to its root.
+        """
+        self.tree.load(f)
+        self.history = []
+        self._reset()
+
+    def save_tree(self, f):
+        """Saves the search tree (see _SearchTree.save)."""
+        self.tree.save(f)
+
+    def get_action(self, iterations=None, time_budget=None):
+        """Runs the given number of iterations, or simulations for
+        time_budget seconds, before returning the best action. Defaults to
+        the runner's time budget if set, else to its iterations.
+        """
         # Note iterations must be greater than the number of actions
         # to guarantee that any action chosen as best_action is explored first
-        if iterations is None:
-            iterations = self.iterations
-        for _ in range(iterations):
-            self.tree.simulate_from_node(self._node)
-        a = self._node.get_best_action()
+        if self.tree.profile is not None:
+            self.tree.profile.reset()
+        start = _clock()
+        if time_budget is None and iterations is None:
+            time_budget = self.time_budget
+        if time_budget is not None:
+            self.last_iterations = self._simulate_until(start + time_budget)
+        else:
+            if iterations is None:
+                iterations = self.iterations
+            for _ in range(iterations):
+                self.tree.simulate_from_node(self._node)
+            self.last_iterations = iterations
+        self.last_elapsed = _clock() - start
+        if self.tree.profile is not None:
+            self.last_profile = self.tree.profile.to_dict()
+        kwargs = self.tree._rng_kwargs()
+        kwargs.update(self.tree._mask_kwargs(self._node.belief))
+        a = self._node.get_best_action(exploit=True, **kwargs)
         # No exploration during exploitation?
         self._last_action = a
         return self.actions[a]
 
+    def _simulate_until(self, deadline):
+        for _ in range(self.min_iterations):
+            self.tree.simulate_from_node(self._node)
+        n = self.min_iterations
+        # Reading the clock is negligible compared to a simulation, whose
+        # duration varies a lot (e.g. when sampling new beliefs), so the
+        # deadline is checked after each one
+        while _clock() < deadline:
+            self.tree.simulate_from_node(self._node)
+            n += 1
+        return n
+
     def step(self, observation):
         if self._last_action is None:
             raise ValueError('Unknown last action')
@@ -483,7 +1829,11 @@ class POMCPPolicyRunner(object):
         new_history = self.history + [self._last_action, o]
         # TODO: Eventually switch to random policy on failure to get or create
         # the node for the new history (would raise MaxSamplesReached)
-        self._node = self.tree.get_node(new_history)
+        if self.reroot:
+            self.tree.set_root(self.tree.get_node([self._last_action, o]))
+            self._node = self.tree.root
+        else:
+            self._node = self.tree.get_node(new_history)
         self.history = new_history  # updates only after get_node has succeeded
 
     def trajectory_trees_from_starts(self, qvalue=False):
@@ -517,32 +1867,64 @@ class POMCPPolicyRunner(object):
         logger("Total reward: %f" % R)
 
 
+def _get_action_after_exploration(runner, get_action, iterations=None,
+                                  time_budget=None):
+    # By default, only runs the iterations not already run in background
+    if (iterations is None and time_budget is None and
+            runner.time_budget is None):
+        iterations = max(0, runner.iterations - runner._node.n_simulations)
+    return get_action(iterations=iterations, time_budget=time_budget)
+
+
 class AsyncPOMCPPolicyRunner(POMCPPolicyRunner):
+    """Runner that keeps exploring from the current node in background.
+    get_action only runs the iterations that were not already run in
+    background (unless iterations or a time budget are given).
+
+    :param batch_size: number of background simulations between two checks
+        for pending operations (10)
+    :param process: run the search in a separate process that builds and
+        owns the search tree and receives get_action, step, reset, load_tree
+        and save_tree (from paths) through a queue (False). The runner then
+        has no tree (its tree is None).
+    """
 
     class _Thread(threading.Thread):
-        """Continuously explores and enable another thread to execute
-        some exploitation in between two explorations.
+        """Continuously explores by batches and enables other threads to
+        execute operations on the tree in between two batches.
         """
 
-        def __init__(self, tree):
+        def __init__(self, tree, batch_size=10):
             super(AsyncPOMCPPolicyRunner._Thread, self).__init__()
+            self.daemon = True
             self.tree = tree
+            self.batch_size = batch_size
             self._node = tree.root
             self._action = None
             self._done = False
-            self._lock = threading.Lock()
+            self._pending = 0  # Number of operations waiting for the tree
+            self._pending_lock = threading.Lock()
+            self._cond = threading.Condition()
 
-        def _stop(self):
+        # Note: _stop would override a method of threading.Thread
+        def _set_done(self):
             self._done = True
 
         def stop(self):
-            self.execute(self._stop)
+            self.execute(self._set_done)
 
         def execute(self, fun, *args, **kwargs):
-            """Waits until current exploration is done and execute fun.
+            """Waits until current batch is done and execute fun.
             """
-            with self._lock:
-                return fun(*args, **kwargs)
+            with self._pending_lock:
+                self._pending += 1
+            with self._cond:
+                try:
+                    return fun(*args, **kwargs)
+                finally:
+                    with self._pending_lock:
+                        self._pending -= 1
+                    self._cond.notify_all()
 
         def set_node(self, node):
             self._node = node
@@ -552,88 +1934,676 @@ class AsyncPOMCPPolicyRunner(POMCPPolicyRunner):
             self._action = action
 
         def explore(self):
-            self.tree.simulate_from_node(self._node, action=self._action)
+            for _ in range(self.batch_size):
+                self.tree.simulate_from_node(self._node, action=self._action)
 
         def run(self):
-            done = False
-            while not done:
-                with self._lock:
+            while True:
+                with self._cond:
+                    while self._pending > 0 and not self._done:
+                        self._cond.wait()
+                    if self._done:
+                        return
                     self.explore()
-                    done = self._done
-                time.sleep(.01)
+
+    class _Process(multiprocessing.Process):
+        """Continuously explores with its own runner, built from the given
+        arguments of POMCPPolicyRunner, and executes the operations received
+        through a queue in between two batches.
+        """
+
+        def __init__(self, args, kwargs, batch_size=10):
+            super(AsyncPOMCPPolicyRunner._Process, self).__init__()
+            self.daemon = True
+            self.args = args
+            self.kwargs = kwargs
+            self.batch_size = batch_size
+            self.requests = multiprocessing.Queue()
+            self.results = multiprocessing.Queue()
+
+        def wait_started(self):
+            """Waits until the runner is built, raising its errors."""
+            result = self.results.get()
+            if isinstance(result, Exception):
+                self.join()
+                raise result
+
+        def execute(self, name, *args):
+            """Sends operation to the search process and waits for its
+            result.
+            """
+            self.requests.put((name, args))
+            result = self.results.get()
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        def stop(self):
+            self.execute('stop')
+
+        def _execute(self, name, args):
+            runner = self.runner
+            if name == 'get_action':
+                a = _get_action_after_exploration(runner, runner.get_action,
+                                                  *args)
+                self._action = runner._last_action
+                return (a, runner.last_iterations, runner.last_elapsed,
+                        runner.last_profile)
+            elif name == 'step':
+                runner.step(*args)
+                self._action = None
+            elif name == 'reset':
+                runner.reset()
+                self._action = None
+            elif name == 'belief':
+                return runner.belief
+            elif name == 'load_tree':
+                runner.load_tree(*args)
+                self._action = None
+            elif name == 'save_tree':
+                runner.save_tree(*args)
+            else:
+                raise ValueError('Unknown operation: ' + str(name))
+
+        def run(self):
+            try:
+                self.runner = POMCPPolicyRunner(*self.args, **self.kwargs)
+            except Exception as e:
+                self.results.put(e)
+                return
+            self.results.put(None)
+            runner = self.runner
+            self._action = None
+            while True:
+                try:
+                    name, args = self.requests.get(block=False)
+                except queue.Empty:
+                    for _ in range(self.batch_size):
+                        runner.tree.simulate_from_node(runner._node,
+                                                       action=self._action)
+                    continue
+                if name == 'stop':
+                    self.results.put(None)
+                    return
+                try:
+                    result = self._execute(name, args)
+                except Exception as e:
+                    result = e
+                self.results.put(result)
 
     def __init__(self, *args, **kwargs):
-        super(AsyncPOMCPPolicyRunner, self).__init__(*args, **kwargs)
-        self.thread = self._Thread(self.tree)
-        self.thread.start()
+        batch_size = kwargs.pop('batch_size', 10)
+        process = kwargs.pop('process', False)
+        self.thread = None
+        self.process = None
+        if process:
+            # Only the state used to forward operations is kept here
+            self._model = args[0] if len(args) > 0 else kwargs['model']
+            self.tree = None
+            self.history = []
+            self._last_action = None
+            self.last_iterations = 0
+            self.last_elapsed = 0.
+            self.last_profile = None
+            process = self._Process(args, kwargs, batch_size=batch_size)
+            process.start()
+            process.wait_started()
+            self.process = process
+        else:
+            super(AsyncPOMCPPolicyRunner, self).__init__(*args, **kwargs)
+            self._model = self.tree.model
+            self.thread = self._Thread(self.tree, batch_size=batch_size)
+            self.thread.start()
 
-    def step(self, observation):
+    @property
+    def actions(self):
+        return self._model.actions
+
+    @property
+    def observations(self):
+        return self._model.observations
+
+    @property
+    def belief(self):
+        if self.process is not None:
+            return self.process.execute('belief')
+        return super(AsyncPOMCPPolicyRunner, self).belief
+
+    # Operations on the tree and the update of the node explored in
+    # background are executed together so that no batch runs in between
+
+    def _step_and_set_node(self, observation):
         super(AsyncPOMCPPolicyRunner, self).step(observation)
-        self.thread.execute(self.thread.set_node, self._node)
+        self.thread.set_node(self._node)
 
-    def reset(self, belief=None):
+    def _reset_and_set_node(self, belief=None):
         self._reset(belief=belief)
-        self.thread.execute(self.thread.set_node, self._node)
+        self.thread.set_node(self._node)
 
-    def get_action(self, iterations=None):
-        # Start with minimal number of iterations to have explored all actions
-        a = self.thread.execute(super(AsyncPOMCPPolicyRunner, self).get_action)
-        self.thread.execute(self.thread.set_action, self._last_action)
+    def _load_tree_and_set_node(self, f):
+        super(AsyncPOMCPPolicyRunner, self).load_tree(f)
+        self.thread.set_node(self._node)
+
+    def _get_action_and_set_action(self, iterations=None, time_budget=None):
+        a = _get_action_after_exploration(
+            self, super(AsyncPOMCPPolicyRunner, self).get_action,
+            iterations=iterations, time_budget=time_budget)
+        self.thread.set_action(self._last_action)
         return a
 
+    def step(self, observation):
+        if self.process is not None:
+            self.process.execute('step', observation)
+            o = self.observations.index(observation)
+            self.history = self.history + [self._last_action, o]
+        else:
+            self.thread.execute(self._step_and_set_node, observation)
+
+    def reset(self, belief=None):
+        if self.process is not None:
+            if belief is not None:
+                raise NotImplementedError
+            self.process.execute('reset')
+            self.history = []
+            self._last_action = None
+        else:
+            self.thread.execute(self._reset_and_set_node, belief=belief)
+
+    def load_tree(self, f):
+        if self.process is not None:
+            self._check_path(f)
+            self.process.execute('load_tree', f)
+            self.history = []
+            self._last_action = None
+        else:
+            self.thread.execute(self._load_tree_and_set_node, f)
+
+    def save_tree(self, f):
+        if self.process is not None:
+            self._check_path(f)
+            self.process.execute('save_tree', f)
+        else:
+            self.thread.execute(super(AsyncPOMCPPolicyRunner, self).save_tree,
+                                f)
+
+    @staticmethod
+    def _check_path(f):
+        if not isinstance(f, str):
+            raise ValueError('Trees of a search process can only be saved '
+                             'to or loaded from paths')
+
+    def get_action(self, iterations=None, time_budget=None):
+        if self.process is not None:
+            (a, self.last_iterations, self.last_elapsed,
+             self.last_profile) = self.process.execute(
+                'get_action', iterations, time_budget)
+            self._last_action = self.actions.index(a)
+            return a
+        return self.thread.execute(self._get_action_and_set_action,
+                                   iterations=iterations,
+                                   time_budget=time_budget)
+
     def stop(self):
-        self.thread.stop()
-        if self.thread.isAlive():
-            self.thread.join()
+        worker = self.thread if self.process is None else self.process
+        if worker is not None and worker.is_alive():
+            worker.stop()
+            worker.join()
 
     def execute(self, *args, **kwargs):
-        self.thread.execute(*args, **kwargs)
+        if self.process is not None:
+            raise ValueError('Can not execute functions in search process')
+        return self.thread.execute(*args, **kwargs)
 
     def __del__(self):
         self.stop()
 
 
-def export_pomcp(policy, destination, belief_as_quotient=False):
+class SharedSearchTree(object):
+    """Search tree shared by several sessions (SharedTreeRunner), each with
+    its own history, that can run simulations concurrently from different
+    threads. Statistics gathered for one session benefit every session that
+    reaches the same nodes.
+
+    Each observation node has its own lock, held while an action is
+    selected from it, while its children are read or added, and while its
+    statistics and the ones of its actions are updated. Belief updates and
+    rollouts run without locks. Counting nodes and looking up shared nodes
+    is done under a lock of the tree.
+
+    The tree must be built with nodes (not arrays), without pruning,
+    profiling, batch rollouts or rollout cache, and its random source must
+    be thread-safe (np.random).
+
+    :param tree: search tree (e.g. from POMCPPolicyRunner(...).tree)
+    """
+
+    def __init__(self, tree):
+        if isinstance(tree, _ArraySearchTree):
+            raise ValueError('Array search trees can not be shared')
+        if (tree.pruning or tree.profile is not None or tree.batch_rollouts
+                or tree.rollout_cache is not None):
+            raise ValueError('Shared trees do not support pruning, '
+                             'profiling, batch rollouts and rollout caches')
+        self.tree = tree
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.tree.model
+
+    @property
+    def root(self):
+        return self.tree.root
+
+    def node_lock(self, node):
+        lock = getattr(node, '_lock', None)
+        if lock is None:
+            with self._lock:
+                if getattr(node, '_lock', None) is None:
+                    node._lock = threading.Lock()
+                lock = node._lock
+        return lock
+
+    def _new_node(self, node, a, o):
+        # The belief update runs without lock
+        belief = self.tree._successor(node.belief, a, o)
+        with self._lock:
+            if self.tree.is_full():
+                return None
+            return self.tree._observation_node_for_belief(belief)
+
+    def child(self, node, a, o, create=True):
+        """Child of node for action a and observation o, created if needed
+        (None if it does not exist and can not be created). Raises
+        MaxSamplesReached if the belief update fails.
+        """
+        with self.node_lock(node):
+            child = node.safe_get_child(a).children.get(o)
+        if child is None and create:
+            new = self._new_node(node, a, o)
+            if new is not None:
+                with self.node_lock(node):
+                    # Keeps the node added concurrently, if any
+                    child = node.children[a].children.setdefault(o, new)
+                if child is not new and not self.tree._shares_nodes:
+                    with self._lock:
+                        self.tree._count_node(new.belief, n=-1)
+        return child
+
+    def get_node(self, history):
+        """Observation node for the history (of action and observation
+        indices), created if needed.
+        """
+        node = self.root
+        for a, o in zip(history[::2], history[1::2]):
+            node = self.child(node, a, o)
+            if node is None:
+                raise ValueError('Search tree is full')
+        return node
+
+    def best_action(self, node):
+        """Explored action of best value from node."""
+        tree = self.tree
+        kwargs = tree._rng_kwargs()
+        kwargs.update(tree._mask_kwargs(node.belief))
+        with self.node_lock(node):
+            return node.get_best_action(exploit=True, **kwargs)
+
+    def simulate_from_node(self, node):
+        tree = self.tree
+        state = node.belief.sample()
+        horizon = tree.horizon_gen()  # Horizons are not shared
+        path = []
+        partial_return = None
+        while not horizon.is_reached():
+            with self.node_lock(node):
+                a = tree._best_action(node)
+                action_node = node.safe_get_child(a)
+            new_s, o, r = tree.model.sample_transition(a, state)
+            horizon.decrement(a, state, new_s, o)
+            path.append((action_node, node, r))
+            with self.node_lock(node):
+                children = action_node.children
+                if (o not in children and tree.widening is not None and
+                        len(children) >= _widening_limit(
+                            tree.widening, action_node.n_simulations)):
+                    keys = list(children)
+                    o = _sample_existing(keys, [children[k].n_simulations
+                                                for k in keys], rng=tree.rng)
+                child = children.get(o)
+            if child is not None:
+                node = child
+                state = new_s
+                continue
+            try:
+                child = self.child(node, a, o)
+            except MaxSamplesReached:
+                tree.log('Maximum number of samples reached, skipping.')
+                partial_return = 0.
+                break
+            if child is None:  # The tree is full
+                partial_return = tree._one_rollout_from_node(new_s, horizon)
+            else:
+                partial_return = self._rollout_from_node(child, horizon)
+            break
+        if partial_return is None:
+            with self.node_lock(node):
+                partial_return = node.value
+        for action_node, node, r in reversed(path):
+            partial_return = r + tree.model.discount * partial_return
+            with self.node_lock(node):
+                action_node.update(partial_return)
+                node.update(partial_return)
+        return partial_return
+
+    def _rollout_from_node(self, node, horizon):
+        tree = self.tree
+        if horizon.is_reached():
+            return 0
+        returns = 0.
+        for _ in range(tree.rollout_it):
+            returns += tree._one_rollout_from_node(node.belief.sample(),
+                                                   horizon.copy())
+        returns /= tree.rollout_it
+        with self.node_lock(node):
+            node.update(returns)
+        return returns
+
+
+class SharedTreeRunner(object):
+    """Session on a SharedSearchTree, with the interface of
+    POMCPPolicyRunner (get_action, step, reset). Several sessions can be
+    used from different threads.
+
+    :param iterations: number of simulations run by get_action
+    """
+
+    def __init__(self, shared, iterations=100):
+        self.shared = shared
+        self.iterations = iterations
+        self.last_iterations = 0
+        self.last_elapsed = 0.
+        self.reset()
+
+    @property
+    def actions(self):
+        return self.shared.model.actions
+
+    @property
+    def observations(self):
+        return self.shared.model.observations
+
+    @property
+    def belief(self):
+        return self._node.belief
+
+    def reset(self, belief=None):
+        if belief is not None:
+            raise NotImplementedError
+        self.history = []
+        self._node = self.shared.root
+        self._last_action = None
+
+    def get_action(self, iterations=None):
+        if iterations is None:
+            iterations = self.iterations
+        start = _clock()
+        for _ in range(iterations):
+            self.shared.simulate_from_node(self._node)
+        self.last_iterations = iterations
+        self.last_elapsed = _clock() - start
+        self._last_action = self.shared.best_action(self._node)
+        return self.actions[self._last_action]
+
+    def step(self, observation):
+        if self._last_action is None:
+            raise ValueError('Unknown last action')
+        o = self.observations.index(observation)
+        node = self.shared.child(self._node, self._last_action, o)
+        if node is None:
+            raise ValueError('Search tree is full')
+        self._node = node
+        self.history = self.history + [self._last_action, o]
+        self._last_action = None
+
+
+class TreePolicy(object):
+    """Policy compiled from a search tree (see compile_policy): the action
+    of each node and the node that follows each observation. Node 0 is the
+    initial node. Histories that were not compiled lead to the last node,
+    which always takes the fallback action.
+
+    :param actions: action names
+    :param observations: observation names
+    :param action_table: array of the action index of each node
+    :param transitions: array of the next node for each node and
+        observation index
+    """
+
+    def __init__(self, actions, observations, action_table, transitions):
+        self.actions = list(actions)
+        self.observations = list(observations)
+        self.action_table = np.asarray(action_table, dtype=np.int64)
+        self.transitions = np.asarray(transitions, dtype=np.int64)
+        assert(self.transitions.shape ==
+               (self.n_nodes, len(self.observations)))
+
+    @property
+    def n_nodes(self):
+        return len(self.action_table)
+
+    @property
+    def fallback(self):
+        return self.n_nodes - 1
+
+    def to_graph_policy(self):
+        """Equivalent GraphPolicy (which can not be reset from a belief)."""
+        return GraphPolicy([self.actions[a] for a in self.action_table],
+                           self.observations, self.transitions, None, init=0)
+
+    def save(self, f):
+        """Saves the policy to f (file or path) as a numpy archive."""
+        arrays = {'action_table': self.action_table,
+                  'transitions': self.transitions,
+                  'names': np.array(json.dumps([self.actions,
+                                                self.observations]))}
+        if isinstance(f, str):
+            # Prevents numpy from adding the .npz extension to the path
+            with open(f, 'wb') as fd:
+                np.savez_compressed(fd, **arrays)
+        else:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, f):
+        data = np.load(f)
+        try:
+            actions, observations = json.loads(str(data['names']))
+            return cls(actions, observations, data['action_table'],
+                       data['transitions'])
+        finally:
+            data.close()
+
+
+def compile_policy(tree, max_depth=None, min_visits=1, fallback_action=None):
+    """Compiles the best actions of the search tree into a TreePolicy.
+
+    :param max_depth: observation nodes deeper than max_depth are not
+        compiled (None)
+    :param min_visits: observation nodes with less visits are not compiled
+    :param fallback_action: action index for histories that are not
+        compiled (None: the most frequent action of compiled nodes)
+    """
+    model = tree.model
+    n_observations = len(model.observations)
+    nodes = [tree.root]
+    index = {id(tree.root): 0}  # Shared nodes are only compiled once
+    depths = [0]
+    actions = []
+    edges = []  # (node, observation, child)
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        a = node.get_best_action(exploit=True)
+        actions.append(a)
+        if ((max_depth is None or depths[i] < max_depth) and
+                node.children[a] is not None):
+            for o, c in node.children[a].children.items():
+                if c.n_simulations < min_visits:
+                    continue
+                key = id(c) if tree._shares_nodes else (i, o)
+                if key not in index:
+                    index[key] = len(nodes)
+                    nodes.append(c)
+                    depths.append(depths[i] + 1)
+                edges.append((i, o, index[key]))
+        i += 1
+    if fallback_action is None:
+        fallback_action = np.bincount(actions).argmax()
+    fallback = len(nodes)
+    transitions = np.full((fallback + 1, n_observations), fallback,
+                          dtype=np.int64)
+    for i, o, c in edges:
+        transitions[i, o] = c
+    return TreePolicy(model.actions, model.observations,
+                      actions + [fallback_action], transitions)
+
+
+class TreePolicyRunner(object):
+    """Runs a TreePolicy, with the interface of POMCPPolicyRunner, without
+    any search.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self._observation_ids = {o: i
+                                 for i, o in enumerate(policy.observations)}
+        self.reset()
+
+    @property
+    def actions(self):
+        return self.policy.actions
+
+    @property
+    def observations(self):
+        return self.policy.observations
+
+    @property
+    def is_fallback(self):
+        """Whether the history was not compiled."""
+        return self.current == self.policy.fallback
+
+    def reset(self, belief=None):
+        if belief is not None:
+            raise NotImplementedError
+        self.history = []
+        self.current = 0
+        self._last_action = None
+
+    def get_action(self):
+        self._last_action = self.policy.action_table[self.current]
+        return self.policy.actions[self._last_action]
+
+    def step(self, observation):
+        if self._last_action is None:
+            raise ValueError('Unknown last action')
+        o = self._observation_ids[observation]
+        self.current = self.policy.transitions[self.current, o]
+        self.history = self.history + [self._last_action, o]
+        self._last_action = None
+
+
+def _write_policy_tree(f, tree, belief_to_list, observed_as_index=True,
+                       max_depth=None, min_visits=0):
+    """Iteratively writes to f the JSON of the policy tree from the root
+    (in the format of to_dict with as_policy): each observation node has the
+    observation nodes that follow its best action as children.
+
+    :param belief_to_list: function(belief) returning the exported belief
+    :param observed_as_index: whether children are marked with their index
+        among observations of their parent or with the observation
+    :param max_depth: observation nodes deeper than max_depth are not
+        exported (None)
+    :param min_visits: observation nodes with less visits are not exported
+    """
+    model = tree.model
+
+    def dumps(x):
+        return json.dumps(x, cls=NPEncoder)
+
+    # Shared nodes are only expanded once
+    visited = set() if tree._shares_nodes else None
+    stack = [(tree.root, None, 0)]  # Nodes to write and closing strings
+    while len(stack) > 0:
+        item = stack.pop()
+        if not isinstance(item, tuple):
+            f.write(item)
+            continue
+        node, observed, depth = item
+        a = node.get_best_action(exploit=True)
+        fields = [("value", node.value), ("visits", node.n_simulations),
+                  ("node", None), ("belief", belief_to_list(node.belief))]
+        fields.extend(node._policy_fields(model, a, observed=observed).items())
+        f.write("{" + ", ".join(["{}: {}".format(dumps(k), dumps(v))
+                                 for k, v in fields]))
+        if visited is not None:
+            if id(node) in visited:
+                # Like to_dict, children of shared nodes are only written once
+                f.write("}")
+                continue
+            visited.add(id(node))
+        children = []
+        expand = max_depth is None or depth < max_depth
+        if expand and node.children[a] is not None:
+            children = [(o, c) for o, c in node.children[a].children.items()
+                        if c.n_simulations >= min_visits]
+        f.write(', "observations": {}, "children": ['.format(
+            dumps([model.observations[o] for o, _ in children])))
+        stack.append("]}")
+        for i in reversed(range(len(children))):
+            o, c = children[i]
+            stack.append((c, i if observed_as_index else o, depth + 1))
+            if i > 0:
+                stack.append(", ")
+
+
+def export_pomcp(policy, destination, belief_as_quotient=False,
+                 max_depth=None, min_visits=0):
+    """Writes the policy tree of the runner in JSON to destination (text
+    file or path), incrementally.
+
+    :param belief_as_quotient: export beliefs as quotient on HTM states (for
+        SupportivePOMDP)
+    :param max_depth: only export observation nodes up to this depth (None)
+    :param min_visits: only export observation nodes with at least this
+        number of visits
+    """
     model = policy.tree.model
     if belief_as_quotient:
-        dic = {}
-        FLAG = '####'
-
-        def to_dict(node):
-            if isinstance(node, _SearchObservationNode):
-                d = node.to_dict(model, as_policy=True, recursive=False)
-                d['belief'] = list(model._int_to_state().belief_quotient(
-                    np.array(d['belief'])))
-                a_i = model.actions.index(d['action'])
-                d['ACTION_IDX'] = sum([c is not None
-                                       for c in node.children[:a_i]])
-            else:
-                d = {"observations": [model.observations[o]
-                                      for o in node.children]}
-                d[FLAG] = True
-            return d
-
-        def join_children(d, children):
-            if d.get(FLAG, False):  # Action node
-                d.pop(FLAG)
-                d['children'] = children
-            else:  # Observation node
-                i = d.pop('ACTION_IDX')
-                child = children[i]
-                d['observations'] = child['observations']
-                d['children'] = child['children']
-                for c, o in zip(d['children'], d['observations']):
-                    c['observed'] = model.observations.index(o)
-            return d
-
-        dic['graphs'] = [policy.tree.map(to_dict, join_children)]
-        dic['states'] = model.htm_names
+        quotient = model._int_to_state().belief_quotient
+
+        def belief_to_list(b):
+            return list(quotient(b.array))
+
+        states = model.htm_names
     else:
-        dic = policy.trajectory_trees_from_starts()
-        dic['states'] = model.states
-    dic['actions'] = model.actions
-    dic['exploration'] = policy.tree.exploration
-    dic['relative_exploration'] = policy.tree.relative_explo
-
-    with open(destination, 'w') as f:
-        json.dump(dic, f, indent=2)
+        def belief_to_list(b):
+            return b.to_list()
+
+        states = model.states
+    if isinstance(destination, str):
+        with open(destination, 'w') as f:
+            export_pomcp(policy, f, belief_as_quotient=belief_as_quotient,
+                         max_depth=max_depth, min_visits=min_visits)
+        return
+    f = destination
+    f.write('{"graphs": [')
+    _write_policy_tree(f, policy.tree, belief_to_list,
+                       observed_as_index=not belief_as_quotient,
+                       max_depth=max_depth, min_visits=min_visits)
+    f.write(']')
+    for k, v in [('states', states), ('actions', model.actions),
+                 ('exploration', policy.tree.exploration),
+                 ('relative_exploration', policy.tree.relative_explo)]:
+        f.write(', {}: {}'.format(json.dumps(k), json.dumps(v, cls=NPEncoder)))
+    f.write('}')
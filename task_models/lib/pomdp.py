@@ -8,7 +8,7 @@ from distutils import spawn
 import numpy as np
 
 from .py23 import TemporaryDirectory, Queue
-from .utils import assert_normal
+from .utils import assert_normal, RandomSource
 
 SOLVER_NAME = 'pomdp-solve'
 
@@ -126,7 +126,15 @@ def _dump_4d_array(a, name, xs, ys):
         ])
 
 
-class POMDP:
+def _sample_rows(p, rng=np.random):
+    """Samples one index per row of the 2d array p of probabilities."""
+    cumulated = p.cumsum(-1)
+    # 1 - random is in (0, 1] which avoids selecting zero probabilities
+    u = (1. - rng.random((p.shape[0], 1))) * cumulated[:, -1:]
+    return (cumulated < u).sum(-1)
+
+
+class POMDP(RandomSource):
 
     """Partially observable Markov model.
 
@@ -150,10 +158,14 @@ class POMDP:
         How to interpret reward coefficients.
     :solver_path: string
         Path in which to look for the executable (default to $PATH)
+    :param rng: random source for sampling (np.random or BufferedRandom,
+        None for np.random)
     """
 
     def __init__(self, T, O, R, start, discount, states=None, actions=None,
-                 observations=None, values='reward', solver_path=None):
+                 observations=None, values='reward', solver_path=None,
+                 rng=None):
+        self.rng = rng
         # Defaults for actions, states and observations
         a, s, o = O.shape
         self._init_states(states, s)
@@ -161,6 +173,7 @@ class POMDP:
         self._init_observations(observations, o)
         self.T = T
         self.O = O
+        self._sparse_T = {}  # Compressed rows of T, by action
         if values == 'reward':
             self.R = R
         elif values == 'cost':
@@ -263,14 +276,77 @@ class POMDP:
             raise Impossible('Impossible observation: ' + str(o))
         return new_b / s
 
+    def _sparse_transitions(self, a):
+        """Transitions of action a as compressed sparse rows: the successors
+        of s are successors[indptr[s]:indptr[s + 1]], with probabilities
+        (cached, T must not be modified in place afterwards).
+        """
+        rows = self._sparse_T.get(a)
+        if rows is None:
+            s, successors = np.nonzero(self.T[a])
+            indptr = np.searchsorted(s, np.arange(self.n_states + 1))
+            rows = indptr, successors, self.T[a][s, successors]
+            self._sparse_T[a] = rows
+        return rows
+
+    def sparse_belief_update(self, a, o, states, probabilities):
+        """Belief update of a sparse belief given by sorted states and their
+        probabilities, in time proportional to the number of transitions
+        from these states. Returns the sorted states and probabilities of
+        the updated belief.
+        """
+        indptr, successors, p = self._sparse_transitions(a)
+        starts = indptr[states]
+        lengths = indptr[np.asarray(states) + 1] - starts
+        ends = np.cumsum(lengths)
+        rows = np.repeat(starts - ends + lengths, lengths) + np.arange(
+            ends[-1] if len(ends) > 0 else 0)
+        new_states, inverse = np.unique(successors[rows], return_inverse=True)
+        new_p = np.bincount(
+            inverse, weights=p[rows] * np.repeat(probabilities, lengths),
+            minlength=len(new_states)) * self.O[a, new_states, o]
+        keep = new_p > 0.
+        s = new_p[keep].sum()
+        if s == 0.:
+            raise Impossible('Impossible observation: ' + str(o))
+        return new_states[keep], new_p[keep] / s
+
     def sample_transition(self, a, s):
-        new_s = np.random.choice(self.n_states, p=self.T[a, s, :])
-        o = np.random.choice(self.n_observations, p=self.O[a, new_s, :])
+        new_s = self.rng.choice(self.n_states, p=self.T[a, s, :])
+        o = self.rng.choice(self.n_observations, p=self.O[a, new_s, :])
         r = self.R[a, s, new_s, o]
         return new_s, o, r
 
+    def observation_probability(self, a, s, new_s, o):
+        """Probability of observing o after the transition from s to new_s
+        under action a (vectorized over arrays). Observations only depend on
+        the action and the end state in this model.
+        """
+        return self.O[a, new_s, o]
+
+    def sample_transitions(self, a, s):
+        """Vectorized sample_transition for arrays of actions and states."""
+        a = np.broadcast_to(a, np.shape(s))
+        new_s = _sample_rows(self.T[a, s, :], rng=self.rng)
+        o = _sample_rows(self.O[a, new_s, :], rng=self.rng)
+        r = self.R[a, s, new_s, o]
+        return new_s, o, r
+
+    def mdp_q_values(self, n_iterations=100):
+        """Action values of the underlying fully observable MDP, computed by
+        n_iterations of value iteration, as an (n_actions, n_states) array.
+        """
+        # Expected immediate reward for each action and state
+        r = (self.T * (self.O[:, np.newaxis, :, :] * self.R).sum(-1)).sum(-1)
+        v = np.zeros((self.n_states,))
+        q = r
+        for _ in range(n_iterations):
+            q = r + self.discount * self.T.dot(v)
+            v = q.max(0)
+        return q
+
     def sample_start(self):
-        return np.random.choice(self.n_states, p=self.start)
+        return self.rng.choice(self.n_states, p=self.start)
 
     def dump(self):
         """Write POMDP description following:
@@ -330,6 +406,7 @@ class POMDP:
             return cls.from_dict(d)
 
     def randomize(self, p_unexpected=1.e-3):
+        self._sparse_T = {}
         self.T += p_unexpected
         self.T /= self.T.sum(-1)[..., None]
         self.O += p_unexpected
@@ -348,7 +425,7 @@ class POMDP:
         if n_iterations is not None:
             args.extend(['-horizon', str(n_iterations)])
         if seed is None:
-            seed = np.random.randint(1.e10)
+            seed = self.rng.randint(1.e10)
         args.extend(['-rand_seed', str(seed)])
         if method == 'grid':
             if grid_type is None:
@@ -461,10 +538,15 @@ class GraphPolicyRunner(object):
 
 
 class GraphPolicyBeliefRunner(GraphPolicyRunner):
+    """
+    :param successor_cache: SuccessorCache of the belief updates of pomdp,
+        which may be shared with search trees (None)
+    """
 
-    def __init__(self, graph_policy, pomdp):
+    def __init__(self, graph_policy, pomdp, successor_cache=None):
         self.gp = graph_policy
         self.pomdp = pomdp
+        self.successor_cache = successor_cache
         self.reset()
 
     def reset(self, belief=None):
@@ -476,7 +558,11 @@ class GraphPolicyBeliefRunner(GraphPolicyRunner):
     def step(self, observation):
         a = self.pomdp.actions.index(self.get_action())
         o = self.pomdp.observations.index(observation)
-        b = self.pomdp.belief_update(a, o, self.current_belief)
+        if self.successor_cache is None:
+            b = self.pomdp.belief_update(a, o, self.current_belief)
+        else:
+            b = self.successor_cache.belief_update(self.pomdp, a, o,
+                                                   self.current_belief)
         self.reset(belief=b)
 
     def _rec_trajectory_tree(self, obs, horizon):
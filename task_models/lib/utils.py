@@ -1,4 +1,5 @@
 from json import JSONEncoder
+from numbers import Integral
 
 import numpy as np
 
@@ -20,3 +21,82 @@ class NPEncoder(JSONEncoder):
             return obj.tolist()
         else:
             return super(NPEncoder, self).default(obj)
+
+
+class RandomSource(object):
+    """Mixin for objects that draw random numbers from self.rng, np.random
+    unless another source (e.g. a BufferedRandom) is set. The np.random
+    module is never stored so that objects can be pickled.
+    """
+
+    _rng = None
+
+    def _default_rng(self):
+        return np.random
+
+    @property
+    def rng(self):
+        return self._default_rng() if self._rng is None else self._rng
+
+    @rng.setter
+    def rng(self, rng):
+        self._rng = None if rng is np.random else rng
+
+
+class BufferedRandom(object):
+    """Random source backed by a numpy Generator, that serves scalar draws
+    from blocks drawn in advance. Implements the part of the np.random
+    interface used by models, beliefs and search trees (random, randint,
+    choice and seed) so that either can be used as their rng.
+
+    :param seed: seed, SeedSequence or Generator
+    :param block_size: number of values drawn at once for scalar draws
+    """
+
+    def __init__(self, seed=None, block_size=1024):
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Resets the generator and discards buffered draws."""
+        if isinstance(seed, np.random.Generator):
+            self.generator = seed
+        else:
+            self.generator = np.random.default_rng(seed)
+        self._uniforms = np.zeros((0,))
+        self._next_uniform = 0
+        self._integers = {}  # high -> [block, index of next]
+
+    def random(self, size=None):
+        if size is not None:
+            return self.generator.random(size)
+        if self._next_uniform >= self._uniforms.shape[0]:
+            self._uniforms = self.generator.random(self.block_size)
+            self._next_uniform = 0
+        self._next_uniform += 1
+        return float(self._uniforms[self._next_uniform - 1])
+
+    def randint(self, low, high=None, size=None):
+        """Integers in [low, high), or in [0, low) if high is None."""
+        if high is not None or size is not None:
+            return self.generator.integers(low, high, size=size)
+        high = int(low)
+        block = self._integers.get(high)
+        if block is None or block[1] >= block[0].shape[0]:
+            block = [self.generator.integers(high, size=self.block_size), 0]
+            self._integers[high] = block
+        block[1] += 1
+        return int(block[0][block[1] - 1])
+
+    def choice(self, a, size=None, replace=True, p=None):
+        if size is not None or not replace:
+            return self.generator.choice(a, size=size, replace=replace, p=p)
+        n = a if isinstance(a, Integral) else len(a)
+        if p is None:
+            i = self.randint(n)
+        else:
+            cumulated = np.cumsum(p)
+            i = min(int(np.searchsorted(
+                cumulated, self.random() * cumulated[-1], side='right')),
+                n - 1)
+        return i if isinstance(a, Integral) else a[i]
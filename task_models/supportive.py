@@ -3,13 +3,20 @@ from itertools import chain
 from .task import (AbstractAction, SequentialCombination,
                    AlternativeCombination, LeafCombination,
                    ParallelCombination)
-from .lib.pomcp import Horizon
+from .lib.utils import RandomSource
+from .lib.pomcp import Horizon, RolloutPolicy, ActionPrior
+from .lib.options import SequenceOption
 
 
 def unique(l):
     return list(set(l))
 
 
+def unique_in_order(l):
+    seen = set()
+    return [x for x in l if not (x in seen or seen.add(x))]
+
+
 class _HTMToDAG:
 
     def __init__(self, node):
@@ -213,13 +220,13 @@ class _SupportivePOMDPState(object):
 
         return [sum_all_but(pp, i) for i, _ in enumerate(pp.shape)]
 
-    def random_object_changes(self, p):
-        to_change = np.random.random((self.n_objects)) < p
+    def random_object_changes(self, p, rng=np.random):
+        to_change = rng.random((self.n_objects)) < p
         for i in to_change.nonzero()[0]:
             self._set_bit(i, 1 - self._get_bit(i))
 
-    def random_preference_changes(self, p):
-        to_change = np.random.random((self.n_preferences)) < p
+    def random_preference_changes(self, p, rng=np.random):
+        to_change = rng.random((self.n_preferences)) < p
         for i in to_change.nonzero()[0]:
             self.set_preference(i, 1 - self.has_preference(i))
 
@@ -228,7 +235,7 @@ class _SupportivePOMDPState(object):
                           self.n_body_features, self.n_objects, s=self.s)
 
 
-class SupportivePOMDP:
+class SupportivePOMDP(RandomSource):
     """
     Each action has a condition attribute that is a pair (condition, object)
     where objects are represented as strings and condition is one of:
@@ -285,14 +292,17 @@ class SupportivePOMDP:
     observations = ['none', 'fail', 'not-found', 'yes', 'no']
     n_observations = len(observations)
 
-    def __init__(self, htm, discount=1.):
+    def __init__(self, htm, discount=1., rng=None):
         self.discount = discount
+        self.rng = rng
         h2d = _HTMToDAG(htm)
         self.htm_nodes = h2d.nodes
         # set final state as successors of last actions in HTM
         self.htm_succs = [[self.htm_clean] if len(s) == 0 else s for s in h2d.succs]
         self.htm_init = h2d.init
         self._populate_conditions()
+        self._htm_holds = np.array([n.action.hold for n in self.htm_nodes] +
+                                   [None, None])  # clean and final
         self.n_states = self.n_htm_states * (
             2 ** (len(self.preferences) + 1 + len(self.objects)))
         self._init_object_actions_indices()
@@ -368,14 +378,56 @@ class SupportivePOMDP:
     def belief_update(self, a, o, b):
         raise NotImplemented
 
+    def legal_actions(self, s):
+        """Boolean mask of the actions that are not pointless from state s:
+        only waiting after the final state, no hold in the cleaning state,
+        and only bringing missing objects or clearing present ones.
+        """
+        _s = self._int_to_state(s)
+        mask = np.ones((self.n_actions,), dtype=bool)
+        if _s.is_final():
+            mask[:] = False
+            mask[self.A_WAIT] = True
+            return mask
+        if _s.htm == self.htm_clean:
+            mask[[self.A_HOLD_H, self.A_HOLD_V]] = False
+        for o, (a_b, a_c) in enumerate(zip(self._a_bring, self._a_clear)):
+            present = _s.has_object(o)
+            mask[a_b] = not present
+            if a_c is not None:
+                mask[a_c] = present
+        return mask
+
     def _update_for_transition(self, _s, node):
         """Computes reward and modifies state to match transition from HTM node
         to a random successor.
         """
-        _s.htm = np.random.choice(self.htm_succs[node])
+        _s.htm = self.rng.choice(self.htm_succs[node])
         return sum([self._update_for_condition(_s, c, o)
                     for c, o in self.htm_conditions[node]])
 
+    def htm_options(self, all_primitives=False):
+        """Options for hierarchical search (see lib.options), derived from
+        the HTM: for each subtask, bring all the objects it needs, and clear
+        all objects; plus the primitive wait, hold and ask actions (or all
+        primitive actions). Failed bring and clear actions are tried again
+        once.
+        """
+        primitives = (range(self.n_actions) if all_primitives
+                      else range(self._skip_to_a_obj))
+        options = [SequenceOption(self.actions[a], [a]) for a in primitives]
+        for node, conditions in zip(self.htm_nodes, self.htm_conditions):
+            if len(conditions) > 0:
+                options.append(SequenceOption(
+                    'bring for ' + node.name,
+                    unique_in_order([self._bring(o) for _, o in conditions]),
+                    retry_observations=[self.O_FAIL]))
+        clear = [self._clear(o) for o, c in enumerate(self.clearable) if c]
+        if len(clear) > 0:
+            options.append(SequenceOption('clear all', clear,
+                                          retry_observations=[self.O_FAIL]))
+        return options
+
     # Action indices manipulation
 
     def _init_object_actions_indices(self):
@@ -391,6 +443,14 @@ class SupportivePOMDP:
             if c:
                 self._a_clear[o] = j
                 j += 1
+        # Lookup arrays for vectorized transitions
+        self._a_objects = np.full((j,), -1, dtype=np.int64)
+        self._a_is_bring = np.zeros((j,), dtype=np.int64)
+        for o, (a_b, a_c) in enumerate(zip(self._a_bring, self._a_clear)):
+            self._a_objects[a_b] = o
+            self._a_is_bring[a_b] = 1
+            if a_c is not None:
+                self._a_objects[a_c] = o
 
     def _obj_from_action(self, a):
         """Returns index of the object that the action gets or removes."""
@@ -426,7 +486,7 @@ class SupportivePOMDP:
         if c == CONSUMES:
             _s.set_object(obj, 0)
         elif c == CONSUMES_SOME:
-            _s.set_object(obj, 0 if np.random.random() < self.p_consume_all else 1)
+            _s.set_object(obj, 0 if self.rng.random() < self.p_consume_all else 1)
         elif c == USES:
             _s.set_object(obj, 1)
         return r
@@ -439,8 +499,9 @@ class SupportivePOMDP:
         _s = self._int_to_state(s)
         if random:
             # random transitions
-            _s.random_object_changes(self.p_changed_by_human)
-            _s.random_preference_changes(self.p_change_preference)
+            _s.random_object_changes(self.p_changed_by_human, rng=self.rng)
+            _s.random_preference_changes(self.p_change_preference,
+                                         rng=self.rng)
         _new_s = self._int_to_state(_s.to_int())
 
         # Actions that trigger a HTM state transition:
@@ -466,7 +527,7 @@ class SupportivePOMDP:
                         (needs_hold == 'v' and a == self.A_HOLD_V)):
                     r += self.r_preference
                 elif (a in (self.A_HOLD_H, self.A_HOLD_V) and (
-                        (not random) or np.random.random() < .98)):
+                        (not random) or self.rng.random() < .98)):
                     # Undesired HOLD: most likely gets an error
                     obs = self.O_FAIL
                 # otherwise it's a wait, there is nothing to do
@@ -482,12 +543,12 @@ class SupportivePOMDP:
         elif a == self.A_ASK:
             r = -self.cost_intrinsic
             if _s.has_preference(self.PREF_HOLD):
-                if (not random) or np.random.random() < 0.9:
+                if (not random) or self.rng.random() < 0.9:
                     obs = self.O_YES
                 else:
                     obs = self.O_NONE
             else:
-                if (not random) or np.random.random() < 0.95:
+                if (not random) or self.rng.random() < 0.95:
                     obs = self.O_NO
                 else:
                     obs = self.O_NONE
@@ -499,7 +560,7 @@ class SupportivePOMDP:
             if _s.has_object(obj) == is_bring:
                 # Bring object already there or remove object that's not there
                 obs = self.O_NOT_FOUND
-            elif random and np.random.random() < self.p_fail:
+            elif random and self.rng.random() < self.p_fail:
                 obs = self.O_FAIL
             else:
                 _new_s.set_object(obj, is_bring)
@@ -508,15 +569,167 @@ class SupportivePOMDP:
             r = -self.cost_intrinsic  # Intrinsic action cost
         return _new_s.to_int(), obs, r
 
+    # Vectorized transitions
+
+    def _random_flips(self, n, p, n_bits, shift):
+        """Masks flipping each of the n_bits bits after shift with
+        probability p, for n states.
+        """
+        flips = self.rng.random((n, n_bits)) < p
+        return flips.dot(1 << (shift + np.arange(n_bits, dtype=np.int64)))
+
+    @staticmethod
+    def _set_bits(s, i, b):
+        return (s & ~(1 << i)) | (b << i)
+
+    def _update_for_transitions(self, new_s, lanes, node):
+        """Vectorized _update_for_transition on given lanes of new_s (which
+        is modified in place).
+        """
+        _s = self._int_to_state()
+        htm = self.rng.choice(self.htm_succs[node], size=len(lanes))
+        s = ((new_s[lanes] & ((1 << _s._shift_htm) - 1)) |
+             (htm << _s._shift_htm))
+        r = np.zeros((len(lanes),))
+        for c, obj in self.htm_conditions[node]:
+            r -= (1 - ((s >> obj) & 1)) * self._cost_get(obj)
+            if c == CONSUMES:
+                s = self._set_bits(s, obj, 0)
+            elif c == CONSUMES_SOME:
+                s = self._set_bits(s, obj, (
+                    self.rng.random(len(lanes)) >= self.p_consume_all
+                    ).astype(np.int64))
+            elif c == USES:
+                s = self._set_bits(s, obj, 1)
+        new_s[lanes] = s
+        return r
+
+    def sample_transitions(self, a, s, random=True):
+        """Vectorized sample_transition for arrays of actions and states.
+        """
+        s = np.array(s, dtype=np.int64)
+        n = s.shape[0]
+        a = np.broadcast_to(a, (n,))
+        self.n_simulator_calls += n
+        _s = self._int_to_state()
+        if random:
+            # random transitions
+            s ^= self._random_flips(n, self.p_changed_by_human,
+                                    _s.n_objects, 0)
+            s ^= self._random_flips(n, self.p_change_preference,
+                                    _s.n_preferences, _s._shift_pref)
+        new_s = s.copy()
+        obs = np.full((n,), self.O_NONE, dtype=np.int64)
+        r = np.zeros((n,))
+        htm = s >> _s._shift_htm
+        pref = ((s >> (_s._shift_pref + self.PREF_HOLD)) & 1).astype(bool)
+        u = self.rng.random(n) if random else np.zeros((n,))
+
+        # Actions that trigger a HTM state transition:
+        is_wait = a == self.A_WAIT
+        is_hold = (a == self.A_HOLD_H) | (a == self.A_HOLD_V)
+        r[is_hold] = -self.cost_hold
+        # Cleaning state (only WAIT finishes the task)
+        clean = (is_wait | is_hold) & (htm == self.htm_clean)
+        obs[clean & is_hold] = self.O_FAIL
+        finish = clean & is_wait
+        for o, _ in enumerate(self.objects):
+            r[finish] -= self._cost_get(o) * ((s[finish] >> o) & 1)
+        r[finish] += self.r_final
+        new_s[finish] = ((s[finish] & ((1 << _s._shift_htm) - 1)) |
+                         (self.htm_final << _s._shift_htm))
+        # Transitions within the given HTM
+        in_htm = (is_wait | is_hold) & (htm < self.htm_clean)
+        holds = self._htm_holds[htm]
+        supported = in_htm & pref & (
+            ((holds == 'h') & (a == self.A_HOLD_H)) |
+            ((holds == 'v') & (a == self.A_HOLD_V)))
+        r[supported] += self.r_preference
+        failed = in_htm & is_hold & ~supported & (u < .98)
+        obs[failed] = self.O_FAIL
+        transition = in_htm & ~failed
+        for node in np.unique(htm[transition]):
+            lanes = np.flatnonzero(transition & (htm == node))
+            r[lanes] += self._update_for_transitions(new_s, lanes, node)
+        r[transition] += self.r_subtask
+        if self.reward_independent_preference:
+            r[transition & ~pref] += self.r_preference - self.cost_hold
+
+        is_ask = a == self.A_ASK
+        r[is_ask] = -self.cost_intrinsic
+        obs[is_ask & pref & (u < .9)] = self.O_YES
+        obs[is_ask & ~pref & (u < .95)] = self.O_NO
+
+        # Clear and bring actions
+        lanes = np.flatnonzero(a >= self._skip_to_a_obj)
+        obj = self._a_objects[a[lanes]]
+        is_bring = self._a_is_bring[a[lanes]]
+        not_found = ((s[lanes] >> obj) & 1) == is_bring
+        fail = ~not_found & (u[lanes] < self.p_fail) & random
+        done = ~not_found & ~fail
+        obs[lanes[not_found]] = self.O_NOT_FOUND
+        obs[lanes[fail]] = self.O_FAIL
+        new_s[lanes[done]] = self._set_bits(new_s[lanes[done]], obj[done],
+                                            is_bring[done])
+        r[lanes] = -self.cost_intrinsic  # Intrinsic action cost
+        return new_s, obs, r
+
+    def observation_probability(self, a, s, new_s, o):
+        """Probability of observing o after the transition from s to new_s
+        under action a, vectorized over arrays. It depends on the start
+        state since failed actions leave the HTM state or the objects
+        unchanged.
+        """
+        shape = np.broadcast(a, s, new_s, o).shape
+        a, s, new_s, o = [np.ravel(x) for x in np.broadcast_arrays(
+            a, np.asarray(s, dtype=np.int64),
+            np.asarray(new_s, dtype=np.int64), o)]
+        _s = self._int_to_state()
+        p = np.zeros(s.shape)
+        htm = s >> _s._shift_htm
+        # Wait and hold: failures are the transitions within the HTM that
+        # leave the HTM state unchanged
+        is_hold = (a == self.A_HOLD_H) | (a == self.A_HOLD_V)
+        failed = ((htm == self.htm_clean) & is_hold) | (
+            (htm < self.htm_clean) & ((new_s >> _s._shift_htm) == htm))
+        p[(is_hold | (a == self.A_WAIT)) &
+          (o == np.where(failed, self.O_FAIL, self.O_NONE))] = 1.
+        # Ask: answers depend on the (possibly changed) preference
+        pref = ((new_s >> (_s._shift_pref + self.PREF_HOLD)) & 1
+                ).astype(bool)
+        is_ask = a == self.A_ASK
+        p[is_ask & pref & (o == self.O_YES)] = .9
+        p[is_ask & pref & (o == self.O_NONE)] = .1
+        p[is_ask & ~pref & (o == self.O_NO)] = .95
+        p[is_ask & ~pref & (o == self.O_NONE)] = .05
+        # Clear and bring actions: if the object ends as the action leaves
+        # it, either it was already there or the action succeeded
+        lanes = np.flatnonzero(a >= self._skip_to_a_obj)
+        obj = self._a_objects[a[lanes]]
+        is_bring = self._a_is_bring[a[lanes]]
+        has = (new_s[lanes] >> obj) & 1
+        unchanged = np.where(((s[lanes] >> obj) & 1) == is_bring,
+                             1. - self.p_changed_by_human,
+                             self.p_changed_by_human)
+        done = (1. - unchanged) * (1. - self.p_fail)
+        total = unchanged + done
+        total[total == 0.] = 1.
+        lane_o = o[lanes]
+        p[lanes] = np.where(
+            has != is_bring, lane_o == self.O_FAIL,
+            np.where(lane_o == self.O_NOT_FOUND, unchanged,
+                     np.where(lane_o == self.O_NONE, done, 0.)) / total)
+        return p.reshape(shape) if len(shape) > 0 else p[0]
+
     def sample_start(self):
         """Samples a starting state."""
-        htm_id = np.random.choice(self.htm_init)
+        htm_id = self.rng.choice(self.htm_init)
         _s = self._int_to_state()
         _s.htm = htm_id
         for i, p in enumerate(self.p_preferences):
-            _s.set_preference(i, 1 if np.random.random() < p else 0)
+            _s.set_preference(i, 1 if self.rng.random() < p else 0)
         # random transitions
-        _s.random_object_changes(self.p_changed_by_human)
+        _s.random_object_changes(self.p_changed_by_human, rng=self.rng)
         return _s.to_int()
 
     @property
@@ -524,11 +737,80 @@ class SupportivePOMDP:
         raise NotImplementedError
 
 
+class SupportiveRolloutPolicy(RolloutPolicy):
+    """Rollout policy that follows the HTM: brings the objects required by
+    the current subtask, clears remaining objects in the cleaning state, and
+    otherwise waits. It does not use the preference of the human, which is
+    left to the search.
+    """
+
+    def _action(self, s):
+        model = self.model
+        _s = model._int_to_state(s)
+        if _s.is_final():
+            return model.A_WAIT
+        elif _s.htm == model.htm_clean:
+            for o, c in enumerate(model.clearable):
+                if c and _s.has_object(o):
+                    return model._clear(o)
+        else:
+            for _, o in model.htm_conditions[_s.htm]:
+                if not _s.has_object(o):
+                    return model._bring(o)
+        return model.A_WAIT
+
+
+class HTMDistancePrior(ActionPrior):
+    """Optimistic action values from the number of subtasks left before
+    the end of the HTM: r_subtask for each remaining subtask plus r_final,
+    minus penalty for actions that differ from the one of the
+    SupportiveRolloutPolicy, averaged over the belief.
+
+    :param penalty: value lost by other actions (None: cost_get, the cost
+        for the human to get an object)
+    """
+
+    def __init__(self, model, n_visits=10, penalty=None):
+        super(HTMDistancePrior, self).__init__(n_visits=n_visits)
+        self.model = model
+        self.penalty = model.cost_get if penalty is None else penalty
+        self._policy = SupportiveRolloutPolicy(model)
+        # Number of subtasks from each HTM state to the cleaning state
+        distances = [0 if i == model.htm_clean else None
+                     for i in range(model.n_htm_states)]
+        while any(d is None for d in distances[:model.htm_clean]):
+            for i, succs in enumerate(model.htm_succs):
+                if distances[i] is None and all(
+                        distances[j] is not None for j in succs):
+                    distances[i] = 1 + min(distances[j] for j in succs)
+        distances[model.htm_final] = 0
+        self.distances = distances
+        self._cache = {}
+
+    def _state_values(self, s):
+        if s not in self._cache:
+            model = self.model
+            _s = model._int_to_state(s)
+            values = np.full((model.n_actions,), -self.penalty)
+            values[self._policy._action(s)] = 0.
+            if not _s.is_final():
+                values += (model.r_subtask * self.distances[_s.htm] +
+                           model.r_final)
+            self._cache[s] = values
+        return self._cache[s]
+
+    def values(self, belief):
+        array = belief.array
+        states = belief.support()
+        return sum(array[s] * self._state_values(s) for s in states)
+
+
 class NHTMHorizon(Horizon):
 
     def __init__(self, model, n):
         self.model = model
         self.n = n
+        self._initial_n = n
 
     def is_reached(self):
         return self.n <= 0
@@ -543,6 +825,12 @@ class NHTMHorizon(Horizon):
     def copy(self):
         return NHTMHorizon(self.model, self.n)
 
+    def reset(self):
+        self.n = self._initial_n
+
+    def key(self):
+        return self.n
+
     @classmethod
     def generator(cls, model, n=3):
         return cls._Generator(cls, model, n)
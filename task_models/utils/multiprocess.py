@@ -12,14 +12,33 @@ class RepeatPool:
     """Implements repeating several times the same function through processes
     and returning the list of results. Takes care of using a different numpy
     random state in each process.
+
+    :param seed: seed of the SeedSequence from which the seeds of the
+        processes are spawned (requires numpy >= 1.17); if None, seeds are
+        drawn from np.random, so that results follow its global state
+    :param rngs: random sources (e.g. BufferedRandom) used by target, that
+        are reseeded in each process
     """
 
-    def __init__(self, target):
+    def __init__(self, target, seed=None, rngs=()):
         self.n_processes = cpu_count()
         self.target = target
-
-    def work(self, seed):
+        self.seed_sequence = (None if seed is None
+                              else np.random.SeedSequence(seed))
+        self.rngs = list(rngs)
+
+    def _seeds(self):
+        """Seeds of np.random and of the random sources of a process."""
+        if self.seed_sequence is None:
+            return (np.random.randint(2**32),
+                    [np.random.randint(2**32) for _ in self.rngs])
+        child = self.seed_sequence.spawn(1)[0]
+        return child.generate_state(1)[0], child.spawn(len(self.rngs))
+
+    def work(self, seed, rng_seeds):
         np.random.seed(seed)
+        for rng, s in zip(self.rngs, rng_seeds):
+            rng.seed(s)
         result = self.target()
         self.result_queue.put(result)
 
@@ -46,7 +65,7 @@ class RepeatPool:
     def _start_or_None(self):
         if self.to_go > 0:
             self.to_go -= 1
-            p = Process(target=self.work, args=(np.random.randint(2**32),))
+            p = Process(target=self.work, args=self._seeds())
             p.start()
             return p
         else:
@@ -67,12 +86,12 @@ class RepeatPool:
                         if w is None else w for w in self.workers]
 
 
-def repeat(func, n):
+def repeat(func, n, seed=None, rngs=()):
     """Repeats calls to func n times in separate process.
 
-    See RepeatPool for implementation.
+    See RepeatPool for implementation and parameters.
     """
-    p = RepeatPool(func)
+    p = RepeatPool(func, seed=seed, rngs=rngs)
     return p.run(n)
 
 
@@ -56,3 +56,16 @@ class TestRandomness(TestCase):
     def test_subprocess_get_different_randoms(self):
         randoms = repeat(self.get_random, 10)
         self.assertTrue(len(set(randoms)) > 1)
+
+    def test_seeded_repeats_are_reproducible(self):
+        def randoms():
+            return sorted(repeat(self.get_random, 10, seed=3))
+
+        self.assertEqual(randoms(), randoms())
+
+    def test_repeats_follow_global_random_state(self):
+        def randoms():
+            np.random.seed(4)
+            return sorted(repeat(self.get_random, 10))
+
+        self.assertEqual(randoms(), randoms())
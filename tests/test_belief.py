@@ -1,10 +1,30 @@
+import warnings
 from numbers import Integral
 from unittest import TestCase
 
 import numpy as np
 
+from task_models.lib.pomdp import POMDP
+from task_models.lib.pomdp import Impossible
 from task_models.lib.belief import (ArrayBelief, ParticleBelief,
-                                    MaxSamplesReached)
+                                    SparseBelief, MaxSamplesReached,
+                                    SuccessorCache, systematic_resample)
+
+
+class TestSystematicResample(TestCase):
+
+    def test_counts(self):
+        weights = np.array([.5, 0., 2., 1.5])
+        for _ in range(10):
+            counts = np.bincount(systematic_resample(weights, 20),
+                                 minlength=4)
+            self.assertEqual(counts.sum(), 20)
+            self.assertEqual(counts[1], 0)
+            # Counts are within one of their expectations
+            self.assertTrue((np.abs(counts - [2.5, 0., 10., 7.5]) < 1).all())
+
+    def test_no_samples(self):
+        self.assertEqual(systematic_resample([.5, .5], 0).shape, (0,))
 
 
 class BeliefBaseTest(object):
@@ -29,6 +49,10 @@ class BeliefBaseTest(object):
     def setUp(self):
         self.p = np.array([.7, 0., .3])
 
+    def test_signature_matches_array_belief(self):
+        self.assertEqual(self.belief.signature(.1),
+                         ArrayBelief(self.belief.array).signature(.1))
+
     def test_sample_is_int(self):
         self.assertIsInstance(self.belief.sample(), Integral)
 
@@ -36,6 +60,21 @@ class BeliefBaseTest(object):
         for i in range(10):
             self.assertNotEqual(self.p[self.belief.sample()], 0.)
 
+    def test_sample_n(self):
+        states = self.belief.sample(50)
+        self.assertEqual(states.shape, (50,))
+        self.assertTrue((self.p[states] != 0.).all())
+
+    def test_legal_actions_is_union_over_support(self):
+        class Model:
+            n_actions = 4
+
+            def legal_actions(self, s):
+                return np.arange(4) == s
+
+        np.testing.assert_array_equal(self.belief.legal_actions(Model()),
+                                      [True, False, True, False])
+
 
 class TestArrayBelief(BeliefBaseTest, TestCase):
 
@@ -50,6 +89,100 @@ class TestArrayBelief(BeliefBaseTest, TestCase):
         self.assertIsInstance(succ, ArrayBelief)
         np.testing.assert_array_equal(succ.array, p_succ)
 
+    def test_nbytes(self):
+        self.assertEqual(self.belief.nbytes, self.p.nbytes)
+
+    def test_signature(self):
+        close = ArrayBelief([.71, 0., .29])
+        far = ArrayBelief([.5, 0., .5])
+        self.assertEqual(self.belief.signature(.1), close.signature(.1))
+        self.assertNotEqual(self.belief.signature(.1), far.signature(.1))
+        self.assertNotEqual(self.belief.signature(.001), close.signature(.001))
+
+
+class TestSparseBelief(BeliefBaseTest, TestCase):
+
+    def setUp(self):
+        super(TestSparseBelief, self).setUp()
+        self.belief = SparseBelief.from_array(self.p)
+
+    def test_from_array(self):
+        np.testing.assert_array_equal(self.belief.states, [0, 2])
+        np.testing.assert_array_equal(self.belief.probabilities, [.7, .3])
+        self.assertEqual(self.belief.n_states, 3)
+        self.assertEqual(self.belief.to_list(), self.p.tolist())
+
+    def test_requires_sorted_states(self):
+        with self.assertRaises(ValueError):
+            SparseBelief([2, 0], [.5, .5], 3)
+
+    def test_hash(self):
+        same = SparseBelief([0, 2], [.7, .3], 3)
+        self.assertEqual(hash(same), hash(self.belief))
+        self.assertEqual(same, self.belief)
+        self.assertNotEqual(SparseBelief([0, 1], [.7, .3], 3), self.belief)
+
+    def test_successor(self):
+        class Model:
+            def sparse_belief_update(self, a, o, states, probabilities):
+                return states + a, probabilities[::-1]
+
+        succ = self.belief.successor(Model(), 1, 0)
+        self.assertIsInstance(succ, SparseBelief)
+        np.testing.assert_array_equal(succ.states, [1, 3])
+        np.testing.assert_array_equal(succ.probabilities, [.3, .7])
+
+    def test_nbytes(self):
+        self.assertEqual(self.belief.nbytes, 32)
+
+
+class TestSuccessorCache(TestCase):
+
+    class Model:
+
+        def __init__(self):
+            self.calls = 0
+
+        def belief_update(self, a, o, b):
+            self.calls += 1
+            if o == 1:
+                raise Impossible('Impossible observation: 1')
+            return np.roll(b, a)
+
+    def setUp(self):
+        self.model = self.Model()
+        self.cache = SuccessorCache(max_size=2)
+        self.belief = ArrayBelief([.7, 0., .3])
+
+    def test_successor(self):
+        succ = self.cache.successor(self.model, self.belief, 1, 0)
+        self.assertIsInstance(succ, ArrayBelief)
+        np.testing.assert_array_equal(succ.array, [.3, .7, 0.])
+        self.assertFalse(succ.array.flags.writeable)
+        again = self.cache.successor(self.model, ArrayBelief([.7, 0., .3]),
+                                     1, 0)
+        self.assertIs(again.array, succ.array)
+        self.assertEqual(self.model.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_caches_impossible(self):
+        for _ in range(2):
+            with self.assertRaises(Impossible):
+                self.cache.successor(self.model, self.belief, 0, 1)
+        self.assertEqual(self.model.calls, 1)
+
+    def test_lru(self):
+        b = self.belief.array
+        self.cache.belief_update(self.model, 0, 0, b)
+        self.cache.belief_update(self.model, 1, 0, b)
+        self.cache.belief_update(self.model, 0, 0, b)  # Most recent
+        self.cache.belief_update(self.model, 2, 0, b)  # Evicts (1, 0)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.belief_update(self.model, 0, 0, b)
+        self.assertEqual(self.model.calls, 3)
+        self.cache.belief_update(self.model, 1, 0, b)
+        self.assertEqual(self.model.calls, 4)
+
 
 class TestParticleBelief(BeliefBaseTest, TestCase):
 
@@ -71,12 +204,102 @@ class TestParticleBelief(BeliefBaseTest, TestCase):
         self.assertTrue(all([s in self.belief.part_states
                              for (_, s) in model.sampled_on]))
 
+    def test_nbytes(self):
+        self.assertEqual(self.belief.nbytes, 80)
+
+    def test_from_particles(self):
+        b = ParticleBelief.from_particles([2, 0, 2], 3)
+        np.testing.assert_array_equal(b.part_states, [2, 0, 2])
+        self.assertEqual(b.part_states.dtype, np.int64)
+        self.assertEqual(b.n_particles, 3)
+        self.assertEqual(b.n_states, 3)
+
     def test_raises_MaxSamplesReached(self):
         def failing_sampler():
             raise MaxSamplesReached(0, 0, 0)
         with self.assertRaises(MaxSamplesReached):
             ParticleBelief(failing_sampler, 10, 10)
 
+    def test_unknown_update(self):
+        with self.assertRaises(ValueError):
+            ParticleBelief(lambda: 0, 3, 10, update='unknown')
+
+    def test_weighted_requires_observation_probability(self):
+        b = ParticleBelief(lambda: 0, 3, 10, update='weighted')
+        with self.assertRaises(ValueError):
+            b.successor(self.FakeModel(self.p, self.p), 0, 0)
+
+    def _pomdp(self, T=None):
+        if T is None:
+            T = np.random.dirichlet(np.ones((3,)), (2, 3))
+        O = np.array([[.9, .1], [0., 1.], [.5, .5]])[None, :, :].repeat(2, 0)
+        return POMDP(T, O, np.zeros((2, 3, 3, 2)), self.p, 1.)
+
+    def test_weighted_successor(self):
+        pomdp = self._pomdp()
+        b = ParticleBelief(pomdp.sample_start, 3, 5000, update='weighted')
+        succ = b.successor(pomdp, 1, 0)
+        self.assertIsInstance(succ, ParticleBelief)
+        self.assertEqual(succ.n_particles, 5000)
+        self.assertEqual(succ.update, 'weighted')
+        self.assertNotIn(1, succ.part_states)
+        np.testing.assert_allclose(
+            succ.array, pomdp.belief_update(1, 0, b.array), atol=.05)
+
+    class RareModel:
+        """Vectorized transitions only reach state 1, in which the
+        observation has probability p, while single transitions reach
+        state 2 with the observation.
+        """
+
+        def __init__(self, p):
+            self.p = p
+
+        def sample_transitions(self, a, s):
+            return np.ones(np.shape(s), dtype=np.int64), None, None
+
+        def sample_transition(self, a, s):
+            return 2, 0, 0.
+
+        def observation_probability(self, a, s, new_s, o):
+            return np.where(new_s == 2, 1., self.p)
+
+    def test_weighted_falls_back_to_rejection(self):
+        b = ParticleBelief(lambda: 0, 3, 10, update='weighted')
+        succ = b.successor(self.RareModel(0.), 0, 0)
+        np.testing.assert_array_equal(succ.part_states, [2] * 10)
+        self.assertEqual(succ.update, 'weighted')
+
+    def test_weighted_reinvigoration(self):
+        b = ParticleBelief(lambda: 0, 3, 10, update='weighted',
+                           reinvigoration=.3)
+        succ = b.successor(self.RareModel(.5), 0, 0)
+        self.assertEqual(succ.reinvigoration, .3)
+        # New consistent particles are injected
+        np.testing.assert_array_equal(np.sort(succ.part_states),
+                                      [1] * 7 + [2] * 3)
+
+    def test_weighted_full_reinvigoration(self):
+        b = ParticleBelief(lambda: 0, 3, 10, update='weighted',
+                           reinvigoration=1.)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            succ = b.successor(self.RareModel(.5), 0, 0)
+        np.testing.assert_array_equal(succ.part_states, [2] * 10)
+
+    def test_weighted_impossible_observation(self):
+        pomdp = self._pomdp()
+        b = ParticleBelief(lambda: 1, 3, 10, update='weighted')
+        pomdp.T[:, 1, :] = np.array([0., 1., 0.])
+        with self.assertRaises(MaxSamplesReached):
+            b.successor(pomdp, 0, 0)
+
+    def test_from_particles_keeps_update(self):
+        b = ParticleBelief.from_particles([0, 1], 3, update='weighted',
+                                          reinvigoration=.5)
+        self.assertEqual(b.update, 'weighted')
+        self.assertEqual(b.reinvigoration, .5)
+
     def test_do_not_fail_with_one_particle_sampled(self):
         states = [3]
 
@@ -88,4 +311,57 @@ class TestParticleBelief(BeliefBaseTest, TestCase):
 
         p = ParticleBelief(sampler_once, 10, 99)
         self.assertEqual(len(p.part_states), 99)
-        self.assertEqual(p.part_states, [3] * 99)
+        np.testing.assert_array_equal(p.part_states, [3] * 99)
+
+    def test_particles_are_shared_read_only(self):
+        particles = np.array([2, 0, 2])
+        b = ParticleBelief.from_particles(particles, 3)
+        self.assertIsNot(b.part_states, particles)
+        self.assertFalse(b.part_states.flags.writeable)
+        self.assertIs(ParticleBelief.from_particles(b.part_states, 3
+                                                    ).part_states,
+                      b.part_states)
+
+    def test_array_is_cached(self):
+        b = ParticleBelief.from_particles([2, 0, 2, 2], 4)
+        np.testing.assert_allclose(b.array, [.25, 0., .75, 0.])
+        self.assertIs(b.array, b.array)
+        self.assertFalse(b.array.flags.writeable)
+
+    def test_identical_successor_shares_particles(self):
+        class Identity:
+            def sample_transition(self, a, s):
+                return s, 0, 0.
+
+            def observation_probability(self, a, s, new_s, o):
+                return np.ones(np.shape(s))
+
+        b = ParticleBelief.from_particles([1] * 10, 3)
+        b.array
+        for update in ['rejection', 'weighted']:
+            b.update = update
+            succ = b.successor(Identity(), 0, 0)
+            self.assertIs(succ.part_states, b.part_states)
+            self.assertIs(succ.array, b.array)
+
+    def test_reordered_successor_shares_particles(self):
+        b = ParticleBelief.from_particles([0, 2, 2, 1], 3)
+        b.array
+        succ = ParticleBelief.from_particles([2, 1, 0, 2], 3)
+        succ._share_identical(b)
+        self.assertIs(succ.part_states, b.part_states)
+        self.assertIs(succ.array, b.array)
+
+    def test_different_successor_does_not_share_particles(self):
+        b = ParticleBelief.from_particles([0, 2, 2, 1], 3)
+        succ = ParticleBelief.from_particles([2, 1, 0, 0], 3)
+        succ._share_identical(b)
+        self.assertIsNot(succ.part_states, b.part_states)
+        self.assertEqual(succ.nbytes, 32)
+
+    def test_shared_particles_are_counted_once(self):
+        b = ParticleBelief.from_particles([0, 2, 2, 1], 3)
+        succ = ParticleBelief.from_particles([2, 1, 0, 2], 3)
+        succ._share_identical(b)
+        self.assertEqual(b.nbytes, 32)
+        self.assertEqual(succ.nbytes, 0)
@@ -0,0 +1,36 @@
+from unittest import TestCase, skipIf
+
+try:
+    from task_models.evaluation import FinishedOrNTransitionsHorizon
+except ImportError:  # Evaluation dependencies (matplotlib, expjobs) missing
+    FinishedOrNTransitionsHorizon = None
+from task_models.task import SequentialCombination, LeafCombination
+from task_models.supportive import SupportivePOMDP, AssembleLeg
+from task_models.lib.pomcp import POMCPPolicyRunner
+
+
+@skipIf(FinishedOrNTransitionsHorizon is None,
+        'evaluation dependencies are not installed')
+class TestFinishedOrNTransitionsHorizon(TestCase):
+
+    def setUp(self):
+        self.model = SupportivePOMDP(SequentialCombination(
+            [LeafCombination(AssembleLeg('leg'))]))
+
+    def test_reset_after_final_transition(self):
+        h = FinishedOrNTransitionsHorizon(self.model, 5)
+        final = self.model._int_to_state()
+        final.htm = self.model.htm_final
+        h.decrement(0, 0, final.to_int(), 0)
+        self.assertTrue(h.is_reached())
+        h.reset()
+        self.assertFalse(h.is_reached())
+        self.assertEqual(h.n, 5)
+
+    def test_reused_horizon_runs_all_simulations(self):
+        policy = POMCPPolicyRunner(
+            self.model, iterations=100, belief='particle',
+            belief_params={'n_particles': 20},
+            horizon=FinishedOrNTransitionsHorizon.generator(self.model, n=20))
+        policy.get_action()
+        self.assertEqual(policy.tree.root.n_simulations, 100)
@@ -0,0 +1,118 @@
+from unittest import TestCase
+
+import numpy as np
+
+from task_models.task import SequentialCombination, LeafCombination
+from task_models.lib.pomdp import POMDP
+from task_models.lib.options import (SequenceOption, OptionModel,
+                                     HierarchicalPolicyRunner)
+from task_models.supportive import (SupportivePOMDP, AssembleFoot, BringTop,
+                                    NHTMHorizon)
+
+
+class TestSequenceOption(TestCase):
+
+    def test_runs_actions_in_order(self):
+        option = SequenceOption('o', [3, 1])
+        self.assertEqual(option.action([]), 3)
+        self.assertEqual(option.action([0]), 1)
+        self.assertIsNone(option.action([0, 0]))
+
+    def test_retries(self):
+        option = SequenceOption('o', [3, 1], retry_observations=[2],
+                                max_retries=1)
+        self.assertEqual(option.action([2]), 3)
+        self.assertEqual(option.action([2, 2]), 1)
+        self.assertEqual(option.action([0, 2]), 1)
+        self.assertIsNone(option.action([2, 0, 2, 2]))
+
+    def test_requires_actions(self):
+        with self.assertRaises(ValueError):
+            SequenceOption('o', [])
+
+
+class TestOptionModel(TestCase):
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((3,)), (2, 3))
+        O = np.random.dirichlet(np.ones((2,)), (2, 3))
+        R = np.random.random((2, 3, 3, 2))
+        self.pomdp = POMDP(T, O, R, np.ones((3,)) / 3, .9,
+                           actions=['a', 'b'], observations=['x', 'y'])
+        self.options = [SequenceOption('a', [0]),
+                        SequenceOption('aba', [0, 1, 0])]
+        self.model = OptionModel(self.pomdp, self.options)
+
+    def test_actions(self):
+        self.assertEqual(self.model.actions, ['a', 'aba'])
+        self.assertEqual(self.model.n_actions, 2)
+
+    def test_sample_transition(self):
+        s, o, r = self.model.sample_transition(1, 0)
+        sequence = self.model.observation_sequence(o)
+        self.assertEqual(len(sequence), 3)
+        self.assertEqual(self.model.observations[o],
+                         ', '.join([self.pomdp.observations[x]
+                                    for x in sequence]))
+        self.assertEqual(self.model.observation_id(sequence), o)
+
+    def test_max_steps(self):
+        self.model.max_steps = 2
+        _, o, _ = self.model.sample_transition(1, 0)
+        self.assertEqual(len(self.model.observation_sequence(o)), 2)
+
+    def test_belief_update(self):
+        o = self.model.observation_id([1, 0, 0])
+        b = self.pomdp.start
+        expected = self.pomdp.belief_update(0, 1, b)
+        expected = self.pomdp.belief_update(1, 0, expected)
+        expected = self.pomdp.belief_update(0, 0, expected)
+        np.testing.assert_allclose(self.model.belief_update(1, o, b),
+                                   expected)
+
+
+class TestHierarchicalPolicyRunner(TestCase):
+
+    def setUp(self):
+        htm = SequentialCombination([LeafCombination(BringTop()),
+                                     LeafCombination(AssembleFoot('leg-1'))])
+        self.model = SupportivePOMDP(htm)
+        self.model.p_fail = 0.
+        self.model.p_changed_by_human = 0.
+        self.model.p_change_preference = 0.
+        self.policy = HierarchicalPolicyRunner(
+            self.model, self.model.htm_options(), iterations=50,
+            horizon=NHTMHorizon.generator(self.model, n=3),
+            belief='particle', belief_params={'n_particles': 20})
+
+    def test_htm_options(self):
+        names = [o.name for o in self.model.htm_options()]
+        self.assertEqual(names[:4], self.model.actions[:4])
+        self.assertIn('clear all', names)
+        self.assertEqual(len(names), 4 + 2 + 1)
+        self.assertEqual(len(self.model.htm_options(all_primitives=True)),
+                         self.model.n_actions + 2 + 1)
+
+    def test_executes_options(self):
+        s = self.model.sample_start()
+        for _ in range(10):
+            a = self.model.actions.index(self.policy.get_action())
+            s, o, _ = self.model.sample_transition(a, s)
+            self.policy.step(self.model.observations[o])
+        self.assertEqual(len(self.policy.history), 20)
+        # Each terminated option is a step of the search runner
+        n_options = len(self.policy.runner.history) // 2
+        self.assertGreater(n_options, 0)
+        self.assertLessEqual(n_options, 10)
+        self.policy.reset()
+        self.assertEqual(self.policy.history, [])
+        self.assertEqual(self.policy.runner.history, [])
+
+    def test_only_searches_when_choosing_options(self):
+        option = self.model.htm_options()[4]
+        self.policy.runner.get_action = lambda **kwargs: option.name
+        self.policy.runner.step = lambda o: None
+        self.assertEqual(self.policy.get_action(), 'bring top')
+        self.policy.step('none')
+        self.assertEqual(self.policy.last_iterations, 0)
+        self.assertIsNone(self.policy._option)
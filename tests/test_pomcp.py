@@ -1,12 +1,25 @@
+import io
+import os
+import sys
+import tempfile
+import threading
+import json
 from unittest import TestCase, skip
 
 import numpy as np
 
 from task_models.lib.pomdp import POMDP
+from task_models.lib.utils import BufferedRandom
 from task_models.lib.pomcp import (
     _SearchNode, _SearchObservationNode, _SearchActionNode, _SearchTree,
-    ArrayBelief, ParticleBelief, POMCPPolicyRunner, NTransitionsHorizon,
-    Horizon, _ValueAverage)
+    _ArraySearchTree, _ObservationLookupSearchTree, ArrayBelief,
+    ParticleBelief, POMCPPolicyRunner, AsyncPOMCPPolicyRunner,
+    NTransitionsHorizon, Horizon, _ValueAverage, TabularRolloutPolicy,
+    RolloutCache, SearchProfile, _get_action_after_exploration,
+    export_pomcp, QMDPPrior, SharedSearchTree, SharedTreeRunner,
+    compile_policy, TreePolicy, TreePolicyRunner)
+from task_models.lib.pomdp import GraphPolicyRunner
+from task_models.lib.belief import SuccessorCache, SparseBelief
 
 
 class TestSearchNode(TestCase):
@@ -90,6 +103,34 @@ class TestSearchObservationNode(TestCase):
         self.node._avg.n_simulations = 9
         self.assertEqual(self.node.get_best_action(), 3)
 
+    def test_get_best_action_max_children(self):
+        self.node.safe_get_child(4).update(0)
+        self.node._avg.n_simulations = 1
+        self.assertEqual(self.node.get_best_action(max_children=1), 4)
+        self.assertNotEqual(self.node.get_best_action(max_children=2), 4)
+
+    def test_get_best_action_exploit(self):
+        self.assertIn(self.node.get_best_action(exploit=True), range(10))
+        self.node.safe_get_child(4).update(1.)
+        self.node.safe_get_child(6).update(3.)
+        self.node._avg.n_simulations = 2
+        for _ in range(10):  # Unexplored actions are never returned
+            self.assertEqual(self.node.get_best_action(exploit=True), 6)
+
+    def test_get_best_action_mask(self):
+        mask = np.zeros((10,), dtype=bool)
+        mask[[2, 5]] = True
+        for _ in range(10):
+            self.assertIn(self.node.get_best_action(mask=mask), [2, 5])
+            self.assertIn(self.node.get_best_action(exploit=True, mask=mask),
+                          [2, 5])
+        for i in range(10):
+            self.node.safe_get_child(i).update(0)
+        self.node._avg.n_simulations = 10
+        self.node.children[7].update(10)
+        self.assertEqual(self.node.get_best_action(), 7)
+        self.assertIn(self.node.get_best_action(mask=mask), [2, 5])
+
     def test_get_best_action_is_best(self):
         for i in range(10):
             c = self.node.safe_get_child(i)
@@ -134,6 +175,17 @@ class TestSearchObservationNode(TestCase):
         a = self.node.get_best_action()
         self.assertEqual(a, best)
 
+    def test_children_statistics_are_updated_in_place(self):
+        c = self.node.safe_get_child(4)
+        c.update(2.)
+        c.update(4.)
+        self.assertEqual(self.node._child_visits[4], 2)
+        self.assertEqual(self.node._child_totals[4], c._avg.total_value)
+        self.assertIsInstance(c.n_simulations, int)
+        self.assertIsInstance(c.value, float)
+        np.testing.assert_array_equal(self.node._not_init_children(),
+                                      [0, 1, 2, 3, 5, 6, 7, 8, 9])
+
     def test_str(self):
         self.node.safe_get_child(2).children[1] = _SearchNode()
         self.assertEqual(str(self.node), "[2: [1: []]]")
@@ -221,6 +273,36 @@ class _FakeModel:
         self.successors_history = []
 
 
+class _FakeBatchModel:
+
+    discount = .5
+    n_actions = 3
+
+    def sample_transitions(self, a, s):
+        return s + 1, np.zeros(s.shape, dtype=int), np.ones(s.shape)
+
+
+class TestRolloutCache(TestCase):
+
+    def test_get_needs_samples(self):
+        cache = RolloutCache(n_samples=2)
+        self.assertIsNone(cache.get('a'))
+        cache.add('a', 1.)
+        self.assertIsNone(cache.get('a'))
+        cache.add('a', 2.)
+        self.assertEqual(cache.get('a'), 1.5)
+
+    def test_evicts_least_recently_used(self):
+        cache = RolloutCache(max_size=2, n_samples=1)
+        cache.add('a', 1.)
+        cache.add('b', 2.)
+        cache.get('a')
+        cache.add('c', 3.)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+
 class TestSearchTree(TestCase):
 
     def setUp(self):
@@ -238,6 +320,9 @@ class TestSearchTree(TestCase):
         self.assertIsInstance(tree.root.belief, ParticleBelief)
         self.assertEqual(tree.root.belief.n_particles, 37)
         self.assertEqual(tree.root.belief.n_states, 10)
+        tree = _SearchTree(self.model, 3, 1., belief='sparse')
+        self.assertIsInstance(tree.root.belief, SparseBelief)
+        np.testing.assert_array_equal(tree.root.belief.states, [9])
 
     def test_get_node(self):
         ca = self.tree.root.safe_get_child(0)
@@ -305,6 +390,56 @@ class TestSearchTree(TestCase):
         self.assertEqual(str(self.tree.root), "[{}: [1: []]]".format(a))
         self.assertEqual(self.tree.root.n_simulations, 1)
 
+    def test_simulate_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 10
+        pomdp = POMDP(np.ones((1, 1, 1)), np.ones((1, 1, 1)),
+                      np.ones((1, 1, 1, 1)), np.ones((1,)), 1.)
+        tree = _SearchTree(pomdp, NTransitionsHorizon.generator(
+            pomdp, n=depth + 2), 1.)
+        node = tree.root
+        for _ in range(depth):  # Chain of already visited nodes
+            node.update(0.)
+            child = node.safe_get_child(0)
+            child.update(0.)
+            child.children[0] = tree._observation_node_for_belief(
+                node.belief)
+            node = child.children[0]
+        tree.simulate_from_node(tree.root)
+        self.assertEqual(tree.root.n_simulations, 2)
+        self.assertEqual(node.n_simulations, 1)  # Rollout from leaf
+
+    def test_to_dict_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 10
+        pomdp = POMDP(np.ones((1, 1, 1)), np.ones((1, 1, 1)),
+                      np.ones((1, 1, 1, 1)), np.ones((1,)), 1.)
+        tree = _SearchTree(pomdp, NTransitionsHorizon.generator(pomdp), 1.)
+        node = tree.root
+        for _ in range(depth):
+            node.update(0.)
+            child = node.safe_get_child(0)
+            child.update(0.)
+            child.children[0] = tree._observation_node_for_belief(
+                node.belief)
+            node = child.children[0]
+        for as_policy in (False, True):
+            d = tree.to_dict(as_policy=as_policy)
+            for _ in range(depth if as_policy else 2 * depth):
+                self.assertEqual(len(d['children']), 1)
+                d = d['children'][0]
+            self.assertEqual(d['children'], [])
+
+    def test_horizon_is_reused(self):
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=1)
+        self.model.transitions = [(1, 1, 11.), (2, 0, 13.)]
+        self.model.successors = [self.start]
+        self.tree.simulate_from_node(self.tree.root)
+        h = self.tree._horizon[1]
+        self.assertTrue(h.is_reached())
+        self.assertIs(self.tree._new_horizon(), h)
+        self.assertEqual(h.n, 1)
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=2)
+        self.assertEqual(self.tree._new_horizon().n, 2)
+
     def test_simulate_from_node_with_horizon_3(self):
         self.model.discount = 1.
         belief = np.zeros((10))
@@ -357,6 +492,194 @@ class TestSearchTree(TestCase):
         self.assertEqual(self.tree.get_node([1, 1, a1, 0])._avg.total_value, 5.)
         self.assertEqual(self.tree.get_node([1, 0])._avg.total_value, 7.)
 
+    def test_counts_nodes(self):
+        self.assertEqual(self.tree.n_nodes, 1)
+        self.assertEqual(self.tree.n_bytes, self.tree._node_nbytes(
+            self.tree.root.belief))
+        self.model.successors = [self.start]
+        self.tree.get_node([0, 1])
+        self.assertEqual(self.tree.n_nodes, 2)
+
+    def test_does_not_expand_when_full(self):
+        self.tree.max_nodes = 1
+        self.model.transitions = [(1, 1, 11.), (2, 0, 13.)]
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=2)
+        self.tree.simulate_from_node(self.tree.root)
+        a = self.model.transitions_history[0][0]
+        self.assertEqual(str(self.tree.root), "[{}: []]".format(a))
+        self.assertEqual(self.tree.root.value, 11. + .9 * 13.)
+        self.assertEqual(len(self.model.successors_history), 0)
+        self.assertEqual(self.tree.n_nodes, 1)
+
+    def test_widening(self):
+        self.tree.widening = (1., 0.)
+        self.model.transitions = [(1, 1, 11.), (2, 0, 13.)]
+        self.model.successors = [self.start]
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=1)
+        self.tree.simulate_from_node(self.tree.root, action=0)
+        self.tree.simulate_from_node(self.tree.root, action=0)
+        self.assertEqual(str(self.tree.root), "[0: [1: []]]")
+        self.assertEqual(len(self.model.successors_history), 1)
+        self.assertEqual(self.tree.get_node([0, 1]).n_simulations, 0)
+        self.assertEqual(self.tree.root.value, 12.)
+
+    def test_save_load(self):
+        self.model.successors = [self.start] * 3
+        self.tree.get_node([0, 1, 2, 0]).update(3.)
+        self.tree.get_node([0, 0]).update(1.)
+        self.tree.get_node([0]).update(2.)
+        self.tree.root.update(2.)
+        f = io.BytesIO()
+        self.tree.save(f)
+        f.seek(0)
+        tree = _SearchTree(self.model, 3, 1., node_params={'alpha': 0.})
+        tree.load(f)
+        self.assertEqual(str(tree.root), str(self.tree.root))
+        self.assertEqual(tree.n_nodes, 4)
+        self.assertEqual(tree.get_node([0, 1, 2, 0]).n_simulations, 1)
+        self.assertEqual(tree.get_node([0]).value, 2.)
+        self.assertEqual(tree.root.children[0].n_simulations, 1)
+
+    def test_save_load_particles(self):
+        tree = _SearchTree(self.model, 3, 1., belief='particle',
+                           belief_params={'n_particles': 5})
+        f = io.BytesIO()
+        tree.save(f)
+        f.seek(0)
+        loaded = _ArraySearchTree(self.model, 3, 1., belief='particle',
+                                  belief_params={'n_particles': 5})
+        loaded.load(f)
+        np.testing.assert_array_equal(loaded.root.belief.part_states,
+                                      tree.root.belief.part_states)
+
+    def test_save_load_sparse(self):
+        tree = _SearchTree(self.model, 3, 1., belief='sparse')
+        tree.root.belief = SparseBelief([2, 4, 5], [.2, .3, .5], 10)
+        f = io.BytesIO()
+        tree.save(f)
+        f.seek(0)
+        loaded = _ArraySearchTree(self.model, 3, 1., belief='sparse')
+        loaded.load(f)
+        self.assertEqual(loaded.root.belief, tree.root.belief)
+
+    def test_load_particles_keeps_update(self):
+        tree = _SearchTree(self.model, 3, 1., belief='particle',
+                           belief_params={'n_particles': 5})
+        f = io.BytesIO()
+        tree.save(f)
+        f.seek(0)
+        loaded = _SearchTree(self.model, 3, 1., belief='particle',
+                             belief_params={'n_particles': 8,
+                                            'update': 'weighted'})
+        loaded.load(f)
+        self.assertEqual(loaded.root.belief.n_particles, 5)
+        self.assertEqual(loaded.root.belief.update, 'weighted')
+
+    def test_load_checks_actions(self):
+        f = io.BytesIO()
+        self.tree.save(f)
+        f.seek(0)
+        tree = _SearchTree(_FakeModel(self.start, 4, 2), 3, 1.)
+        with self.assertRaises(ValueError):
+            tree.load(f)
+
+    def test_action_widening(self):
+        self.tree.action_widening = (1., 0.)
+        self.model.transitions = [(1, 1, 1.)] * 5
+        self.model.successors = [self.start]
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=1)
+        for _ in range(5):
+            self.tree.simulate_from_node(self.tree.root)
+        self.assertEqual(len(self.tree.root._children_keys()), 1)
+        self.assertEqual(self.tree.root.n_simulations, 5)
+
+    def test_prune(self):
+        self.model.successors = [self.start] * 4
+        keep = self.tree.get_node([0, 0, 1, 0])
+        self.tree.get_node([0, 1])
+        self.tree.get_node([1, 0]).update(1.)
+        self.assertEqual(self.tree.n_nodes, 5)
+        self.tree.max_nodes = 5
+        self.tree.prune(keep=keep, ratio=1.)
+        self.assertEqual(str(self.tree.root),
+                         "[0: [0: [1: [0: []]]], 1: [0: []]]")
+        self.assertEqual(self.tree.n_nodes, 4)
+        self.assertEqual(self.tree.n_pruned, 1)
+        self.tree.max_nodes = 2  # Can not prune ancestors of keep
+        self.tree.prune(keep=keep)
+        self.assertEqual(str(self.tree.root), "[0: [0: [1: [0: []]]], 1: []]")
+        self.assertEqual(self.tree.n_nodes, 3)
+        self.assertEqual(self.tree.n_pruned, 2)
+        self.assertIs(self.tree.get_node([0, 0, 1, 0]), keep)
+
+    def test_set_root(self):
+        self.model.successors = [self.start] * 3
+        node = self.tree.get_node([0, 1])
+        node.safe_get_child(2)
+        self.tree.get_node([0, 1, 2, 0])
+        self.tree.get_node([1, 0])
+        self.tree.set_root(node)
+        self.assertIs(self.tree.root, node)
+        self.assertIs(self.tree.get_node([]), node)
+        self.assertEqual(str(self.tree.root), "[2: [0: []]]")
+        self.assertEqual(self.tree.n_nodes, 2)
+
+    def test_reset_root(self):
+        self.model.successors = [self.start]
+        self.tree.get_node([0, 1])
+        self.tree.reset_root()
+        self.assertEqual(str(self.tree.root), "[]")
+        self.assertEqual(self.tree.n_nodes, 1)
+        np.testing.assert_array_equal(self.tree.root.belief.array, self.start)
+
+    def test_batch_rollouts(self):
+        self.tree.model = _FakeBatchModel()
+        horizons = [NTransitionsHorizon(n) for n in (0, 1, 3)]
+        returns = self.tree._batch_rollouts([0, 4, 2], horizons)
+        np.testing.assert_array_equal(returns, [0., 1., 1.75])
+        self.assertTrue(all([h.is_reached() for h in horizons]))
+
+    def test_rollout_from_node_batch_rollouts(self):
+        self.model.sample_transitions = _FakeBatchModel().sample_transitions
+        tree = _SearchTree(self.model, 3, 1., node_params={'alpha': 0.},
+                           rollout_it=10, batch_rollouts=True)
+        self.assertAlmostEqual(
+            tree.rollout_from_node(tree.root, NTransitionsHorizon(n=2)),
+            1.9)
+        self.assertEqual(len(self.model.transitions_history), 0)
+        self.assertEqual(tree.root.n_simulations, 1)
+
+    def test_batch_rollouts_needs_model_support(self):
+        tree = _SearchTree(self.model, 3, 1., batch_rollouts=True)
+        self.assertFalse(tree.batch_rollouts)
+
+    def test_rollout_policy(self):
+        self.tree.rollout_policy = TabularRolloutPolicy(self.model, [2] * 10)
+        self.model.transitions = [(1, None, 1.), (2, None, 1.)]
+        self.tree._one_rollout_from_node(3, NTransitionsHorizon(2))
+        self.assertEqual(self.model.transitions_history, [(2, 3), (2, 1)])
+
+    def test_rollout_policy_batch(self):
+        self.tree.model = _FakeBatchModel()
+        policy = TabularRolloutPolicy(self.model, [0, 1, 2, 0, 1, 2])
+        self.assertEqual(policy.actions(np.array([1, 5])).tolist(), [1, 2])
+        self.tree.rollout_policy = policy
+        returns = self.tree._batch_rollouts([0, 4], [NTransitionsHorizon(2),
+                                                     NTransitionsHorizon(1)])
+        np.testing.assert_array_equal(returns, [1.5, 1.])
+
+    def test_rollout_cache(self):
+        self.tree.rollout_cache = RolloutCache(n_samples=2)
+        self.model.transitions = [(1, None, 1.), (1, None, 3.)]
+        self.assertEqual(
+            self.tree._one_rollout_from_node(3, NTransitionsHorizon(1)), 1.)
+        self.assertEqual(
+            self.tree._one_rollout_from_node(3, NTransitionsHorizon(1)), 3.)
+        self.assertEqual(
+            self.tree._one_rollout_from_node(3, NTransitionsHorizon(1)), 2.)
+        self.assertEqual(len(self.model.transitions_history), 2)
+        self.assertIn((3, 1), self.tree.rollout_cache)
+
     def test_rollout_from_node_multiple_rollouts(self):
         self.tree.rollout_it = 10
         self.model.transitions = [(1, 1, 11.)] * 10
@@ -368,6 +691,201 @@ class TestSearchTree(TestCase):
         self.assertEqual(self.tree.root.n_simulations, 1)
 
 
+class TestObservationLookupSearchTree(TestCase):
+
+    def setUp(self):
+        self.start = np.zeros((10,))
+        self.start[-1] = 1.
+        self.model = _FakeModel(self.start, 3, 2)
+
+    def test_shares_nodes_for_equal_beliefs(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1.)
+        b = np.zeros((10,))
+        b[1] = 1.
+        self.model.successors = [b, b.copy()]
+        self.assertIs(tree.get_node([0, 1]), tree.get_node([1, 0]))
+        self.assertEqual(tree.n_nodes, 2)
+
+    def test_tolerance(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1., tolerance=.1)
+        self.model.successors = [np.array([0.] * 8 + [.51, .49]),
+                                 np.array([0.] * 8 + [.49, .51]),
+                                 np.array([0.] * 8 + [.3, .7])]
+        n = tree.get_node([0, 1])
+        self.assertIs(tree.get_node([1, 0]), n)
+        self.assertIsNot(tree.get_node([2, 0]), n)
+        self.assertEqual(tree.n_nodes, 3)
+
+    def test_map_with_cycle(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1.)
+        self.model.successors = [self.start]
+        self.assertIs(tree.get_node([0, 1]), tree.root)
+        d = tree.map(lambda n: {})
+        self.assertEqual(d, {'children': [{'children': [{'children': []}]}]})
+
+    def test_save_load_shared_nodes(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1.)
+        self.model.successors = [self.start]
+        tree.get_node([0, 1]).update(1.)
+        f = io.BytesIO()
+        tree.save(f)
+        f.seek(0)
+        loaded = _ObservationLookupSearchTree(self.model, 3, 1.)
+        loaded.load(f)
+        self.assertIs(loaded.get_node([0, 1]), loaded.root)
+        self.assertEqual(loaded.root.n_simulations, 1)
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            _SearchTree(self.model, 3, 1.).load(f)
+
+    def _beliefs(self, n):
+        return [np.eye(10)[i] for i in range(n)]
+
+    def test_set_root_removes_unreachable_entries(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1.)
+        self.model.successors = self._beliefs(3)
+        n1 = tree.get_node([0, 0])
+        tree.get_node([1, 0])
+        tree.get_node([0, 0, 0, 1])
+        self.assertEqual(len(tree._obs_nodes), 4)
+        tree.set_root(n1)
+        self.assertEqual(len(tree._obs_nodes), 2)
+        self.assertEqual(set(map(id, tree._obs_nodes.values())),
+                         set(map(id, tree._iterate_observation_nodes())))
+
+    def test_max_lookup(self):
+        tree = _ObservationLookupSearchTree(self.model, 3, 1., max_lookup=2)
+        b = self._beliefs(3)
+        self.model.successors = b + [b[2].copy(), b[0].copy()]
+        n0 = tree.get_node([0, 0])
+        tree.get_node([1, 0])
+        self.assertEqual(len(tree._obs_nodes), 2)  # Root is forgotten
+        tree.get_node([2, 0])
+        # Recently used node is still shared, the oldest one is not
+        self.assertIs(tree.get_node([1, 0, 0, 0]), tree.get_node([2, 0]))
+        self.assertIsNot(tree.get_node([1, 0, 1, 0]), n0)
+        self.assertIs(tree.get_node([0, 0]), n0)  # Still in the tree
+        self.assertLessEqual(len(tree._obs_nodes), 2)
+
+    def test_particle_belief_needs_tolerance(self):
+        with self.assertRaises(ValueError):
+            _ObservationLookupSearchTree(self.model, 3, 1., belief='particle')
+        tree = _ObservationLookupSearchTree(
+            self.model, 3, 1., belief='particle', tolerance=.1,
+            belief_params={'n_particles': 7})
+        self.assertIsInstance(tree.root.belief, ParticleBelief)
+        self.assertEqual(tree.root.belief.n_particles, 7)
+        self.assertIn(tree.root.belief.signature(.1), tree._obs_nodes)
+
+
+class TestArraySearchTree(TestCase):
+
+    def setUp(self):
+        self.start = np.zeros((10,))
+        self.start[-1] = 1.
+        self.model = _FakeModel(self.start, 3, 2)
+        self.tree = _ArraySearchTree(self.model, 3, 1., capacity=1,
+                                     node_params={'alpha': 0.})
+
+    def test_root(self):
+        self.assertIsInstance(self.tree.root, _SearchObservationNode)
+        self.assertIsInstance(self.tree.root.belief, ArrayBelief)
+        self.assertEqual(self.tree.root.n_simulations, 0)
+        self.assertEqual(self.tree.root.children, [None, None, None])
+
+    def test_get_node_creates_child(self):
+        b = np.zeros((10,))
+        b[1] = 1.
+        self.model.successors = [b, b]
+        n = self.tree.get_node([0, 1, 2])
+        self.assertIsInstance(n, _SearchActionNode)
+        n = self.tree.get_node([0, 1, 2, 0])
+        self.assertIsInstance(n, _SearchObservationNode)
+        np.testing.assert_array_equal(n.belief.array, b)
+        self.assertEqual(self.tree.n_nodes, 3)
+        self.assertEqual(str(self.tree.root), "[0: [1: [2: [0: []]]]]")
+        with self.assertRaises(IndexError):
+            self.tree.get_node([3])
+
+    def test_simulate_from_node_with_horizon_1(self):
+        self.model.transitions = [(1, 1, 11.)]
+        belief2 = np.zeros((10))
+        belief2[1] = 1.
+        self.model.successors = [belief2]
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=1)
+        self.tree.simulate_from_node(self.tree.root)
+        a = self.model.transitions_history[0][0]
+        self.assertEqual(str(self.tree.root), "[{}: [1: []]]".format(a))
+        self.assertEqual(self.tree.root.n_simulations, 1)
+        self.assertEqual(self.tree.root.value, 11.)
+        self.assertEqual(self.tree.get_node([a]).value, 11.)
+        self.assertEqual(self.tree.get_node([a, 1]).n_simulations, 0)
+
+    def test_set_root(self):
+        self.model.successors = [self.start] * 5
+        self.tree.get_node([0, 1, 2, 0]).update(3.)
+        self.tree.get_node([0, 1, 2, 1]).update(2.)
+        self.tree.get_node([0, 1, 1, 1])
+        self.tree.get_node([1, 0])
+        node = self.tree.get_node([0, 1])
+        self.tree.set_root(node)
+        self.assertEqual(self.tree.n_nodes, 4)
+        self.assertEqual(str(self.tree.root), "[1: [1: []], 2: [0: [], 1: []]]")
+        self.assertEqual(self.tree.get_node([2, 0]).value, 3.)
+        self.assertEqual(self.tree.get_node([2, 1]).value, 2.)
+        self.model.successors = [self.start]
+        self.tree.get_node([0, 0])
+        self.assertEqual(self.tree.n_nodes, 5)
+
+    def test_same_as_node_tree(self):
+        s, a, o = 5, 3, 2
+        T = np.random.dirichlet(np.ones((s,)), (a, s))
+        O = np.random.dirichlet(np.ones((o,)), (a, s))
+        R = np.random.random((a, s, s, o))
+        start = np.random.dirichlet(np.ones((s)))
+        pomdp = POMDP(T, O, R, start, .9)
+        dicts = []
+        for tree in ('nodes', 'arrays'):
+            np.random.seed(42)
+            policy = POMCPPolicyRunner(pomdp, iterations=100, horizon=4,
+                                       tree=tree)
+            policy.get_action()
+            dicts.append(policy.tree.to_dict())
+        self.assertEqual(dicts[0], dicts[1])
+
+    def test_no_belief_values(self):
+        with self.assertRaises(ValueError):
+            POMCPPolicyRunner(self.model, tree='arrays', belief_values=True)
+
+    def test_widening(self):
+        self.tree.widening = (1., 0.)
+        self.model.transitions = [(1, 1, 11.), (2, 0, 13.)]
+        self.model.successors = [self.start]
+        self.tree.horizon_gen = NTransitionsHorizon.generator(self.model, n=1)
+        self.tree.simulate_from_node(self.tree.root, action=0)
+        self.tree.simulate_from_node(self.tree.root, action=0)
+        self.assertEqual(str(self.tree.root), "[0: [1: []]]")
+        self.assertEqual(len(self.model.successors_history), 1)
+        self.assertEqual(self.tree.root.n_simulations, 2)
+
+    def test_save_load(self):
+        self.model.successors = [self.start] * 4
+        self.tree.get_node([0, 1, 2, 0]).update(3.)
+        self.tree.get_node([0, 1, 2, 1]).update(2.)
+        self.tree.get_node([1, 0])
+        f = io.BytesIO()
+        self.tree.save(f)
+        f.seek(0)
+        tree = _SearchTree(self.model, 3, 1.)  # Loads into node tree
+        tree.load(f)
+        self.assertEqual(str(tree.root), str(self.tree.root))
+        self.assertEqual(tree.n_nodes, 5)
+        self.assertEqual(tree.get_node([0, 1, 2, 1]).value, 2.)
+        f.seek(0)
+        self.tree.load(f)
+        self.assertEqual(str(tree.root), str(self.tree.root))
+
+
 class TestPOMCPPolicyRunner(TestCase):
 
     def setUp(self):
@@ -388,6 +906,29 @@ class TestPOMCPPolicyRunner(TestCase):
         a = self.policy.get_action()
         self.assertIn(a, self.pomdp.actions)
 
+    def test_get_action_reports_iterations(self):
+        self.policy.get_action()
+        self.assertEqual(self.policy.last_iterations, 20)
+        self.assertEqual(self.policy.tree.root.n_simulations, 20)
+        self.policy.get_action(iterations=7)
+        self.assertEqual(self.policy.last_iterations, 7)
+
+    def test_get_action_time_budget(self):
+        self.policy.get_action(time_budget=.05)
+        n = self.policy.last_iterations
+        self.assertGreaterEqual(n, self.pomdp.n_actions)
+        self.assertEqual(self.policy.tree.root.n_simulations, n)
+        self.assertGreaterEqual(self.policy.last_elapsed, .05)
+        self.assertLess(self.policy.last_elapsed, .5)
+
+    def test_time_budget_min_iterations(self):
+        policy = POMCPPolicyRunner(self.pomdp, horizon=5, time_budget=0.,
+                                   min_iterations=13)
+        self.assertIn(policy.get_action(), self.pomdp.actions)
+        self.assertEqual(policy.last_iterations, 13)
+        policy.get_action(iterations=2)  # Explicit iterations are used
+        self.assertEqual(policy.last_iterations, 2)
+
     def test_step_updates_history(self):
         self.policy.get_action()
         self.policy.history = [0, 1]  # Note: Might fail if '1' unobserved
@@ -395,6 +936,18 @@ class TestPOMCPPolicyRunner(TestCase):
         self.policy.step(True)
         self.assertEqual(self.policy.history, [0, 1, a, 0])
 
+    def test_reroot(self):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                   reroot=True)
+        policy.get_action()
+        policy.step(True)
+        self.assertIs(policy._node, policy.tree.root)
+        self.assertEqual(len(policy.history), 2)
+        policy.get_action()
+        policy.reset()
+        self.assertIs(policy._node, policy.tree.root)
+        self.assertEqual(policy.tree.n_nodes, 1)
+
     def test_horizon_generator_is_one(self):
         # Default, from int
         h = self.policy.tree.horizon_gen()
@@ -408,6 +961,490 @@ class TestPOMCPPolicyRunner(TestCase):
         self.assertIsInstance(h, NTransitionsHorizon)
         self.assertEqual(h.n, 13)
 
+    def test_profile(self):
+        self.assertIsNone(self.policy.tree.profile)
+        self.policy.get_action()
+        self.assertIsNone(self.policy.last_profile)
+        policy = POMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                   profile=True)
+        policy.get_action()
+        profile = policy.last_profile
+        self.assertEqual(set(profile['times']), set(SearchProfile.PHASES))
+        self.assertTrue(all(t >= 0 for t in profile['times'].values()))
+        counts = profile['counts']
+        self.assertEqual(counts['simulations'], 20)
+        self.assertEqual(counts['new_nodes'], policy.tree.n_nodes - 1)
+        self.assertGreater(counts['rollout_steps'], 0)
+        # Each simulation samples 5 transitions, in the tree or in rollouts
+        self.assertEqual(counts['simulator_calls'], 100)
+        policy.get_action(iterations=7)  # Profile is for last call only
+        self.assertEqual(policy.last_profile['counts']['simulations'], 7)
+
+    def test_profile_counts_belief_update_calls(self):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                   belief='particle', profile=True)
+        calls = []
+        sample_transition = self.pomdp.sample_transition
+
+        def counted(a, s):
+            calls.append(a)
+            return sample_transition(a, s)
+
+        self.pomdp.sample_transition = counted
+        policy.get_action()
+        counts = policy.last_profile['counts']
+        self.assertGreater(counts['simulator_calls'], 100)
+        self.assertEqual(counts['simulator_calls'], len(calls))
+
+    def test_sparse_belief(self):
+        for tree in ['nodes', 'arrays']:
+            policy = POMCPPolicyRunner(self.pomdp, iterations=50, horizon=3,
+                                       tree=tree, belief='sparse')
+            policy.get_action()
+            node = policy.tree.get_node([2, 0])
+            self.assertIsInstance(node.belief, SparseBelief)
+            np.testing.assert_allclose(
+                node.belief.array,
+                self.pomdp.belief_update(2, 0, self.pomdp.start))
+
+    def test_successor_cache(self):
+        cache = SuccessorCache()
+        for tree in ['nodes', 'arrays']:
+            policy = POMCPPolicyRunner(
+                self.pomdp, iterations=50, horizon=3, tree=tree,
+                tree_params={'successor_cache': cache})
+            policy.get_action()
+            self.assertIs(policy.tree.successor_cache, cache)
+        # The second tree reuses the updates of the first one
+        self.assertGreater(cache.hits, 0)
+        self.assertGreater(len(cache), 0)
+        node = policy.tree.get_node([0, 1])
+        np.testing.assert_allclose(
+            node.belief.array,
+            self.pomdp.belief_update(0, 1, self.pomdp.start))
+        with self.assertRaises(ValueError):
+            POMCPPolicyRunner(self.pomdp, iterations=50, horizon=3,
+                              belief='particle',
+                              tree_params={'successor_cache': cache})
+
+    def test_get_action_with_action_widening_exploits(self):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=30, horizon=5,
+                                   tree_params={'action_widening': (1, .1)})
+        for _ in range(5):
+            a = self.pomdp.actions.index(policy.get_action())
+            node = policy.tree.root
+            visited = np.flatnonzero(node._child_visits)
+            self.assertLess(len(visited), self.pomdp.n_actions)
+            values = node._child_totals[visited] / node._child_visits[visited]
+            self.assertEqual(a, visited[np.argmax(values)])
+
+    def test_random_source_is_reproducible(self):
+        def tree_dict(seed):
+            rng = BufferedRandom(seed)
+            self.pomdp.rng = rng
+            policy = POMCPPolicyRunner(self.pomdp, iterations=30, horizon=5)
+            self.assertIs(policy.tree.rng, rng)
+            self.assertIs(policy.tree.root.belief.rng, rng)
+            policy.get_action()
+            return policy.tree.to_dict()
+
+        self.assertEqual(tree_dict(5), tree_dict(5))
+        self.pomdp.rng = None
+        self.assertIs(POMCPPolicyRunner(self.pomdp).tree.rng, np.random)
+
+    def _export(self, **kwargs):
+        f = io.StringIO()
+        export_pomcp(self.policy, f, **kwargs)
+        return json.loads(f.getvalue())
+
+    def test_export_pomcp(self):
+        self.policy.get_action(iterations=100)
+        np.random.seed(3)  # Best actions of unexplored nodes are random
+        d = self._export()
+        np.random.seed(3)
+        self.assertEqual(d['graphs'], [self.policy.tree.to_dict(
+            as_policy=True)])
+        self.assertEqual(d['actions'], self.pomdp.actions)
+        self.assertEqual(d['exploration'], self.policy.tree.exploration)
+
+    def test_export_pomcp_belief_values(self):
+        self.policy = POMCPPolicyRunner(self.pomdp, iterations=100,
+                                        horizon=5, belief_values=True)
+        self.policy.get_action()
+        self.assertTrue(self.policy.tree._shares_nodes)
+        np.random.seed(3)
+        d = self._export()
+        np.random.seed(3)
+        self.assertEqual(d['graphs'], [self.policy.tree.to_dict(
+            as_policy=True)])
+
+    def test_export_pomcp_cutoffs(self):
+        self.policy.get_action(iterations=100)
+
+        def depth(node):
+            return 1 + max([depth(c) for c in node['children']] + [-1])
+
+        def min_visits(node):
+            return min([node['visits']] +
+                       [min_visits(c) for c in node['children']])
+
+        self.assertGreater(depth(self._export()['graphs'][0]), 1)
+        root = self._export(max_depth=1)['graphs'][0]
+        self.assertEqual(depth(root), 1)
+        self.assertEqual(len(root['children']), len(root['observations']))
+        self.assertGreaterEqual(
+            min_visits(self._export(min_visits=5)['graphs'][0]), 5)
+
+
+class TestActionPrior(TestCase):
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((4,)), (3, 4))
+        O = np.random.dirichlet(np.ones((2,)), (3, 4))
+        R = np.random.random((3, 4, 4, 2))
+        R[1] += 1.  # Action b is the best
+        start = np.random.dirichlet(np.ones((4)))
+        self.pomdp = POMDP(T, O, R, start, .9, states=range(4),
+                           actions=['a', 'b', 'c'],
+                           observations=[True, False])
+        self.prior = QMDPPrior(self.pomdp, n_visits=5)
+
+    def test_qmdp_values(self):
+        b = ArrayBelief(self.pomdp.start)
+        np.testing.assert_allclose(
+            self.prior.values(b),
+            self.pomdp.mdp_q_values().dot(self.pomdp.start))
+        self.assertEqual(np.argmax(self.prior.values(b)), 1)
+
+    def _policy(self, iterations=30, **kwargs):
+        return POMCPPolicyRunner(self.pomdp, iterations=iterations, horizon=3,
+                                 tree_params={'prior': self.prior}, **kwargs)
+
+    def test_new_nodes_have_prior(self):
+        for kwargs in [{}, {'tree': 'arrays'}, {'belief_values': True}]:
+            policy = self._policy(**kwargs)
+            root = policy.tree.root
+            self.assertEqual(root.n_simulations, 15)
+            self.assertEqual([c.n_simulations for c in root.children],
+                             [5, 5, 5])
+            values = self.prior.values(root.belief)
+            np.testing.assert_allclose([c.value for c in root.children],
+                                       values)
+            self.assertAlmostEqual(root.value, values.mean())
+            policy.get_action()
+            self.assertEqual(root.n_simulations, 45)
+            node = policy.tree.get_node([1, 0])
+            self.assertGreaterEqual(node.n_simulations, 15)
+            self.assertTrue(all(c.n_simulations >= 5 for c in node.children))
+
+    def test_search_starts_from_best_prior_action(self):
+        policy = self._policy(exploration=0.)
+        policy.get_action(iterations=1)
+        self.assertEqual(list(policy.tree.root._child_visits), [5, 6, 5])
+
+    def test_no_warning_for_few_iterations(self):
+        messages = []
+        self._policy(logger=messages.append, iterations=1)
+        self.assertEqual(messages, [])
+
+    def test_load_keeps_saved_statistics(self):
+        policy = self._policy(tree='arrays')
+        policy.get_action()
+        f = io.BytesIO()
+        policy.save_tree(f)
+        f.seek(0)
+        loaded = self._policy(tree='arrays')
+        loaded.load_tree(f)
+        self.assertEqual(loaded.tree.root.n_simulations,
+                         policy.tree.root.n_simulations)
+        self.assertEqual(loaded.tree.n_nodes, policy.tree.n_nodes)
+
+
+class TestLegalActions(TestCase):
+
+    class MaskedPOMDP(POMDP):
+
+        # Action 2 is only legal from state 0
+        def legal_actions(self, s):
+            return np.array([True, True, s == 0])
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((4,)), (3, 4))
+        T[:, :, 0] = 0.  # State 0 is never reached
+        T /= T.sum(-1, keepdims=True)
+        O = np.ones((3, 4, 2)) * .5
+        R = np.random.random((3, 4, 4, 2))
+        start = np.array([0., .2, .3, .5])
+        self.pomdp = self.MaskedPOMDP(T, O, R, start, 1, states=range(4),
+                                      actions=['a', 'b', 'c'],
+                                      observations=[True, False])
+        self.actions = []
+        sample_transition = self.pomdp.sample_transition
+
+        def recorded(a, s):
+            self.actions.append(a)
+            return sample_transition(a, s)
+
+        self.pomdp.sample_transition = recorded
+
+    def test_requires_model_legal_actions(self):
+        with self.assertRaises(ValueError):
+            POMCPPolicyRunner(POMDP(self.pomdp.T, self.pomdp.O, self.pomdp.R,
+                                    self.pomdp.start, 1),
+                              tree_params={'legal_actions': True})
+
+    def test_illegal_actions_are_never_used(self):
+        for tree, belief in [('nodes', 'array'), ('nodes', 'particle'),
+                             ('arrays', 'array')]:
+            policy = POMCPPolicyRunner(self.pomdp, iterations=30, horizon=5,
+                                       tree=tree, belief=belief,
+                                       tree_params={'legal_actions': True})
+            for _ in range(3):
+                self.assertNotEqual(policy.get_action(), 'c')
+                policy.step(True)
+            self.assertNotIn(2, self.actions)
+            belief = policy.tree.root.belief
+            for _ in range(10):
+                self.assertNotEqual(policy.tree.random_action(belief), 2)
+
+    def test_all_actions_are_used_by_default(self):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=30, horizon=5)
+        policy.get_action()
+        self.assertIn(2, self.actions)
+
+
+class TestCompilePolicy(TestCase):
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((4,)), (3, 4))
+        O = np.random.dirichlet(np.ones((2,)), (3, 4))
+        R = np.random.random((3, 4, 4, 2))
+        start = np.random.dirichlet(np.ones((4)))
+        self.pomdp = POMDP(T, O, R, start, 1, states=range(4),
+                           actions=['a', 'b', 'c'],
+                           observations=[True, False])
+
+    def _policy(self, **kwargs):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=200, horizon=4,
+                                   **kwargs)
+        policy.get_action()
+        return policy
+
+    def test_follows_tree(self):
+        for kwargs in [{}, {'tree': 'arrays'}, {'belief_values': True}]:
+            search = self._policy(**kwargs)
+            runner = TreePolicyRunner(compile_policy(search.tree))
+            for o in [True, False, True]:
+                node = search._node
+                if runner.is_fallback:
+                    break
+                a = runner.get_action()
+                self.assertEqual(self.pomdp.actions.index(a),
+                                 node.get_best_action(exploit=True))
+                search._last_action = self.pomdp.actions.index(a)
+                search.step(o)
+                runner.step(o)
+            self.assertEqual(runner.history, search.history)
+
+    def test_fallback(self):
+        search = self._policy()
+        compiled = compile_policy(search.tree, max_depth=0,
+                                  fallback_action=2)
+        self.assertEqual(compiled.n_nodes, 2)
+        runner = TreePolicyRunner(compiled)
+        self.assertEqual(self.pomdp.actions.index(runner.get_action()),
+                         search.tree.root.get_best_action(exploit=True))
+        runner.step(True)
+        self.assertTrue(runner.is_fallback)
+        for o in [True, False]:
+            self.assertEqual(runner.get_action(), 'c')
+            runner.step(o)
+        runner.reset()
+        self.assertFalse(runner.is_fallback)
+
+    def test_min_visits(self):
+        search = self._policy()
+        n = compile_policy(search.tree).n_nodes
+        self.assertLess(compile_policy(search.tree, min_visits=20).n_nodes, n)
+
+    def test_save_load(self):
+        compiled = compile_policy(self._policy().tree)
+        f = io.BytesIO()
+        compiled.save(f)
+        f.seek(0)
+        loaded = TreePolicy.load(f)
+        self.assertEqual(loaded.actions, compiled.actions)
+        self.assertEqual(loaded.observations, compiled.observations)
+        np.testing.assert_array_equal(loaded.action_table,
+                                      compiled.action_table)
+        np.testing.assert_array_equal(loaded.transitions,
+                                      compiled.transitions)
+
+    def test_graph_policy(self):
+        compiled = compile_policy(self._policy().tree)
+        runner = TreePolicyRunner(compiled)
+        graph = GraphPolicyRunner(compiled.to_graph_policy())
+        for o in [False, False, True, True]:
+            self.assertEqual(graph.get_action(), runner.get_action())
+            runner.step(o)
+            graph.step(o)
+
+
+class TestAsyncPOMCPPolicyRunner(TestCase):
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((4,)), (3, 4))
+        O = np.ones((3, 4, 2)) * .5
+        R = np.random.random((3, 4, 4, 2))
+        start = np.random.dirichlet(np.ones((4)))
+        self.pomdp = POMDP(T, O, R, start, 1, states=range(4),
+                           actions=['a', 'b', 'c'],
+                           observations=[True, False])
+
+    def test_explores_in_background(self):
+        policy = AsyncPOMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                        batch_size=5)
+        try:
+            a = policy.get_action()
+            self.assertIn(a, self.pomdp.actions)
+            n = policy.execute(lambda: policy.tree.root.n_simulations)
+            self.assertGreaterEqual(n, 20)
+            self.assertEqual(n, policy.tree.root.n_simulations)
+            policy.step(True)
+            self.assertEqual(len(policy.history), 2)
+        finally:
+            policy.stop()
+        self.assertFalse(policy.thread.is_alive())
+
+    def test_only_runs_remaining_iterations(self):
+        policy = POMCPPolicyRunner(self.pomdp, iterations=20, horizon=5)
+        for _ in range(15):
+            policy.tree.simulate_from_node(policy.tree.root)
+        _get_action_after_exploration(policy, policy.get_action)
+        self.assertEqual(policy.last_iterations, 5)
+        _get_action_after_exploration(policy, policy.get_action)
+        self.assertEqual(policy.last_iterations, 0)
+        _get_action_after_exploration(policy, policy.get_action,
+                                      iterations=3)
+        self.assertEqual(policy.last_iterations, 3)
+
+    def test_search_process(self):
+        policy = AsyncPOMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                        process=True)
+        try:
+            a = policy.get_action()
+            self.assertIn(a, self.pomdp.actions)
+            self.assertEqual(policy._last_action, self.pomdp.actions.index(a))
+            policy.step(False)
+            self.assertEqual(policy.history,
+                             [self.pomdp.actions.index(a), 1])
+            self.assertIsInstance(policy.belief, ArrayBelief)
+            policy.reset()
+            self.assertEqual(policy.history, [])
+        finally:
+            policy.stop()
+        self.assertFalse(policy.process.is_alive())
+        # The tree is only built in the search process
+        self.assertIsNone(policy.tree)
+
+    def test_search_process_raises_init_errors(self):
+        with self.assertRaises(ValueError):
+            AsyncPOMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                   tree='unknown', process=True)
+
+    def test_step_updates_explored_node(self):
+        policy = AsyncPOMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                        batch_size=1)
+        try:
+            for _ in range(3):
+                policy.get_action()
+                policy.step(True)
+                self.assertIs(policy.execute(lambda: policy.thread._node),
+                              policy._node)
+            policy.reset()
+            self.assertIs(policy.execute(lambda: policy.thread._node),
+                          policy.tree.root)
+        finally:
+            policy.stop()
+
+    def test_search_process_saves_and_loads_tree(self):
+        policy = AsyncPOMCPPolicyRunner(self.pomdp, iterations=20, horizon=5,
+                                        process=True)
+        path = os.path.join(tempfile.mkdtemp(), 'tree.npz')
+        try:
+            policy.get_action()
+            policy.save_tree(path)
+            with self.assertRaises(ValueError):
+                policy.save_tree(io.BytesIO())
+            policy.step(True)
+            policy.load_tree(path)
+            self.assertEqual(policy.history, [])
+        finally:
+            policy.stop()
+        loaded = POMCPPolicyRunner(self.pomdp, iterations=20, horizon=5)
+        loaded.load_tree(path)
+        self.assertGreaterEqual(loaded.tree.root.n_simulations, 20)
+
+
+class TestSharedSearchTree(TestCase):
+
+    def setUp(self):
+        T = np.random.dirichlet(np.ones((4,)), (3, 4))
+        O = np.ones((3, 4, 2)) * .5
+        R = np.random.random((3, 4, 4, 2))
+        start = np.random.dirichlet(np.ones((4)))
+        self.pomdp = POMDP(T, O, R, start, 1, states=range(4),
+                           actions=['a', 'b', 'c'],
+                           observations=[True, False])
+
+    def _shared(self, **kwargs):
+        return SharedSearchTree(POMCPPolicyRunner(
+            self.pomdp, horizon=5, **kwargs).tree)
+
+    def test_unsupported_trees(self):
+        with self.assertRaises(ValueError):
+            self._shared(tree='arrays')
+        with self.assertRaises(ValueError):
+            self._shared(profile=True)
+
+    def test_sessions_share_statistics(self):
+        shared = self._shared()
+        s1 = SharedTreeRunner(shared, iterations=20)
+        s2 = SharedTreeRunner(shared, iterations=20)
+        a = s1.get_action()
+        self.assertIn(a, self.pomdp.actions)
+        self.assertEqual(shared.root.n_simulations, 20)
+        s2.get_action()
+        self.assertEqual(shared.root.n_simulations, 40)
+        s1.step(True)
+        self.assertEqual(s1.history, [self.pomdp.actions.index(a), 0])
+        self.assertIs(s1._node, shared.get_node(s1.history))
+        self.assertIs(s2._node, shared.root)
+        s1.reset()
+        self.assertIs(s1._node, shared.root)
+
+    def test_concurrent_sessions(self):
+        for kwargs in [{}, {'belief_values': True}]:
+            shared = self._shared(**kwargs)
+            sessions = [SharedTreeRunner(shared, iterations=50)
+                        for _ in range(4)]
+
+            def run(session):
+                session.get_action()
+                session.step(False)
+                session.get_action()
+
+            threads = [threading.Thread(target=run, args=(s,))
+                       for s in sessions]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            # No update is lost
+            self.assertGreaterEqual(shared.root.n_simulations, 200)
+            n_nodes = len(list(shared.tree._iterate_observation_nodes()))
+            self.assertEqual(shared.tree.n_nodes, n_nodes)
+
 
 class Test_ValueAverage(TestCase):
 
@@ -3,8 +3,10 @@ from unittest import TestCase
 
 import numpy as np
 
+from task_models.lib.belief import SuccessorCache
 from task_models.lib.pomdp import (
     parse_value_function, parse_policy_graph, POMDP, GraphPolicy,
+    GraphPolicyBeliefRunner, Impossible,
     _dump_list, _dump_1d_array, _dump_2d_array, _dump_3d_array, _dump_4d_array)
 
 
@@ -264,6 +266,63 @@ class TestPOMDP(TestCase):
         c = p.belief_update(a, o, b)
         np.testing.assert_allclose(c, self.T[a, s, :])
 
+    def test_sample_transitions(self):
+        T = np.zeros((4, 3, 3))
+        T[:, :, 1] = .5
+        T[:, :, 2] = .5
+        p = POMDP(T, self.O, self.R, self.start, .8)
+        a = np.random.randint(4, size=1000)
+        s = np.random.randint(3, size=1000)
+        new_s, o, r = p.sample_transitions(a, s)
+        self.assertEqual(new_s.shape, (1000,))
+        self.assertTrue(((new_s == 1) | (new_s == 2)).all())
+        self.assertAlmostEqual((new_s == 1).mean(), .5, delta=.1)
+        self.assertTrue(((o == 0) | (o == 1)).all())
+        np.testing.assert_array_equal(r, self.R[a, s, new_s, o])
+
+    def test_sparse_belief_update(self):
+        self.T[:, :, 1] = 0.
+        self.T /= self.T.sum(-1, keepdims=True)
+        p = POMDP(self.T, self.O, self.R, self.start, .8)
+        for states, probabilities in [([2], [1.]), ([0, 1], [.4, .6]),
+                                      ([0, 1, 2], self.start)]:
+            b = np.zeros((3,))
+            b[states] = probabilities
+            for a, o in [(0, 0), (3, 1)]:
+                new_states, new_p = p.sparse_belief_update(a, o, states,
+                                                           probabilities)
+                np.testing.assert_array_equal(new_states, [0, 2])
+                np.testing.assert_allclose(new_p,
+                                           p.belief_update(a, o, b)[[0, 2]])
+
+    def test_sparse_belief_update_raises_Impossible(self):
+        self.O[:, 1, :] = [1., 0.]
+        p = POMDP(np.eye(3)[None, :, :].repeat(4, 0), self.O, self.R,
+                  self.start, .8)
+        with self.assertRaises(Impossible):
+            p.sparse_belief_update(0, 1, [1], [1.])
+
+    def test_observation_probability(self):
+        p = POMDP(self.T, self.O, self.R, self.start, .8)
+        self.assertEqual(p.observation_probability(2, 0, 1, 1),
+                         self.O[2, 1, 1])
+        np.testing.assert_array_equal(
+            p.observation_probability(1, [0, 1], [2, 0], 0),
+            self.O[1, [2, 0], 0])
+
+    def test_mdp_q_values(self):
+        T = np.zeros((2, 3, 3))
+        T[0, :, 0] = 1.  # Action 0 resets
+        T[1, [0, 1, 2], [1, 2, 2]] = 1.  # Action 1 moves forward
+        R = np.zeros((2, 3, 3, 2))
+        R[1, 1, 2, :] = 1.
+        p = POMDP(T, self.O[:2], R, self.start, .5)
+        q = p.mdp_q_values(n_iterations=50)
+        self.assertEqual(q.shape, (2, 3))
+        # Fixed point: V = [4/7, 8/7, 2/7]
+        np.testing.assert_allclose(q[1], np.array([4., 8., 1.]) / 7)
+        np.testing.assert_allclose(q[0], np.array([2., 2., 2.]) / 7)
+
     def test_save_load(self):
         p = POMDP(self.T, self.O, self.R, self.start, .8)
         dump = p.as_json()
@@ -310,3 +369,30 @@ class TestPolicy(TestCase):
         np.testing.assert_allclose(pol.transitions, p.transitions)
         np.testing.assert_allclose(pol.values, p.values)
         self.assertEqual(self.i, p.init)
+
+
+class TestGraphPolicyBeliefRunner(TestCase):
+
+    def setUp(self):
+        T = np.eye(3)[None, :, :].repeat(2, 0)
+        T[1] = np.roll(T[1], 1, axis=1)
+        O = np.array([[1., 0.], [0., 1.], [.5, .5]])[None, :, :].repeat(2, 0)
+        self.pomdp = POMDP(T, O, np.zeros((2, 3, 3, 2)),
+                           np.array([1., 0., 0.]), 1., actions=['a', 'b'],
+                           observations=['x', 'y'])
+        self.gp = GraphPolicy(['a', 'b'], ['x', 'y'], [[1, 0], [0, 1]],
+                              np.eye(2, 3), init=0)
+
+    def test_successor_cache(self):
+        expected = GraphPolicyBeliefRunner(
+            self.gp, self.pomdp).trajectory_tree(4)
+        cache = SuccessorCache()
+        runner = GraphPolicyBeliefRunner(self.gp, self.pomdp,
+                                         successor_cache=cache)
+        self.assertEqual(runner.trajectory_tree(4), expected)
+        misses = cache.misses
+        runner.reset()
+        self.assertEqual(runner.trajectory_tree(4), expected)
+        # Impossible observations are cached too
+        self.assertEqual(cache.misses, misses)
+        self.assertGreater(cache.hits, 0)
@@ -9,7 +9,9 @@ from task_models.supportive import (_HTMToDAG, unique, SupportivePOMDP,
                                     AssembleFoot, AssembleTopJoint,
                                     AssembleLegToTop, BringTop,
                                     CONSUMES, USES, _SupportivePOMDPState,
-                                    NHTMHorizon)
+                                    NHTMHorizon, SupportiveRolloutPolicy,
+                                    HTMDistancePrior)
+from task_models.lib.belief import ArrayBelief
 
 
 class TestHelpers(TestCase):
@@ -443,6 +445,81 @@ class TestSupportivePOMDP(TestCase):
         self.assertEqual(_s.has_object(1), 1)
         self.assertEqual(o, self.p.O_NOT_FOUND)
 
+    def test_sample_transitions_not_random(self):
+        states = np.arange(self.p.n_states)
+        for a in range(self.p.n_actions):
+            new_s, o, r = self.p.sample_transitions(a, states, random=False)
+            for i, s in enumerate(states):
+                self.assertEqual(
+                    (new_s[i], o[i], r[i]),
+                    self.p.sample_transition(a, s, random=False))
+
+    def test_sample_transitions_counts_calls(self):
+        n = self.p.n_simulator_calls
+        self.p.sample_transitions([0, 1, 4], [0, 1, 2])
+        self.assertEqual(self.p.n_simulator_calls, n + 3)
+
+    def test_observation_probability(self):
+        self.p.p_changed_by_human = .1
+        self.p.p_change_preference = .1
+        self.p.p_fail = .2
+        states = np.arange(self.p.n_states)
+        for a in range(self.p.n_actions):
+            s = np.repeat(states, 200)
+            new_s, o, _ = self.p.sample_transitions(a, s)
+            p = self.p.observation_probability(
+                a, s[:, None], new_s[:, None],
+                np.arange(self.p.n_observations))
+            np.testing.assert_allclose(p.sum(-1), 1.)
+            # Sampled observations are possible and on average as likely
+            # as predicted
+            self.assertTrue((p[np.arange(len(s)), o] > 0).all())
+            np.testing.assert_allclose(
+                p.mean(0), np.bincount(o, minlength=p.shape[1]) / len(s),
+                atol=.02)
+
+    def test_legal_actions(self):
+        _s = self.p._int_to_state()
+        _s.htm = 1
+        _s.set_object(self.p.objects.index('joints'), 1)
+        legal = self.p.legal_actions(_s.to_int())
+        self.assertEqual(legal.shape, (self.p.n_actions,))
+        self.assertTrue(legal[[self.p.A_WAIT, self.p.A_HOLD_H,
+                               self.p.A_HOLD_V, self.p.A_ASK]].all())
+        self.assertFalse(legal[self.p._bring(1)])
+        self.assertTrue(legal[self.p._clear(1)])
+        self.assertTrue(legal[self.p._bring(2)])
+        self.assertFalse(legal[self.p._clear(3)])
+        _s.htm = self.p.htm_clean
+        legal = self.p.legal_actions(_s.to_int())
+        self.assertFalse(legal[[self.p.A_HOLD_H, self.p.A_HOLD_V]].any())
+        _s.htm = self.p.htm_final
+        legal = self.p.legal_actions(_s.to_int())
+        self.assertEqual(list(np.flatnonzero(legal)), [self.p.A_WAIT])
+
+    def test_rollout_policy_brings_missing_objects(self):
+        policy = SupportiveRolloutPolicy(self.p)
+        _s = self.p._int_to_state()
+        _s.htm = 1
+        _s.set_object(self.p.objects.index('joints'), 1)
+        self.assertEqual(policy.action(_s.to_int()),
+                         self.p._bring(self.p.objects.index('leg')))
+        for o in ['leg', 'screwdriver', 'screws']:
+            _s.set_object(self.p.objects.index(o), 1)
+        self.assertEqual(policy.action(_s.to_int()), self.p.A_WAIT)
+
+    def test_rollout_policy_clears_objects(self):
+        policy = SupportiveRolloutPolicy(self.p)
+        _s = self.p._int_to_state()
+        _s.htm = self.p.htm_clean
+        _s.set_object(self.p.objects.index('screws'), 1)
+        self.assertEqual(policy.action(_s.to_int()),
+                         self.p._clear(self.p.objects.index('screws')))
+        _s.set_object(self.p.objects.index('screws'), 0)
+        self.assertEqual(policy.action(_s.to_int()), self.p.A_WAIT)
+        _s.htm = self.p.htm_final
+        self.assertEqual(policy.action(_s.to_int()), self.p.A_WAIT)
+
     def test_reward_independent_preference(self):
         htm = SequentialCombination([self.alt, self.af])
         p = SupportivePOMDP(htm)
@@ -472,6 +549,31 @@ class TestSupportivePOMDP(TestCase):
         self.assertEqual(r, 10. - p.cost_hold + 10.)
 
 
+class TestHTMDistancePrior(TestCase):
+
+    def setUp(self):
+        htm = SequentialCombination([LeafCombination(BringTop()),
+                                     LeafCombination(AssembleFoot('leg-1'))])
+        self.model = SupportivePOMDP(htm)
+        self.prior = HTMDistancePrior(self.model, penalty=3.)
+
+    def test_distances(self):
+        self.assertEqual(self.prior.distances, [2, 1, 0, 0])
+
+    def test_values(self):
+        _s = self.model._int_to_state()
+        _s.htm = 1
+        b = ArrayBelief(np.eye(self.model.n_states)[_s.to_int()])
+        values = self.prior.values(b)
+        best = self.model.r_subtask + self.model.r_final
+        a = SupportiveRolloutPolicy(self.model).action(_s.to_int())
+        self.assertEqual(values[a], best)
+        self.assertEqual(sorted(set(values)), [best - 3., best])
+        _s.htm = self.model.htm_final
+        b = ArrayBelief(np.eye(self.model.n_states)[_s.to_int()])
+        self.assertEqual(self.prior.values(b)[self.model.A_WAIT], 0.)
+
+
 class TestNHTMHorizon(TestCase):
 
     def setUp(self):
@@ -0,0 +1,63 @@
+import pickle
+from unittest import TestCase
+
+import numpy as np
+
+from task_models.lib.utils import BufferedRandom
+from task_models.lib.belief import ArrayBelief, ParticleBelief
+
+
+class TestBufferedRandom(TestCase):
+
+    def test_scalar_draws_refill_blocks(self):
+        rng = BufferedRandom(0, block_size=4)
+        draws = [rng.random() for _ in range(10)]
+        self.assertTrue(all(0 <= u < 1 for u in draws))
+        self.assertEqual(len(set(draws)), 10)  # New blocks are drawn
+        ints = [rng.randint(3) for _ in range(10)]
+        self.assertTrue(all(0 <= i < 3 for i in ints))
+        self.assertEqual(rng._integers[3][1], 2)  # 10 = 4 + 4 + 2
+
+    def test_same_seed_same_draws(self):
+        def draws(rng):
+            return ([rng.random() for _ in range(5)] +
+                    [rng.randint(7) for _ in range(5)] +
+                    [rng.choice(4, p=[.1, .2, .3, .4]) for _ in range(5)] +
+                    rng.random(3).tolist())
+
+        self.assertEqual(draws(BufferedRandom(3, block_size=2)),
+                         draws(BufferedRandom(3, block_size=2)))
+        self.assertNotEqual(draws(BufferedRandom(3)),
+                            draws(BufferedRandom(4)))
+        rng = BufferedRandom(3)
+        first = draws(rng)
+        rng.seed(3)
+        self.assertEqual(draws(rng), first)
+
+    def test_choice_skips_zero_probabilities(self):
+        rng = BufferedRandom(1, block_size=16)
+        p = [0., .5, 0., .5, 0.]
+        samples = [rng.choice(5, p=p) for _ in range(200)]
+        self.assertEqual(set(samples), set([1, 3]))
+        self.assertEqual(set(rng.choice(['a', 'b', 'c'], p=[0., 0., 1.])
+                             for _ in range(10)), set(['c']))
+
+    def test_choice_from_sequence(self):
+        rng = BufferedRandom(1)
+        self.assertIn(rng.choice(['a', 'b']), ['a', 'b'])
+        self.assertEqual(rng.choice(np.arange(3), size=4).shape, (4,))
+
+
+class TestRandomSource(TestCase):
+
+    def test_default_is_global_and_picklable(self):
+        b = ArrayBelief([.5, .5])
+        self.assertIs(b.rng, np.random)
+        self.assertEqual(pickle.loads(pickle.dumps(b)), b)
+
+    def test_source_is_passed_to_beliefs(self):
+        rng = BufferedRandom(2)
+        b = ParticleBelief(lambda: 1, 3, n_particles=5, rng=rng)
+        self.assertIs(b.rng, rng)
+        self.assertIs(pickle.loads(pickle.dumps(b)).rng.__class__,
+                      BufferedRandom)